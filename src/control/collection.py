@@ -0,0 +1,113 @@
+import numpy as np
+import gymnasium as gym
+
+
+class VectorEnvCollector:
+    """
+    Collects episodes from several copies of an environment stepped together in a gymnasium vector env,
+    so that with asynchronous=True each copy is stepped in its own process. The episodes of a round run
+    in lockstep: the policy picks the actions of every environment at once, and an episode's transitions
+    are handed back as soon as its environment finishes.
+    """
+
+    def __init__(self, env_fn, num_envs, episode_len, gamma, reward=None, terminate=None, asynchronous=True):
+        """
+        Parameters
+        ----------
+        env_fn : function
+            Takes no arguments and returns a new gym.Env.
+        num_envs : int
+            Number of environments stepped together.
+        episode_len : int
+            Maximum number of time steps in each episode.
+        gamma : float in (0, 1]
+            Discount factor for computing returns.
+        reward : function
+            If given, overrides the reward from the environment, see MBRLLearner.
+        terminate : function
+            If given, also ends episodes on this condition, see MBRLLearner. Episodes still end when the
+            environment terminates or truncates them, since the vector env has already reset it by then.
+        asynchronous : bool
+            If true, use gym.vector.AsyncVectorEnv (one process per environment), else gym.vector.SyncVectorEnv.
+        """
+        self.num_envs = num_envs
+        self.episode_len = episode_len
+        self.gamma = gamma
+        self.reward = reward
+        self.terminate = terminate
+
+        # Environments that finish early are reset by the vector env and keep stepping (their results
+        # are ignored) until the whole round is done
+        vector_env = gym.vector.AsyncVectorEnv if asynchronous else gym.vector.SyncVectorEnv
+        self.envs = vector_env([env_fn for i in range(num_envs)],
+                               autoreset_mode=gym.vector.AutoresetMode.SAME_STEP)
+
+    def collect(self, policy, num_episodes, on_episode=None):
+        """
+        Run one round of up to num_envs episodes.
+
+        Parameters
+        ----------
+        policy : function
+            Takes the (num_envs, state_dim) array of current observations, the timestep and the boolean
+            (num_envs,) mask of environments whose episode is still running, and returns a (num_envs, action_dim)
+            array of actions. Actions of finished environments are ignored.
+        num_episodes : int
+            Number of episodes to collect, at most num_envs.
+        on_episode : function
+            If given, called with (i, states, actions, next_states, ret, ep_len) as soon as the episode of
+            environment i ends, e.g. to push its transitions to a ReplayBuffer.
+
+        Return
+        ------
+        list of tuples (states, actions, next_states, ret, ep_len), one per episode in environment order, where
+        ep_len is the time step the episode terminated at (episode_len if it did not terminate).
+        """
+        if num_episodes > self.num_envs:
+            raise ValueError("Cannot collect more episodes than there are environments in one round")
+        o, _ = self.envs.reset()
+        active = np.arange(self.num_envs) < num_episodes
+        rets = np.zeros(self.num_envs)
+        ep_lens = np.full(self.num_envs, self.episode_len)
+        transitions = [([], [], []) for i in range(self.num_envs)]
+        episodes = [None] * self.num_envs
+
+        for t in range(self.episode_len):
+            actions = np.asarray(policy(o, t, active.copy()))
+            next_o, rewards, terminated, truncated, _ = self.envs.step(actions)
+            for i in np.flatnonzero(active):
+                # Use custom reward function
+                reward = rewards[i] if self.reward is None else self.reward(o[i], actions[i])
+                rets[i] += (self.gamma ** t) * reward
+
+                # Use custom termination condition. With same step autoreset next_o[i] is the first observation
+                # of the next episode once the environment is done, so its episode ends whatever terminate says.
+                done = terminated[i] or truncated[i]
+                if self.terminate is not None:
+                    done = done or self.terminate(o[i], actions[i], t)
+
+                if done:
+                    ep_lens[i] = t
+                    active[i] = False
+                    episodes[i] = self.finish_episode(i, transitions[i], rets[i], ep_lens[i], on_episode)
+                    continue
+                transitions[i][0].append(o[i])
+                transitions[i][1].append(actions[i])
+                transitions[i][2].append(next_o[i])
+            if not active.any():
+                break
+            o = next_o
+
+        for i in np.flatnonzero(active):
+            episodes[i] = self.finish_episode(i, transitions[i], rets[i], ep_lens[i], on_episode)
+        return episodes[:num_episodes]
+
+    def finish_episode(self, i, transitions, ret, ep_len, on_episode):
+        states, actions, next_states = [np.array(x) for x in transitions]
+        episode = (states, actions, next_states, ret, ep_len)
+        if on_episode is not None:
+            on_episode(i, *episode)
+        return episode
+
+    def close(self):
+        self.envs.close()
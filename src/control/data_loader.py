@@ -0,0 +1,112 @@
+import queue
+import threading
+
+import numpy as np
+import torch
+
+_END = object()
+
+
+class PrefetchLoader:
+    """
+    Iterates over minibatches sampled from a ReplayBuffer. Batches are sampled, normalized and
+    converted to contiguous float32 tensors on a background thread, which keeps up to 'prefetch'
+    batches ready while the current optimizer step runs.
+
+    Use as a context manager so that the background thread is always shut down:
+
+        with PrefetchLoader(replay_buffer, batch_size, num_batches) as loader:
+            for input, target in loader:
+                ...
+    """
+
+    def __init__(self, replay_buffer, batch_size, num_batches, rl_prop=0, prefetch=2, seed=None, pin_memory=False):
+        """
+        Parameters
+        ----------
+        replay_buffer : ReplayBuffer
+            Must not be sampled from by other threads while the loader is running (pushing is safe).
+        batch_size : int
+        num_batches : int
+            Number of batches to produce.
+        rl_prop : float in [0, 1]
+            Fraction of samples that come from MPC transitions, see ReplayBuffer.sample.
+        prefetch : int
+            Maximum number of batches prepared ahead of the consumer.
+        seed : int or np.random.SeedSequence
+            Seed of the generator used for sampling, so that the sequence of batches is reproducible.
+        pin_memory : bool
+            If true, batches are copied into page-locked memory (for fast transfer to a GPU).
+        """
+        self.replay_buffer = replay_buffer
+        self.batch_size = batch_size
+        self.num_batches = num_batches
+        self.rl_prop = rl_prop
+        self.pin_memory = pin_memory
+        self.rng = np.random.default_rng(seed)
+        self.queue = queue.Queue(maxsize=prefetch)
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.produce, daemon=True)
+            self.thread.start()
+
+    def produce(self):
+        try:
+            for i in range(self.num_batches):
+                if self.stop_event.is_set():
+                    return
+                state, action, d_state = self.replay_buffer.sample(self.batch_size, self.rl_prop, rng=self.rng)
+
+                # Copy out of the replay buffer's reusable batch buffers
+                input = np.empty((state.shape[0], state.shape[1] + action.shape[1]), dtype=np.float32)
+                input[:, :state.shape[1]] = state
+                input[:, state.shape[1]:] = action
+                input = torch.from_numpy(input)
+                target = torch.from_numpy(d_state.astype(np.float32))
+                if self.pin_memory:
+                    input = input.pin_memory()
+                    target = target.pin_memory()
+                self.put((input, target))
+        except Exception as e:
+            self.put(e)
+        finally:
+            self.put(_END)
+
+    def put(self, item):
+        while not self.stop_event.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def __iter__(self):
+        self.start()
+        while True:
+            item = self.queue.get()
+            if item is _END:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    def close(self):
+        """
+        Stop the background thread and drop any batches it already prepared.
+        """
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        while not self.queue.empty():
+            self.queue.get_nowait()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
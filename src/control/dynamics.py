@@ -26,49 +26,79 @@ class DynamicsModel(nn.Module):
         self.action_var = nn.Parameter(torch.ones(action_dim), requires_grad=False)
         self.action_mean = nn.Parameter(torch.zeros(action_dim), requires_grad=False)
         self.normalize = normalize
+        self.version = 0
+        self.linear_relu_stack = self.create_network()
 
-        self.linear_relu_stack = nn.Sequential(
-            nn.Linear(state_dim + action_dim, 512),
+    def create_network(self):
+        return nn.Sequential(
+            nn.Linear(self.state_dim + self.action_dim, 512),
             nn.ReLU(),
             nn.Linear(512, 512),
             nn.ReLU(),
-            nn.Linear(512, state_dim)
+            nn.Linear(512, self.state_dim)
         )
 
-        # self.linear_relu_stack = nn.Sequential(
-        #     nn.Linear(state_dim + action_dim, 64),
+        # return nn.Sequential(
+        #     nn.Linear(self.state_dim + self.action_dim, 64),
         #     nn.ReLU(),
-        #     nn.Linear(64, state_dim)
+        #     nn.Linear(64, self.state_dim)
         # )
 
     def forward(self, x):
         output = self.linear_relu_stack(x)
         return output
 
+    def predict(self, x):
+        """
+        Predicted (normalized) next_state - state for the (normalized) input 'x'.
+        """
+        return self.forward(x)
+
+    def training_loss(self, input, target, loss):
+        """
+        Loss of the model on a minibatch of (normalized) inputs and next_state - state targets.
+        """
+        return loss(self.forward(input), target)
+
     def forward_np(self, state, action):
         if self.normalize:
             n_state, n_action = self.normalize_state_action(state, action)
             x = np.concatenate((n_state, n_action))
             x_torch = torch.from_numpy(x).float()
-            n_next_state = self.forward(x_torch).detach().numpy() + n_state
+            n_next_state = self.predict(x_torch).detach().numpy() + n_state
             output = self.denormalize_state(n_next_state)
         else:
             x = np.concatenate((state, action))
             x_torch = torch.from_numpy(x).float()
-            output = self.forward(x_torch).detach().numpy() + state
+            output = self.predict(x_torch).detach().numpy() + state
 
         return output
 
+    def increment_version(self):
+        """
+        Mark the weights or normalization statistics as changed, so that copies held by
+        rollout workers get refreshed.
+        """
+        self.version += 1
+
+    def load_state_dict(self, *args, **kwargs):
+        self.increment_version()
+        return super().load_state_dict(*args, **kwargs)
+
     def update_state_var(self, state_var):
+        self.increment_version()
         self.state_var = nn.Parameter(torch.from_numpy(state_var))
 
     def update_state_mean(self, state_mean):
+        self.increment_version()
         self.state_mean = nn.Parameter(torch.from_numpy(state_mean))
 
     def update_action_var(self, action_var):
+        self.increment_version()
         self.action_var = nn.Parameter(torch.from_numpy(action_var))
 
     def update_action_mean(self, action_mean):
+        self.increment_version()
         self.action_mean = nn.Parameter(torch.from_numpy(action_mean))
 
     def normalize_state_action(self, state, action):
@@ -76,14 +106,14 @@ class DynamicsModel(nn.Module):
         state_var = self.state_var.detach().numpy()
         action_mean = self.action_mean.detach().numpy()
         action_var = self.action_var.detach().numpy()
-        n_state = (state - state_mean) @ np.diagflat(np.reciprocal(np.sqrt(state_var)))
-        n_action = (action - action_mean) @ np.diagflat(np.reciprocal(np.sqrt(action_var)))
+        n_state = (state - state_mean) / np.sqrt(state_var)
+        n_action = (action - action_mean) / np.sqrt(action_var)
         return n_state, n_action
 
     def denormalize_state(self, state):
         state_mean = self.state_mean.detach().numpy()
         state_var = self.state_var.detach().numpy()
-        output = state @ np.diagflat(np.sqrt(state_var)) + state_mean
+        output = state * np.sqrt(state_var) + state_mean
         return output
 
     def create_nn_params(self):
@@ -116,6 +146,234 @@ class DynamicsModel(nn.Module):
                      'stack': stack}
         return nn_params
 
+    def create_folded_nn_params(self):
+        """
+        Export the network for inference with the normalization folded into the weights. With
+        x = (state - mean) / std the first layer W1 x + b1 equals (W1 / std) input + (b1 - (W1 / std) mean),
+        and the denormalized residual (W3 h + b3 + n_state) * state_std + state_mean equals
+        state + (state_std * W3) h + state_std * b3. So the folded network maps the raw (state, action)
+        to next_state - state without any elementwise normalization.
+
+        Return
+        ------
+        dict: {'stack': stack} where stack has the same keys and layout as in create_nn_params().
+        """
+        stack = self.create_nn_params()['stack']
+        state_std, input_mean, input_std = self.folding_statistics()
+
+        w1 = stack['w1'] / input_std
+        b1 = stack['b1'] - w1 @ input_mean
+        w3 = state_std[:, np.newaxis] * stack['w3']
+        b3 = state_std * stack['b3']
+
+        folded_stack = {'w1': np.array(w1, dtype=np.float32, order='F'),
+                        'w2': stack['w2'],
+                        'w3': np.array(w3, dtype=np.float32, order='F'),
+                        'b1': b1.astype(np.float32),
+                        'b2': stack['b2'],
+                        'b3': b3.astype(np.float32)}
+        return {'stack': folded_stack}
+
+    def folding_statistics(self):
+        """
+        Return (state_std, input_mean, input_std) used to fold the normalization into the weights,
+        where the input is the concatenated (state, action).
+        """
+        if self.normalize:
+            state_mean = self.state_mean.detach().numpy().astype(np.float64)
+            state_std = np.sqrt(self.state_var.detach().numpy().astype(np.float64))
+            action_mean = self.action_mean.detach().numpy().astype(np.float64)
+            action_std = np.sqrt(self.action_var.detach().numpy().astype(np.float64))
+        else:
+            state_mean, state_std = np.zeros(self.state_dim), np.ones(self.state_dim)
+            action_mean, action_std = np.zeros(self.action_dim), np.ones(self.action_dim)
+        input_mean = np.concatenate((state_mean, action_mean))
+        input_std = np.concatenate((state_std, action_std))
+        return state_std, input_mean, input_std
+
+
+class EnsembleLinear(nn.Module):
+    """
+    'num_members' independent linear layers stored as stacked tensors, so that all members are applied
+    with a single batched matmul.
+    """
+
+    def __init__(self, num_members, in_features, out_features):
+        super().__init__()
+        self.num_members = num_members
+        self.in_features = in_features
+        self.out_features = out_features
+
+        # Same initialization as nn.Linear, independently for each member
+        bound = 1 / np.sqrt(in_features)
+        self.weight = nn.Parameter(torch.empty(num_members, in_features, out_features).uniform_(-bound, bound))
+        self.bias = nn.Parameter(torch.empty(num_members, 1, out_features).uniform_(-bound, bound))
+
+    def forward(self, x):
+        """
+        Map the (num_members, batch_size, in_features) input to a (num_members, batch_size, out_features) output.
+        """
+        return torch.baddbmm(self.bias, x, self.weight)
+
+
+class EnsembleDynamicsModel(DynamicsModel):
+    """
+    An ensemble of dynamics models (as in PETS), with all members stored as stacked weight tensors. Each
+    member optionally has a Gaussian output head predicting the log-variance of next_state - state.
+    """
+
+    def __init__(self, state_dim, action_dim, normalize=False, num_members=5, probabilistic=False, hidden_dim=512):
+        """
+        Parameters
+        ----------
+        state_dim : int
+            Dimension of states.
+        action_dim : int
+            Dimension of actions.
+        normalize : boolean
+            Normalize data.
+        num_members : int
+            Number of models in the ensemble.
+        probabilistic : boolean
+            If true, each member predicts a diagonal Gaussian over next_state - state.
+        hidden_dim : int
+            Width of the hidden layers.
+        """
+        self.num_members = num_members
+        self.probabilistic = probabilistic
+        self.hidden_dim = hidden_dim
+        super().__init__(state_dim, action_dim, normalize)
+        if probabilistic:
+            self.max_logvar = nn.Parameter(0.5 * torch.ones(state_dim))
+            self.min_logvar = nn.Parameter(-10 * torch.ones(state_dim))
+
+    def create_network(self):
+        output_dim = 2 * self.state_dim if self.probabilistic else self.state_dim
+        return nn.Sequential(
+            EnsembleLinear(self.num_members, self.state_dim + self.action_dim, self.hidden_dim),
+            nn.ReLU(),
+            EnsembleLinear(self.num_members, self.hidden_dim, self.hidden_dim),
+            nn.ReLU(),
+            EnsembleLinear(self.num_members, self.hidden_dim, output_dim)
+        )
+
+    def forward(self, x):
+        """
+        Parameters
+        ----------
+        x : torch.Tensor
+            (batch_size, input_dim) input shared by all members, or (num_members, batch_size, input_dim)
+            input with a separate batch for each member.
+
+        Return
+        ------
+        torch.Tensor: (num_members, batch_size, output_dim) output of every member.
+        """
+        if x.dim() < 3:
+            x = x.expand(self.num_members, *x.shape)
+        return self.linear_relu_stack(x)
+
+    def mean_logvar(self, x):
+        """
+        Return the predicted mean and (softly bounded) log-variance of every member, each of shape
+        (num_members, batch_size, state_dim). The log-variance is None if the model is not probabilistic.
+        """
+        output = self.forward(x)
+        if not self.probabilistic:
+            return output, None
+        mean = output[..., :self.state_dim]
+        logvar = output[..., self.state_dim:]
+        logvar = self.max_logvar - F.softplus(self.max_logvar - logvar)
+        logvar = self.min_logvar + F.softplus(logvar - self.min_logvar)
+        return mean, logvar
+
+    def predict(self, x):
+        """
+        Mean prediction of the ensemble, of shape (batch_size, state_dim) (or (state_dim,) for a single input).
+        """
+        squeeze = x.dim() == 1
+        if squeeze:
+            x = x.unsqueeze(0)
+        mean, _ = self.mean_logvar(x)
+        mean = mean.mean(dim=0)
+        return mean.squeeze(0) if squeeze else mean
+
+    def training_loss(self, input, target, loss):
+        """
+        Each member is trained on its own bootstrap resample of the minibatch. Deterministic members
+        minimize 'loss', probabilistic ones the Gaussian negative log-likelihood with a penalty keeping
+        the log-variance bounds tight. The member losses are summed so each gets a full-size gradient.
+        """
+        idx = torch.randint(input.shape[0], (self.num_members, input.shape[0]), device=input.device)
+        input = input[idx]
+        target = target[idx]
+        mean, logvar = self.mean_logvar(input)
+        if not self.probabilistic:
+            return loss(mean, target) * self.num_members
+        nll = (torch.square(mean - target) * torch.exp(-logvar) + logvar).mean(dim=(1, 2)).sum()
+        return nll + 0.01 * (self.max_logvar.sum() - self.min_logvar.sum())
+
+    def create_nn_params(self):
+        """
+        Same as DynamicsModel.create_nn_params(), except that every array in the stack has a leading
+        member dimension. stack['w1'][m] etc. are FORTRAN-contiguous (out, in) matrices.
+        """
+        stack = {}
+        for i, layer in [(1, 0), (2, 2), (3, 4)]:
+            module = self.linear_relu_stack[layer]
+            stack['w' + str(i)] = stacked_fortran(module.weight.detach().numpy().transpose(0, 2, 1))
+            stack['b' + str(i)] = module.bias.detach().numpy()[:, 0, :]
+
+        nn_params = {'state_mean': self.state_mean.detach().numpy(),
+                     'state_var': self.state_var.detach().numpy(),
+                     'action_mean': self.action_mean.detach().numpy(),
+                     'action_var': self.action_var.detach().numpy(),
+                     'stack': stack}
+        return nn_params
+
+    def create_folded_nn_params(self):
+        """
+        Same as DynamicsModel.create_folded_nn_params() for every member. Only the mean part of a Gaussian
+        output layer is folded; its log-variance stays in normalized units, to be bounded and then
+        scaled by state_std.
+
+        Return
+        ------
+        dict: {'stack', 'num_members', 'probabilistic', 'state_std', 'max_logvar', 'min_logvar'}
+        """
+        stack = self.create_nn_params()['stack']
+        state_std, input_mean, input_std = self.folding_statistics()
+
+        w1 = stack['w1'] / input_std
+        b1 = stack['b1'] - np.einsum('mhi,i->mh', w1, input_mean)
+        w3 = np.array(stack['w3'], dtype=np.float64)
+        b3 = np.array(stack['b3'], dtype=np.float64)
+        w3[:, :self.state_dim, :] *= state_std[:, np.newaxis]
+        b3[:, :self.state_dim] *= state_std
+
+        folded_stack = {'w1': stacked_fortran(w1),
+                        'w2': stack['w2'],
+                        'w3': stacked_fortran(w3),
+                        'b1': b1.astype(np.float32),
+                        'b2': stack['b2'],
+                        'b3': b3.astype(np.float32)}
+        nn_params = {'stack': folded_stack,
+                     'num_members': self.num_members,
+                     'probabilistic': self.probabilistic,
+                     'state_std': state_std}
+        if self.probabilistic:
+            nn_params['max_logvar'] = self.max_logvar.detach().numpy().astype(np.float64)
+            nn_params['min_logvar'] = self.min_logvar.detach().numpy().astype(np.float64)
+        return nn_params
+
+
+def stacked_fortran(w):
+    """
+    Copy the (num_members, out, in) array 'w' to float32 so that every member's matrix w[m] is
+    FORTRAN-contiguous (and so can be passed to sgemm without a copy).
+    """
+    return np.ascontiguousarray(np.swapaxes(w, 1, 2), dtype=np.float32).swapaxes(1, 2)
+
 
 def normalize_state_action_static(state_mean, state_var,
                                   action_mean, action_var, state, action):
@@ -173,3 +431,156 @@ def forward_np_static(nn_params, state, action):
     n_next_state = forward_static(stack, x) + n_state
     output = denormalize_state_static(state_mean, state_var, n_next_state)
     return output
+
+
+class RolloutWorkspace:
+    """
+    Preallocated buffers for batched rollouts, so that stepping a batch of trajectories through
+    the dynamics model does not allocate any arrays. A workspace can be reused across control steps
+    for any batch of up to 'num_traj' trajectories.
+
+    All buffers are C-contiguous with one row per trajectory, so that the transpose of any block of
+    rows is a FORTRAN-contiguous block which sgemm can read and write in place.
+    """
+
+    def __init__(self, num_traj, state_dim, action_dim, hidden_dim, output_dim=None, seed=None):
+        """
+        Parameters
+        ----------
+        num_traj : int
+            Maximum number of trajectories stepped at once.
+        state_dim : int
+        action_dim : int
+        hidden_dim : int
+            Width of the hidden layers of the dynamics model.
+        output_dim : int
+            Width of the output layer, if not state_dim (2 * state_dim for a Gaussian output).
+        seed : int, np.random.SeedSequence or np.random.Generator
+            Seed of the generator sampling next states from probabilistic models.
+        """
+        self.num_traj = num_traj
+        self.state_dim = state_dim
+        self.action_dim = action_dim
+        self.hidden_dim = hidden_dim
+        self.output_dim = state_dim if output_dim is None else output_dim
+        self.rng = np.random.default_rng(seed)
+
+        # Number of trajectory steps predicted, for measuring how much compute rollouts use
+        self.num_forward = 0
+
+        self.states = np.empty((num_traj, state_dim))
+        self.next_states = np.empty((num_traj, state_dim))
+        self.actions = np.empty((num_traj, action_dim))
+        self.alive = np.empty(num_traj, dtype=bool)
+        self.x = np.empty((num_traj, state_dim + action_dim), dtype=np.float32)
+        self.h1 = np.empty((num_traj, hidden_dim), dtype=np.float32)
+        self.h2 = np.empty((num_traj, hidden_dim), dtype=np.float32)
+        self.y = np.empty((num_traj, self.output_dim), dtype=np.float32)
+
+    def fits(self, num_traj, state_dim, action_dim, hidden_dim, output_dim=None):
+        output_dim = state_dim if output_dim is None else output_dim
+        return (num_traj <= self.num_traj and state_dim == self.state_dim and action_dim == self.action_dim and
+                hidden_dim == self.hidden_dim and output_dim == self.output_dim)
+
+    def forward_np(self, nn_params, states, actions, out, members=None):
+        """
+        Predict the next states of a batch of trajectories in place, writing them into 'out'.
+
+        Parameters
+        ----------
+        nn_params : dict
+            As returned by DynamicsModel.create_folded_nn_params() or EnsembleDynamicsModel.create_folded_nn_params(),
+            or a reduced precision export from precision.export_low_precision().
+        states : np.ndarray
+            (n, state_dim) array of states with n <= num_traj.
+        actions : np.ndarray
+            (n, action_dim) array of actions.
+        out : np.ndarray
+            (n, state_dim) array, may not be 'states'.
+        members : np.ndarray
+            For ensembles, the sorted (n,) array of the member each trajectory is stepped with.
+        """
+        stack = nn_params['stack']
+        n = states.shape[0]
+        y = self.y[:n]
+        self.num_forward += n
+
+        # The normalization is folded into the weights, so raw states and actions are the input
+        self.x[:n, :self.state_dim] = states
+        self.x[:n, self.state_dim:] = actions
+
+        # Reduced precision export, see precision.export_low_precision()
+        if 'module' in nn_params:
+            with torch.inference_mode():
+                y = nn_params['module'](torch.from_numpy(self.x[:n]).to(nn_params['dtype']))
+            np.add(states, y.float().numpy(), out=out)
+            return out
+
+        if 'num_members' not in nn_params:
+            self.mlp(stack['w1'], stack['b1'], stack['w2'], stack['b2'], stack['w3'], stack['b3'], 0, n)
+            # The folded output layer predicts next_state - state in raw units
+            np.add(states, y, out=out)
+            return out
+
+        # Each member steps its own contiguous block of trajectories
+        bounds = np.searchsorted(members, np.arange(nn_params['num_members'] + 1))
+        for m in range(nn_params['num_members']):
+            if bounds[m] < bounds[m + 1]:
+                self.mlp(stack['w1'][m], stack['b1'][m], stack['w2'][m], stack['b2'][m],
+                         stack['w3'][m], stack['b3'][m], bounds[m], bounds[m + 1])
+        np.add(states, y[:, :self.state_dim], out=out)
+
+        # Sample from the Gaussian head, whose log-variance is in normalized units
+        if nn_params['probabilistic']:
+            logvar = y[:, self.state_dim:].astype(np.float64)
+            logvar = nn_params['max_logvar'] - np.logaddexp(0, nn_params['max_logvar'] - logvar)
+            logvar = nn_params['min_logvar'] + np.logaddexp(0, logvar - nn_params['min_logvar'])
+            out += np.exp(0.5 * logvar) * nn_params['state_std'] * self.rng.standard_normal(size=out.shape)
+        return out
+
+    def mlp(self, w1, b1, w2, b2, w3, b3, lo, hi):
+        """
+        Push rows lo:hi of the input buffer through the network into the output buffer.
+        """
+        x = self.x[lo:hi]
+        h1 = self.h1[lo:hi]
+        h2 = self.h2[lo:hi]
+        y = self.y[lo:hi]
+
+        # Each layer computes h^T = W x^T + b in place, with the bias preloaded into the output
+        h1[:] = b1
+        blas.sgemm(alpha=1., a=w1, b=x.T, beta=1., c=h1.T, overwrite_c=True)
+        np.maximum(h1, 0, out=h1)
+        h2[:] = b2
+        blas.sgemm(alpha=1., a=w2, b=h1.T, beta=1., c=h2.T, overwrite_c=True)
+        np.maximum(h2, 0, out=h2)
+        y[:] = b3
+        blas.sgemm(alpha=1., a=w3, b=h2.T, beta=1., c=y.T, overwrite_c=True)
+
+
+def rollout_workspace(nn_params, num_traj, workspace=None, seed=None):
+    """
+    Return 'workspace' if it can hold 'num_traj' trajectories of the network described by 'nn_params',
+    otherwise a new RolloutWorkspace that can. A new workspace is seeded with 'seed', or keeps drawing from
+    the generator of the workspace it replaces.
+    """
+    stack = nn_params['stack']
+    hidden_dim, input_dim = stack['w1'].shape[-2:]
+    output_dim = stack['w3'].shape[-2]
+    state_dim = output_dim // 2 if nn_params.get('probabilistic', False) else output_dim
+    action_dim = input_dim - state_dim
+    if workspace is not None and workspace.fits(num_traj, state_dim, action_dim, hidden_dim, output_dim):
+        return workspace
+    if workspace is not None:
+        seed = workspace.rng
+    return RolloutWorkspace(num_traj, state_dim, action_dim, hidden_dim, output_dim, seed=seed)
+
+
+def ensemble_members(nn_params, num_traj):
+    """
+    Return the sorted (num_traj,) array assigning trajectories to ensemble members in equal contiguous
+    blocks, or None if 'nn_params' is not an ensemble.
+    """
+    if 'num_members' not in nn_params:
+        return None
+    return np.arange(num_traj) * nn_params['num_members'] // num_traj
@@ -1,9 +1,13 @@
+import copy
+import gymnasium as gym
 import numpy as np
 import torch
 import torch.nn as nn
-from src.control.dynamics import DynamicsModel
-from src.control.mpc import MPC
+from src.control.dynamics import DynamicsModel, EnsembleDynamicsModel
+from src.control.mpc import MPC, DEFAULT_COMPACT_THRESHOLD
 from src.control.replay_buffer import ReplayBuffer
+from src.control.training import DynamicsTrainer, AsyncDynamicsLearner
+from src.control.collection import VectorEnvCollector
 import os
 from datetime import datetime
 from src.constants import MODELS_PATH
@@ -26,6 +30,14 @@ class MBRLLearner:
             - action_dim : int
                 Dimension of the action space
             - env : gym.Env
+            - env_fn : function (optional)
+                Takes no arguments and returns a new copy of env, used to collect episodes in parallel (see num_envs)
+            - action_low : float or np.ndarray (optional)
+                Lower bound of each action dimension (defaults to env.action_space.low, required if the
+                action space is not a gym.spaces.Box)
+            - action_high : float or np.ndarray (optional)
+                Upper bound of each action dimension (defaults to env.action_space.high, required if the
+                action space is not a gym.spaces.Box)
 
         train_dict : dict
             A dictionary containing parameters related to training. Key-value pairs are
@@ -37,6 +49,10 @@ class MBRLLearner:
                 Reward function at each timestep
             - terminate : function
                 Termination condition at each timestep
+            - reward_batch : function (optional)
+                Batched form of reward taking (N, state_dim) and (N, action_dim) arrays
+            - terminate_batch : function (optional)
+                Batched form of terminate taking (N, state_dim) and (N, action_dim) arrays and a timestep
             - lr : float
                 Learning rate for training dynamics model
             - batch_size : int
@@ -47,15 +63,77 @@ class MBRLLearner:
                 Proportion of data in each batch that comes from MPC-chosen actions
             - epsilon : float in [0, 1]
                 Fraction of actions taken per episode that are randomly generated (Epsilon Greedy)
+            - buffer_size : int (optional)
+                Maximum number of random and of MPC transitions held in the replay buffer (defaults to 10000)
+            - contiguous_buffer : bool (optional)
+                If true, the replay buffer stores transitions in preallocated arrays (defaults to False)
+            - prefetch : int (optional)
+                Number of minibatches prepared ahead on a background thread while training (defaults to 2)
+            - seed : int (optional)
+                Seed for sampling minibatches and their noise
+            - train_steps : int (optional)
+                Number of gradient steps per dynamics update (defaults to 4)
+            - train_epochs : int (optional)
+                If given, each dynamics update instead runs up to this many epochs over the replay buffer
+            - val_prop : float (optional)
+                Fraction of transitions held out for validating the dynamics model (defaults to 0)
+            - patience : int (optional)
+                Stop a dynamics update after this many epochs without validation improvement
+            - min_delta : float (optional)
+                Minimum decrease in validation MSE counted as an improvement (defaults to 0)
+            - num_members : int (optional)
+                If given, the dynamics model is an ensemble of this many members
+            - probabilistic : bool (optional)
+                If true, ensemble members predict a Gaussian over the next state (defaults to False)
+            - num_envs : int (optional)
+                Number of episodes collected at once from copies of the environment made by env_fn (defaults to 1)
+            - async_envs : bool (optional)
+                If true, each copy of the environment is stepped in its own process (defaults to True)
+            - async_learner : bool (optional)
+                If true, the dynamics model is trained on a background thread while episodes are collected, and
+                the MPC plans with a copy of its weights refreshed at the start of every episode (defaults to False)
+            - max_staleness : int (optional)
+                With async_learner, also refresh the MPC's weights mid-episode whenever they are more than this
+                many dynamics updates behind the learner's
+            - max_updates_per_episode : int (optional)
+                With async_learner, bound the number of dynamics updates per collected episode (defaults to 1,
+                None trains continuously)
 
         mpc_dict : dict
-            A dictionary containing parameters related to the MPC controller. Key-value pairs are
+            A dictionary containing parameters related to the MPC controller. The MPC plans continuous actions
+            within env_dict['action_low'] and env_dict['action_high'], which must be given if the action space of
+            the environment is not a gym.spaces.Box (e.g. gym.spaces.Discrete). Key-value pairs are
             - num_traj : int
                 Number of trajectories to sample at each timestep
             - gamma : float in (0, 1]
                 Discount factor for computing returns (both in mbrl.py and mpc.py)
             - horizon : int
                 Number of timesteps to estimate optimal trajectories at each timestep
+            - batched : bool (optional)
+                If true, the MPC rolls out all trajectories together (defaults to False)
+            - planner : str (optional)
+                One of 'random_shooting' (default), 'cem' or 'mppi'
+            - planner_params : dict (optional)
+                Parameters of the iterative planners, see MPC
+            - noise_scale : float (optional)
+                Stdev of the noise used to sample action sequences (defaults to 1.0)
+            - num_particles : int (optional)
+                Number of particles per action sequence, spread over the ensemble members (defaults to num_members)
+            - precision : str (optional)
+                Precision of the dynamics network in MPC rollouts, see MPC (defaults to 'float32')
+            - backend : str (optional)
+                One of 'numpy' (default), 'torch', 'torch_compile' or 'numba', see MPC
+            - compact_threshold : float (optional)
+                Fraction of live trajectories at which batched rollouts drop terminated ones (defaults to 0.75)
+            - time_budget : float (optional)
+                Wall-clock seconds per control step; if given, the MPC plans in anytime mode, see MPC
+            - chunk_size : int (optional)
+                Number of trajectories evaluated at once in anytime mode (defaults to num_traj // 8)
+            - transport : str (optional)
+                One of 'ray' (default) or 'shared_memory', how rollouts are sent to the worker pool, see MPC
+            - worker_sampling : bool (optional)
+                If true, the workers sample the action sequences from counter-based RNG streams, see MPC
+                (defaults to False)
 
         misc_dict : dict
             A dictionary containing miscellaneous parameters. Key-value paris are
@@ -71,23 +149,49 @@ class MBRLLearner:
                 If true, reward from environment will be overriden by reward given in train_dict
             - override_env_terminate : bool
                 If true, termination condition from environment will be overriden by termination
-                function given in train_dict
+                function given in train_dict. Episodes collected with num_envs > 1 still end when the
+                environment terminates, since the vector env resets it on the same step.
         """
         # Environment Parameters
         self.state_dim = env_dict['state_dim']
         self.action_dim = env_dict['action_dim']
         self.env = env_dict['env']
+        if ('action_low' not in env_dict or 'action_high' not in env_dict) and \
+                not isinstance(self.env.action_space, gym.spaces.Box):
+            raise ValueError("env_dict['action_low'] and env_dict['action_high'] are required unless the action "
+                             "space is a gym.spaces.Box, got {}".format(self.env.action_space))
+        if 'action_low' in env_dict:
+            self.action_low = env_dict['action_low']
+        else:
+            self.action_low = self.env.action_space.low
+        if 'action_high' in env_dict:
+            self.action_high = env_dict['action_high']
+        else:
+            self.action_high = self.env.action_space.high
 
         # Training Parameters
         self.num_episodes = train_dict['num_episodes']
         self.episode_len = train_dict['episode_len']
         self.reward = train_dict['reward']
         self.terminate = train_dict['terminate']
+        self.reward_batch = train_dict.get('reward_batch')
+        self.terminate_batch = train_dict.get('terminate_batch')
         self.lr = train_dict['lr']
         self.batch_size = train_dict['batch_size']
         self.num_rand_eps = train_dict['num_rand_eps']
         self.rl_prop = train_dict['rl_prop']
         self.epsilon = train_dict['epsilon']
+        self.prefetch = train_dict.get('prefetch', 2)
+        self.seed_sequence = np.random.SeedSequence(train_dict.get('seed'))
+        self.num_envs = train_dict.get('num_envs', 1)
+        self.env_fn = env_dict.get('env_fn')
+        self.async_envs = train_dict.get('async_envs', True)
+        if self.num_envs > 1 and self.env_fn is None:
+            raise ValueError("Collecting episodes from several environments requires env_dict['env_fn']")
+        self.async_learner = train_dict.get('async_learner', False)
+        self.max_staleness = train_dict.get('max_staleness')
+        self.max_updates_per_episode = train_dict.get('max_updates_per_episode', 1)
+        self.learner = None
 
         # Miscellaneous Parameters
         self.print_every_n_episodes = misc_dict['print_every_n_episodes']
@@ -102,20 +206,56 @@ class MBRLLearner:
             self.save_name = now.strftime("%Y%m%d-%H%M%S")
 
         # Replay Buffer
-        self.replay_buffer = ReplayBuffer(self.state_dim, self.action_dim, normalize=self.normalize)
+        self.replay_buffer = ReplayBuffer(self.state_dim, self.action_dim,
+                                          max_size=train_dict.get('buffer_size', 10000),
+                                          normalize=self.normalize,
+                                          contiguous=train_dict.get('contiguous_buffer', False),
+                                          seed=self.seed_sequence.spawn(1)[0],
+                                          val_prop=train_dict.get('val_prop', 0))
 
         # Dynamics Model Trainings Parameters
         self.device = torch.device("cpu")  # torch.device("cuda" if torch.cuda.is_available() else "cpu")
         print(f"Using device: {self.device}")
-        self.model = DynamicsModel(self.state_dim, self.action_dim, self.normalize).to(self.device)
+        if 'num_members' in train_dict:
+            self.model = EnsembleDynamicsModel(self.state_dim, self.action_dim, self.normalize,
+                                               num_members=train_dict['num_members'],
+                                               probabilistic=train_dict.get('probabilistic', False)).to(self.device)
+        else:
+            self.model = DynamicsModel(self.state_dim, self.action_dim, self.normalize).to(self.device)
         self.loss = nn.MSELoss()
         self.optimizer = torch.optim.Adam(self.model.parameters(), lr=self.lr)
+        self.trainer = DynamicsTrainer(self.model, self.optimizer, self.loss, self.replay_buffer, self.batch_size,
+                                       train_steps=train_dict.get('train_steps', 4),
+                                       train_epochs=train_dict.get('train_epochs'),
+                                       patience=train_dict.get('patience'),
+                                       min_delta=train_dict.get('min_delta', 0.),
+                                       prefetch=self.prefetch, device=self.device)
+        self.train_stats = None
+
+        # With an asynchronous learner the MPC plans with a snapshot of the weights, see AsyncDynamicsLearner
+        self.policy_model = copy.deepcopy(self.model) if self.async_learner else self.model
+        self.policy_version = 0
 
         # MPC Parameters
         self.num_traj = mpc_dict['num_traj']
         self.gamma = mpc_dict['gamma']
         self.horizon = mpc_dict['horizon']
-        self.policy = MPC(self.model, self.num_traj, self.gamma, self.horizon, self.reward, self.terminate, True)
+        self.batched = mpc_dict.get('batched', False)
+        self.policy = MPC(self.policy_model, self.num_traj, self.gamma, self.horizon, self.reward, self.terminate, True,
+                          self.batched, self.reward_batch, self.terminate_batch,
+                          planner=mpc_dict.get('planner', 'random_shooting'),
+                          planner_params=mpc_dict.get('planner_params'),
+                          noise_scale=mpc_dict.get('noise_scale', 1.0),
+                          action_low=self.action_low, action_high=self.action_high,
+                          num_particles=mpc_dict.get('num_particles'),
+                          precision=mpc_dict.get('precision', 'float32'),
+                          backend=mpc_dict.get('backend', 'numpy'),
+                          compact_threshold=mpc_dict.get('compact_threshold', DEFAULT_COMPACT_THRESHOLD),
+                          time_budget=mpc_dict.get('time_budget'),
+                          chunk_size=mpc_dict.get('chunk_size'),
+                          transport=mpc_dict.get('transport', 'ray'),
+                          worker_sampling=mpc_dict.get('worker_sampling', False),
+                          seed=self.seed_sequence.spawn(1)[0])
 
         # Make model directory
         self.dir_path = os.path.join(MODELS_PATH, self.save_name)
@@ -136,8 +276,14 @@ class MBRLLearner:
         train_dict_copy = train_dict.copy()
 
         del env_dict_copy['env']
+        env_dict_copy.pop('env_fn', None)
+        for key in ['action_low', 'action_high']:
+            if isinstance(env_dict_copy.get(key), np.ndarray):
+                env_dict_copy[key] = env_dict_copy[key].tolist()
         del train_dict_copy['reward']
         del train_dict_copy['terminate']
+        train_dict_copy.pop('reward_batch', None)
+        train_dict_copy.pop('terminate_batch', None)
 
         f_dict = open(os.path.join(self.dir_path, self.dict_file_name), 'a')
         f_dict.write('env_dict:\n')
@@ -172,6 +318,12 @@ class MBRLLearner:
         # Print to stdout
         print("Episodes {}-{} finished | mean return: {:.2f} | return stdev: {:.2f} | mean time of termination: {:.2f}"
               .format(first_ep, last_ep,  mean_ret, stdev, mean_termination))
+        if self.train_stats is not None:
+            val_loss = self.train_stats['val_loss']
+            print("Dynamics update | steps: {} | epochs: {} | train loss: {:.4f} | val loss: {} | samples/sec: {:.0f}"
+                  .format(self.train_stats['steps'], self.train_stats['epochs'], self.train_stats['train_loss'],
+                          'n/a' if val_loss is None else '{:.4f}'.format(val_loss),
+                          self.train_stats['samples_per_sec']))
 
         # Write to train file
         f_train = open(os.path.join(self.dir_path, self.train_file_name), 'a')
@@ -182,6 +334,10 @@ class MBRLLearner:
         """
         Train the MBRL agent.
         """
+        if self.num_envs > 1 or self.async_learner:
+            self.train_vectorized()
+            return
+
         ret_list = []
         trunc_list = []
         for ep in range(self.num_episodes):
@@ -193,13 +349,14 @@ class MBRLLearner:
             ep_ret = 0
             ep_len = self.episode_len  # If episode doesn't terminate from gym, it's len will be episode_len
             self.policy.empty_past_trajectory()
+            ep_states, ep_actions, ep_next_states = [], [], []
             for t in range(self.episode_len):
 
                 # Only start MPC after num_rand_eps number of episodes where only random actions taken
                 if ep < self.num_rand_eps or np.random.uniform(low=0, high=1.0) < self.epsilon:
-                    action = np.random.uniform(low=-0.3, high=0.3, size=(8,))
+                    action = np.random.uniform(low=self.action_low, high=self.action_high, size=(self.action_dim,))
                 else:
-                    action = self.policy.random_shooting(o)
+                    action = self.policy.plan(o)
 
                 next_o, reward, terminated, truncated, _ = self.env.step(action)
 
@@ -217,33 +374,128 @@ class MBRLLearner:
                     ep_len = t
                     break
 
-                self.replay_buffer.push(o, action, next_o, ep >= self.num_rand_eps)
+                ep_states.append(o)
+                ep_actions.append(action)
+                ep_next_states.append(next_o)
                 o = next_o
             self.env.close()
 
-            # Results from training
-            ret_list.append(ep_ret)
-            trunc_list.append(ep_len)
-
-            if (ep + 1) % self.print_every_n_episodes == 0 and ep != 0:
-                self.print_and_save_results(first_ep=ep - self.print_every_n_episodes + 1,
-                                            last_ep=ep,
-                                            mean_ret=np.mean(ret_list),
-                                            stdev=np.std(ret_list),
-                                            mean_termination=np.mean(trunc_list))
-                ret_list.clear()
-                trunc_list.clear()
-
-            # Save trained dynamics model every n episodes, and do MPC eval
-            if (ep + 1) % self.save_every_n_episodes == 0 and ep != 0:
-                torch.save(self.model.state_dict(), os.path.join(self.dir_path, self.save_name + ".pt"))
-                self.eval_model(ep)  # Whenever a model is saved, run model with MPC
-                print("-- Model saved --")
+            # Push the whole episode at once
+            if len(ep_states) > 0:
+                self.replay_buffer.push_batch(np.array(ep_states), np.array(ep_actions), np.array(ep_next_states),
+                                              ep >= self.num_rand_eps)
+            self.end_episode(ep, ep_ret, ep_len, ret_list, trunc_list)
+
+        # Save when training ends
+        torch.save(self.model.state_dict(), os.path.join(self.dir_path, self.save_name + ".pt"))
+        print("-- Model saved --")
+
+    def train_vectorized(self):
+        """
+        Train the MBRL agent, collecting num_envs episodes at a time from copies of the environment made by env_fn.
+        Before each round the dynamics model gets one update per episode in the round, so that it runs as many
+        gradient steps as in train(). Random actions need no planning, so the num_rand_eps random episodes are
+        collected with no work in the parent process besides sampling; in MPC episodes the actions of all
+        environments are planned together with MPC.plan_batch().
+
+        With async_learner, the dynamics model is instead updated continuously by an AsyncDynamicsLearner.
+        """
+        env_fn = self.env_fn
+        asynchronous = self.async_envs
+        if env_fn is None:
+            env_fn = lambda: self.env
+            asynchronous = False
+        collector = VectorEnvCollector(env_fn, self.num_envs, self.episode_len, self.gamma,
+                                       reward=self.reward if self.override_env_reward else None,
+                                       terminate=self.terminate if self.override_env_terminate else None,
+                                       asynchronous=asynchronous)
+        if self.async_learner:
+            self.learner = AsyncDynamicsLearner(self.trainer, self.batch_size, before_fit=self.update_model_statistics,
+                                                max_updates_per_episode=self.max_updates_per_episode,
+                                                seed=self.seed_sequence.spawn(1)[0])
+            self.learner.start()
+        ret_list = []
+        trunc_list = []
+        try:
+            for first_ep in range(0, self.num_episodes, self.num_envs):
+                num_episodes = min(self.num_envs, self.num_episodes - first_ep)
+                if self.learner is not None:
+                    # Only use rl data after 5 rl episodes
+                    self.learner.rl_prop = self.rl_prop * (first_ep - 5 >= self.num_rand_eps)
+                    self.policy_version = self.learner.sync(self.policy_model, self.policy_version)
+                self.policy.empty_past_trajectory()
+                for ep in range(first_ep, first_ep + num_episodes):
+                    if self.learner is None and self.replay_buffer.__len__() > self.batch_size:
+                        self.update_model_statistics()
+                        self.update_dynamics(ep - 5)  # Only use rl data after 5 rl episodes
+
+                # Stream each episode into the replay buffer as soon as its environment finishes
+                def push_episode(i, states, actions, next_states, ret, ep_len):
+                    if len(states) > 0:
+                        self.replay_buffer.push_batch(states, actions, next_states,
+                                                      first_ep + i >= self.num_rand_eps)
+                    if self.learner is not None:
+                        self.learner.add_episodes()
+
+                episodes = collector.collect(self.vector_policy(first_ep), num_episodes, on_episode=push_episode)
+                if self.learner is not None:
+                    self.train_stats = self.learner.latest()[2]
+                for i, (states, actions, next_states, ep_ret, ep_len) in enumerate(episodes):
+                    self.end_episode(first_ep + i, ep_ret, ep_len, ret_list, trunc_list)
+        finally:
+            collector.close()
+            if self.learner is not None:
+                self.learner.close()
 
         # Save when training ends
+        if self.learner is not None:
+            self.policy_version = self.learner.sync(self.policy_model, self.policy_version)
+            self.learner = None
         torch.save(self.model.state_dict(), os.path.join(self.dir_path, self.save_name + ".pt"))
         print("-- Model saved --")
 
+    def vector_policy(self, first_ep):
+        """
+        Return the policy used by VectorEnvCollector.collect() for the round of episodes starting at first_ep.
+        """
+        def policy(o, t, active):
+            if self.learner is not None and self.max_staleness is not None:
+                self.policy_version = self.learner.sync(self.policy_model, self.policy_version, self.max_staleness)
+            actions = np.random.uniform(low=self.action_low, high=self.action_high, size=(o.shape[0], self.action_dim))
+
+            # Only start MPC after num_rand_eps number of episodes where only random actions taken
+            planned = [i for i in np.flatnonzero(active)
+                       if first_ep + i >= self.num_rand_eps and np.random.uniform(low=0, high=1.0) >= self.epsilon]
+            if len(planned) > 0:
+                actions[planned] = self.policy.plan_batch(o[planned], env_ids=planned)
+            return actions
+        return policy
+
+    def end_episode(self, ep, ep_ret, ep_len, ret_list, trunc_list):
+        """
+        Record the results of episode ep, printing them and saving the dynamics model every few episodes.
+        """
+        ret_list.append(ep_ret)
+        trunc_list.append(ep_len)
+
+        if (ep + 1) % self.print_every_n_episodes == 0 and ep != 0:
+            self.print_and_save_results(first_ep=ep - self.print_every_n_episodes + 1,
+                                        last_ep=ep,
+                                        mean_ret=np.mean(ret_list),
+                                        stdev=np.std(ret_list),
+                                        mean_termination=np.mean(trunc_list))
+            ret_list.clear()
+            trunc_list.clear()
+
+        # Save trained dynamics model every n episodes, and do MPC eval
+        if (ep + 1) % self.save_every_n_episodes == 0 and ep != 0:
+            # The policy's copy may be a few versions behind the learner's latest snapshot
+            if self.learner is not None:
+                self.policy_version = self.learner.sync(self.policy_model, self.policy_version)
+            torch.save(self.policy_model.state_dict(), os.path.join(self.dir_path, self.save_name + ".pt"))
+            self.eval_model(ep)  # Whenever a model is saved, run model with MPC
+            print("-- Model saved --")
+
     def update_dynamics(self, ep):
         """
         Update the dynamics model using sampled (s,a,s'-s) triplets stored in replay_buffer.
@@ -252,22 +504,15 @@ class MBRLLearner:
         ep : int
             Episode number (in training)
         """
-        for i in range(4):
-            state, action, d_state = self.replay_buffer.sample(self.batch_size, self.rl_prop * (ep >= self.num_rand_eps))
-            input = torch.from_numpy(np.concatenate((state, action), axis=1)).float().to(self.device)
-            target = torch.from_numpy(d_state).float().to(self.device)
-            self.optimizer.zero_grad()
-            output = self.model(input)
-            loss = self.loss(output, target)
-            loss.backward()
-            self.optimizer.step()
+        self.train_stats = self.trainer.fit(self.rl_prop * (ep >= self.num_rand_eps),
+                                            seed=self.seed_sequence.spawn(1)[0])
 
     def eval_model(self, ep):
         o, _ = self.env.reset()
         self.policy.empty_past_trajectory()
         ret = 0
         for t in range(self.episode_len):
-            action = self.policy.random_shooting(o)
+            action = self.policy.plan(o)
             next_o, reward, terminated, truncated, _ = self.env.step(action)
 
             # Use custom reward function
@@ -303,7 +548,7 @@ class MBRLLearner:
         o, _ = env.reset()
         ret = 0
         for t in range(episode_len):
-            action = policy.random_shooting(o)
+            action = policy.plan(o)
             next_o, reward, terminated, truncated, _ = env.step(action)
 
             # Use custom reward function
@@ -324,9 +569,11 @@ class MBRLLearner:
         print("----------------------------------------")
         print("Model Evaluation: ret = {:.2f}".format(ret))
         print("----------------------------------------")
+        return ret
 
     def update_model_statistics(self):
-        self.model.update_state_var(self.replay_buffer.get_state_var())
-        self.model.update_state_mean(self.replay_buffer.get_state_mean())
-        self.model.update_action_var(self.replay_buffer.get_action_var())
-        self.model.update_action_mean(self.replay_buffer.get_action_mean())
+        with self.replay_buffer.lock:
+            self.model.update_state_var(self.replay_buffer.get_state_var())
+            self.model.update_state_mean(self.replay_buffer.get_state_mean())
+            self.model.update_action_var(self.replay_buffer.get_action_var())
+            self.model.update_action_mean(self.replay_buffer.get_action_mean())
@@ -1,7 +1,27 @@
 import numpy as np
 import ray
-from src.control.dynamics import forward_np_static
-import itertools
+from src.control.dynamics import EnsembleDynamicsModel, ensemble_members, forward_np_static, rollout_workspace
+from src.control.precision import export_low_precision
+from src.control.rewards import vectorize_reward, vectorize_terminate
+from src.control.sampling import PopulationStream, SampledPopulation, sample_truncated_normal
+from src.control.torch_rollout import TorchRolloutKernel
+from src.control.numba_rollout import NumbaRolloutKernel, numba_available
+from src.control.shared_memory import SharedMemoryWorkerPool
+import time
+import warnings
+
+BACKENDS = ['numpy', 'torch', 'torch_compile', 'numba']
+
+TRANSPORTS = ['ray', 'shared_memory']
+
+DEFAULT_COMPACT_THRESHOLD = 0.75
+
+DEFAULT_PLANNER_PARAMS = {'num_iters': 5,
+                          'num_elites': 64,
+                          'alpha': 0.1,
+                          'temperature': 1.0,
+                          'shift': True,
+                          'num_carry': 0}
 
 
 class MPC:
@@ -9,7 +29,11 @@ class MPC:
     A class implementation of a predictive sampling MPC.
     """
 
-    def __init__(self, model, num_traj, gamma, horizon, reward, terminate=None, multithreading=True):
+    def __init__(self, model, num_traj, gamma, horizon, reward, terminate=None, multithreading=True, batched=False,
+                 reward_batch=None, terminate_batch=None, num_workers=None, planner='random_shooting',
+                 planner_params=None, noise_scale=1.0, action_low=None, action_high=None, num_particles=None,
+                 precision='float32', backend='numpy', compact_threshold=DEFAULT_COMPACT_THRESHOLD,
+                 time_budget=None, chunk_size=None, transport='ray', worker_sampling=False, seed=None):
         """
         Parameters
         ----------
@@ -25,16 +49,217 @@ class MPC:
         terminate : function
              For a given (s, a, t) tuple returns true if episode has ended.
         multithreading: bool
+            If true, rollouts are split across a pool of persistent worker processes, see 'transport'.
+        batched: bool
+            If true, all trajectories are rolled out together one timestep at a time, so that each
+            timestep is a single matrix-matrix forward pass through the dynamics model.
+        reward_batch : function
+            Batched form of 'reward' taking (N, state_dim) and (N, action_dim) arrays and returning
+            an (N,) array. If None, 'reward' is wrapped and called once per trajectory.
+        terminate_batch : function
+            Batched form of 'terminate' taking (N, state_dim) and (N, action_dim) arrays and a
+            timestep, and returning an (N,) boolean done-mask. If None, 'terminate' is wrapped.
+        num_workers : int
+            Number of workers used when multithreading. Defaults to the number of CPUs in the Ray cluster
+            (or of the machine with the 'shared_memory' transport).
+        planner : str
+            Planner used by plan(); one of 'random_shooting', 'cem' or 'mppi'.
+        planner_params : dict
+            Parameters of the iterative planners. Missing keys are taken from DEFAULT_PLANNER_PARAMS.
+            - num_iters : int
+                Number of sampling iterations per control step (cem and mppi)
+            - num_elites : int
+                Number of best sequences the sampling distribution is refit to (cem)
+            - alpha : float in [0, 1)
+                Weight of the previous mean/stdev when refitting (cem)
+            - temperature : float
+                Temperature of the exponential weighting of returns (mppi)
+            - shift : bool
+                If true, the plan of each control step is shifted forward by one timestep (with the initial
+                action appended) before warm-starting the next step (all planners)
+            - num_carry : int
+                Number of best sequences of each control step carried (shifted) into the first population
+                of the next step (all planners)
+        noise_scale : float
+            Stdev of the Gaussian noise added to the mean action sequence when sampling (the initial
+            stdev for cem). Either a float or an array of shape (action_dim,).
+        action_low : float or np.ndarray
+            Lower bound of each action dimension. Defaults to no bound.
+        action_high : float or np.ndarray
+            Upper bound of each action dimension. Defaults to no bound.
+        num_particles : int
+            Number of particles each action sequence is rolled out with, spread evenly over the members
+            of an ensemble model; its return is the particles' mean return. Defaults to the number of
+            ensemble members (1 for a single model). Requires batched.
+        precision : str
+            Precision of the dynamics network in batched rollouts; one of 'float32', 'bfloat16', 'float16'
+            or 'int8' (see precision.export_low_precision()).
+        backend : str
+            How batched rollouts are computed, both locally and on the worker pool. 'numpy' steps all
+            trajectories with in-place sgemm calls; 'torch' runs the whole horizon loop in one torch function
+            and 'torch_compile' compiles that function with torch.compile (see torch_rollout.TorchRolloutKernel).
+            The torch backends require 'reward_batch' and 'terminate_batch' to work on torch tensors.
+            'numba' JIT compiles the rollout of each trajectory, together with the scalar 'reward' and
+            'terminate', and runs trajectories in parallel (see numba_rollout.NumbaRolloutKernel). Falls
+            back to 'numpy' with a warning if numba is not installed.
+        compact_threshold : float in [0, 1]
+            In batched rollouts, terminated trajectories are dropped from the batch once the fraction still
+            alive drops to this threshold (0 never compacts, 1 compacts at every termination).
+        time_budget : float
+            If given, plan() runs in anytime mode: trajectories are evaluated in chunks of 'chunk_size' and
+            no new chunk (or planner iteration) is started once 'time_budget' seconds have passed, so the
+            action is the best one found by the deadline. At least one chunk is always evaluated.
+        chunk_size : int
+            Number of trajectories evaluated at once in anytime mode. Defaults to num_traj // 8.
+        transport : str
+            How the worker pool is run when multithreading. 'ray' uses Ray actors, which are sent the pickled
+            action sequences at every control step. 'shared_memory' uses local processes which read the
+            action sequences and weights in place from shared memory and write their returns into a shared
+            array, so that only the bounds of each worker's slice are sent (see
+            shared_memory.SharedMemoryWorkerPool).
+        worker_sampling : bool
+            If true, populations are described by their mean trajectories and counter-based RNG keys (see
+            sampling.PopulationStream) instead of being sampled by the planner: with multithreading every worker
+            samples its own slice of action sequences, so that a control step only sends O(horizon * action_dim)
+            values, and the planner only rebuilds the sequences it needs (e.g. the best one). The populations
+            only depend on 'seed', not on the number of workers.
+        seed : int or np.random.SeedSequence
+            Seed of the populations sampled with worker_sampling, and of the next states sampled from
+            probabilistic models. Each worker of the pool gets a stream of its own, so rollouts are reproducible
+            for a given number of workers.
         """
         self.model = model
+        self.action_dim = model.action_dim
         self.num_traj = num_traj
         self.gamma = gamma
         self.horizon = horizon
         self.reward = reward
         self.terminate = terminate
+        self.reward_batch = vectorize_reward(reward, reward_batch)
+        self.terminate_batch = vectorize_terminate(terminate, terminate_batch)
         self.past_actions = []
         self.multithreading = multithreading
+        self.batched = batched
+        self.num_workers = num_workers
+        self.pool = None
+        self.planner = planner
+        self.planner_params = dict(DEFAULT_PLANNER_PARAMS, **(planner_params or {}))
+        self.noise_scale = noise_scale
+        self.action_low = np.broadcast_to(-np.inf if action_low is None else action_low, (self.action_dim,))
+        self.action_high = np.broadcast_to(np.inf if action_high is None else action_high, (self.action_dim,))
+        self.num_rollouts = 0
+        self.workspace = None
+        self.nn_params = None
+        self.nn_params_version = None
         self.past_trajectory = None
+        self.carried_seqs = None
+        self.batch_warm_starts = {}
+        self.num_particles = getattr(model, 'num_members', 1) if num_particles is None else num_particles
+        self.precision = precision
+        if isinstance(model, EnsembleDynamicsModel) and multithreading and not batched:
+            raise ValueError("Rollouts of ensemble models on worker pools require batched=True")
+        if self.num_particles > 1 and not batched:
+            raise ValueError("Rolling out several particles per action sequence requires batched=True")
+        if precision != 'float32' and not batched:
+            raise ValueError("Reduced precision rollouts require batched=True")
+        if backend not in BACKENDS:
+            raise ValueError("Unknown backend: {}".format(backend))
+        if backend == 'numba' and not numba_available():
+            warnings.warn("numba is not installed, using the numpy rollout backend")
+            backend = 'numpy'
+        if backend in ['torch', 'torch_compile'] and not batched:
+            raise ValueError("The torch rollout backends require batched=True")
+        if backend == 'numba' and reward is None:
+            raise ValueError("The numba rollout backend requires the scalar reward function")
+        if backend != 'numpy' and (precision != 'float32' or isinstance(model, EnsembleDynamicsModel)):
+            raise ValueError("The torch and numba rollout backends only support float32 single models")
+        if transport not in TRANSPORTS:
+            raise ValueError("Unknown transport: {}".format(transport))
+        self.transport = transport
+        self.worker_sampling = worker_sampling
+        seed_sequence = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+        self.seed = seed_sequence.generate_state(1, np.uint64)[0]
+        self.seed_sequence = seed_sequence
+        self.workspace_seed = seed_sequence.spawn(1)[0]
+        self.num_populations = 0
+        self.backend = backend
+        self.kernel = None
+        self.compact_threshold = compact_threshold
+        self.time_budget = time_budget
+        self.chunk_size = max(num_traj // 8, 1) if chunk_size is None else chunk_size
+        self.deadline = None
+        self.last_stats = None
+
+    def plan(self, state0):
+        """
+        Return the first action of the optimal sequence of actions found by the configured planner.
+
+        Statistics of the call are stored in last_stats: the number of trajectories rolled out,
+        the number of planner iterations, the wall-clock time, and whether the time budget cut
+        planning short.
+        """
+        if self.planner not in ['random_shooting', 'cem', 'mppi']:
+            raise ValueError("Unknown planner: {}".format(self.planner))
+
+        start_time = time.perf_counter()
+        if self.time_budget is not None:
+            self.deadline = start_time + self.time_budget
+        num_rollouts = self.num_rollouts
+        self.last_stats = {'rollouts': 0, 'iterations': 0, 'time': 0., 'deadline_hit': False}
+
+        if self.planner == 'random_shooting':
+            action = self.random_shooting(state0)
+        elif self.planner == 'cem':
+            action = self.cem(state0)
+        else:
+            action = self.mppi(state0)
+
+        self.last_stats['rollouts'] = self.num_rollouts - num_rollouts
+        self.last_stats['time'] = time.perf_counter() - start_time
+        self.deadline = None
+        return action
+
+    def plan_batch(self, states0, env_ids=None):
+        """
+        Plan for several environments at once with the configured planner. Each environment keeps its own
+        warm start between calls, and the populations of all environments are rolled out together, so every
+        planner iteration is a single evaluation of (num_envs * num_traj) trajectories. In anytime mode the
+        time budget only cuts the number of iterations (cem and mppi), never a population short.
+
+        Parameters
+        ----------
+        states0 : np.ndarray
+            (num_envs, state_dim) array of current states
+        env_ids : list of hashable
+            Identifies the environment of each row of states0, so that calls may plan for different subsets of
+            environments. Defaults to range(num_envs). The warm starts are cleared by empty_past_trajectory().
+
+        Return
+        ------
+        np.ndarray: (num_envs, action_dim) array of actions
+        """
+        if self.planner not in ['random_shooting', 'cem', 'mppi']:
+            raise ValueError("Unknown planner: {}".format(self.planner))
+        states0 = np.asarray(states0)
+        env_ids = list(range(states0.shape[0])) if env_ids is None else list(env_ids)
+
+        start_time = time.perf_counter()
+        if self.time_budget is not None:
+            self.deadline = start_time + self.time_budget
+        num_rollouts = self.num_rollouts
+        self.last_stats = {'rollouts': 0, 'iterations': 0, 'time': 0., 'deadline_hit': False}
+
+        warm_starts = [self.batch_warm_starts.get(env_id) for env_id in env_ids]
+        if self.planner == 'random_shooting':
+            actions, warm_starts = self.random_shooting_batch(states0, warm_starts)
+        else:
+            actions, warm_starts = self.iterative_planner_batch(states0, warm_starts)
+        self.batch_warm_starts.update(zip(env_ids, warm_starts))
+
+        self.last_stats['rollouts'] = self.num_rollouts - num_rollouts
+        self.last_stats['time'] = time.perf_counter() - start_time
+        self.deadline = None
+        return actions
 
     def random_shooting(self, state0):
         """
@@ -48,51 +273,417 @@ class MPC:
         """
         # Sample actions
         if self.past_trajectory is None:
-            self.past_trajectory = np.zeros(shape=(self.num_traj, self.horizon, 8))
-            return self.past_trajectory[0, 0, :]
+            self.past_trajectory = self.initial_mean()
+            return self.past_trajectory[0, :]
         else:
-            action_seqs = self.past_trajectory + np.random.normal(loc=0, scale=1.0,
-                                                                  size=(self.num_traj, self.horizon, 8))
-            action_seqs = np.clip(action_seqs, -0.3, 0.3)
+            action_seqs = self.sample_population(self.past_trajectory, self.noise_scale)
 
         # Evaluate action sequences
-        if not self.multithreading:
-            rets = np.zeros(self.num_traj)
-            for seq in range(self.num_traj):
-                rets[seq] = self.do_rollout(state0, action_seqs[seq, :, :])
-
-        else:
-            nn_params_ref = ray.put(self.model.create_nn_params())
-            mpc_params_ref = ray.put({'gamma': self.gamma, 'horizon': self.horizon})
-            action_seqs_ref = ray.put(action_seqs)
-            reward_ref = ray.put(self.reward)
-            terminate_ref = ray.put(self.terminate)
-            state0_ref = ray.put(state0)
-
-            rets_ref = []
-            seqs = list(range(self.num_traj))
-            batch_size = int(self.num_traj / 16)
-            for i in range(0, self.num_traj, batch_size):
-                batch = seqs[i:i+batch_size]
-                rets_ref.append(do_batch_rollout_static.remote(nn_params_ref, mpc_params_ref, reward_ref,
-                                                               terminate_ref, state0_ref, action_seqs_ref, batch))
-            # rets = ray.get(rets_ref)
-            rets = list(itertools.chain(*ray.get(rets_ref)))
-
-            del rets_ref
-            del nn_params_ref
-            del mpc_params_ref
-            del action_seqs_ref
-            del reward_ref
-            del terminate_ref
-            del state0_ref
+        action_seqs, rets = self.evaluate_within_budget(state0, action_seqs)
 
         # Return first action of optimal sequence
         opt_seq_idx = np.argmax(rets)
-        self.past_trajectory = action_seqs[opt_seq_idx, :, :]
         opt_action = action_seqs[opt_seq_idx, 0, :]
+        self.warm_start(action_seqs[opt_seq_idx, :, :], action_seqs, rets)
+        return opt_action
+
+    def cem(self, state0):
+        """
+        Cross-Entropy Method. A Gaussian over action sequences is repeatedly refit to the
+        'num_elites' best sampled sequences.
+
+        Parameters
+        ----------
+        state0: np.array
+
+        Return
+        ------
+        np.array: The first action of the mean of the final sampling distribution.
+        """
+        num_elites = min(self.planner_params['num_elites'], self.num_traj)
+        alpha = self.planner_params['alpha']
+
+        mean = self.initial_mean()
+        std = self.noise_scale * np.ones_like(mean)
+        for i in range(self.planner_params['num_iters']):
+            if i > 0 and self.deadline_passed():
+                break
+            action_seqs = self.sample_population(mean, std)
+            action_seqs, rets = self.evaluate_within_budget(state0, action_seqs)
+
+            elites = action_seqs[np.argsort(rets)[-min(num_elites, len(rets)):]]
+            mean = alpha * mean + (1 - alpha) * np.mean(elites, axis=0)
+            std = alpha * std + (1 - alpha) * np.std(elites, axis=0)
+
+        opt_action = mean[0, :]
+        self.warm_start(mean, action_seqs, rets)
         return opt_action
 
+    def mppi(self, state0):
+        """
+        Model Predictive Path Integral control. The mean action sequence is repeatedly replaced
+        by the average of the sampled sequences weighted by their exponentiated returns.
+
+        Parameters
+        ----------
+        state0: np.array
+
+        Return
+        ------
+        np.array: The first action of the final mean action sequence.
+        """
+        temperature = self.planner_params['temperature']
+
+        mean = self.initial_mean()
+        for i in range(self.planner_params['num_iters']):
+            if i > 0 and self.deadline_passed():
+                break
+            action_seqs = self.sample_population(mean, self.noise_scale)
+            action_seqs, rets = self.evaluate_within_budget(state0, action_seqs)
+
+            weights = np.exp((rets - np.max(rets)) / temperature)
+            weights = weights / np.sum(weights)
+            mean = np.tensordot(weights, action_seqs, axes=1)
+
+        opt_action = mean[0, :]
+        self.warm_start(mean, action_seqs, rets)
+        return opt_action
+
+    def random_shooting_batch(self, states0, warm_starts):
+        """
+        Random shooting for a batch of environments, see plan_batch(). As in random_shooting(), environments
+        without a warm start take the first action of the initial mean without planning.
+
+        Parameters
+        ----------
+        states0 : np.ndarray
+            (num_envs, state_dim) array of current states
+        warm_starts : list
+            (past_trajectory, carried_seqs) tuple of each environment, or None
+
+        Return
+        ------
+        tuple: ((num_envs, action_dim) array of actions, list of the environments' new warm starts)
+        """
+        warm_starts = list(warm_starts)
+        actions = np.empty((states0.shape[0], self.action_dim))
+        rows = [b for b, warm_start in enumerate(warm_starts) if warm_start is not None]
+        for b, warm_start in enumerate(warm_starts):
+            if warm_start is None:
+                warm_starts[b] = (self.zero_mean(), None)
+                actions[b] = warm_starts[b][0][0, :]
+        if len(rows) == 0:
+            return actions, warm_starts
+
+        means = np.stack([warm_starts[b][0] for b in rows])
+        action_seqs = self.sample_population_batch(means, self.noise_scale, [warm_starts[b][1] for b in rows])
+        rets = self.evaluate_batch(states0[rows], action_seqs)
+        for r, b in enumerate(rows):
+            opt_seq_idx = np.argmax(rets[r])
+            actions[b] = action_seqs[r, opt_seq_idx, 0, :]
+            warm_starts[b] = self.next_warm_start(action_seqs[r, opt_seq_idx], action_seqs[r], rets[r])
+        return actions, warm_starts
+
+    def iterative_planner_batch(self, states0, warm_starts):
+        """
+        cem or mppi for a batch of environments, see plan_batch(), random_shooting_batch(), cem() and mppi().
+        """
+        num_envs = states0.shape[0]
+        means = np.stack([self.zero_mean() if warm_start is None else warm_start[0] for warm_start in warm_starts])
+        stds = self.noise_scale * np.ones_like(means)
+        carried_seqs = [None if warm_start is None else warm_start[1] for warm_start in warm_starts]
+        num_elites = min(self.planner_params['num_elites'], self.num_traj)
+        alpha = self.planner_params['alpha']
+        temperature = self.planner_params['temperature']
+        for i in range(self.planner_params['num_iters']):
+            if i > 0 and self.deadline_passed():
+                break
+            if self.planner == 'cem':
+                action_seqs = self.sample_population_batch(means, stds, carried_seqs)
+            else:
+                action_seqs = self.sample_population_batch(means, self.noise_scale, carried_seqs)
+            carried_seqs = [None] * num_envs
+            rets = self.evaluate_batch(states0, action_seqs)
+
+            if self.planner == 'cem':
+                elite_idx = np.argsort(rets, axis=1)[:, -num_elites:]
+                elites = action_seqs[np.arange(num_envs)[:, np.newaxis], elite_idx]
+                means = alpha * means + (1 - alpha) * np.mean(elites, axis=1)
+                stds = alpha * stds + (1 - alpha) * np.std(elites, axis=1)
+            else:
+                weights = np.exp((rets - np.max(rets, axis=1, keepdims=True)) / temperature)
+                weights = weights / np.sum(weights, axis=1, keepdims=True)
+                means = np.einsum('bn,bnha->bha', weights, action_seqs)
+
+        warm_starts = [self.next_warm_start(means[b], action_seqs[b], rets[b]) for b in range(num_envs)]
+        return means[:, 0, :], warm_starts
+
+    def initial_mean(self):
+        """
+        Return the (horizon, action_dim) mean action sequence to start sampling around.
+        """
+        if self.past_trajectory is None:
+            return self.zero_mean()
+        return self.past_trajectory
+
+    def zero_mean(self):
+        """
+        Return the (horizon, action_dim) sequence of zero actions, clipped to the action bounds.
+        """
+        return np.clip(np.zeros(shape=(self.horizon, self.action_dim)), self.action_low, self.action_high)
+
+    def evaluate_within_budget(self, state0, action_seqs):
+        """
+        Evaluate 'action_seqs', in anytime mode only the chunks started before the deadline.
+
+        Return
+        ------
+        tuple: (the evaluated prefix of action_seqs, its (n,) array of returns)
+        """
+        self.last_stats['iterations'] += 1
+        if self.deadline is None:
+            return action_seqs, self.evaluate(state0, action_seqs)
+
+        rets = []
+        for start in range(0, action_seqs.shape[0], self.chunk_size):
+            if start > 0 and self.deadline_passed():
+                break
+            rets.append(self.evaluate(state0, action_seqs[start:start + self.chunk_size]))
+        rets = np.concatenate(rets)
+        return action_seqs[:len(rets)], rets
+
+    def deadline_passed(self):
+        if self.deadline is None or time.perf_counter() < self.deadline:
+            return False
+        self.last_stats['deadline_hit'] = True
+        return True
+
+    def warm_start(self, plan, action_seqs, rets):
+        """
+        Keep the plan of this control step, and the 'num_carry' best sequences of its last population,
+        to warm-start the next control step. Unless disabled by planner_params['shift'], they are shifted
+        forward by one timestep (receding horizon) with the initial action appended.
+
+        Parameters
+        ----------
+        plan : np.ndarray
+            (horizon, action_dim) action sequence whose first action is executed
+        action_seqs : np.ndarray
+            (num_traj, horizon, action_dim) last evaluated population
+        rets : np.ndarray
+            (num_traj,) returns of 'action_seqs'
+        """
+        self.past_trajectory, self.carried_seqs = self.next_warm_start(plan, action_seqs, rets)
+
+    def next_warm_start(self, plan, action_seqs, rets):
+        """
+        Return the (past_trajectory, carried_seqs) warm start kept by warm_start(), carried_seqs being None
+        if planner_params['num_carry'] is 0.
+        """
+        num_carry = min(self.planner_params['num_carry'], action_seqs.shape[0])
+        carried_seqs = action_seqs[np.argsort(rets)[action_seqs.shape[0] - num_carry:]]
+        if self.planner_params['shift']:
+            tail = np.clip(np.zeros(self.action_dim), self.action_low, self.action_high)
+            plan = np.concatenate((plan[1:], tail[np.newaxis, :]), axis=0)
+            tails = np.broadcast_to(tail, (num_carry, 1, self.action_dim))
+            carried_seqs = np.concatenate((carried_seqs[:, 1:], tails), axis=1)
+        return np.array(plan), carried_seqs if num_carry > 0 else None
+
+    def sample_population(self, mean, std):
+        """
+        Sample action sequences around 'mean', replacing the first ones with the sequences carried over from
+        the previous control step (if any, and only for the first population of a control step). They come
+        first so that they are evaluated even if the time budget cuts the evaluation short.
+
+        Return
+        ------
+        np.ndarray or SampledPopulation: (num_traj, horizon, action_dim) array of action sequences
+        """
+        if self.worker_sampling:
+            action_seqs = self.sampled_population(mean[np.newaxis], np.asarray(std)[np.newaxis], [self.carried_seqs])
+            self.carried_seqs = None
+            return action_seqs[0]
+        action_seqs = self.sample_action_seqs(mean, std)
+        if self.carried_seqs is not None:
+            num_carry = min(self.carried_seqs.shape[0], self.num_traj)
+            action_seqs[:num_carry] = self.carried_seqs[-num_carry:]
+            self.carried_seqs = None
+        return action_seqs
+
+    def sample_population_batch(self, means, stds, carried_seqs):
+        """
+        Sample a population of action sequences for each environment of a batch, see sample_population().
+
+        Parameters
+        ----------
+        means : np.ndarray
+            (num_envs, horizon, action_dim) array of mean action sequences
+        stds : float or np.ndarray
+            Stdev of the noise, either as noise_scale or as a (num_envs, horizon, action_dim) array
+        carried_seqs : list
+            Sequences carried over from the previous control step of each environment, or None
+
+        Return
+        ------
+        np.ndarray or SampledPopulation: (num_envs, num_traj, horizon, action_dim) array of action sequences
+        """
+        if self.worker_sampling:
+            return self.sampled_population(means, stds, carried_seqs)
+        num_envs = means.shape[0]
+        if np.ndim(stds) == 3:
+            stds = stds[:, np.newaxis]
+        action_seqs = sample_truncated_normal(means[:, np.newaxis], stds, self.action_low, self.action_high,
+                                              (num_envs, self.num_traj, self.horizon, self.action_dim))
+        for b in range(num_envs):
+            if carried_seqs[b] is not None:
+                num_carry = min(carried_seqs[b].shape[0], self.num_traj)
+                action_seqs[b, :num_carry] = carried_seqs[b][-num_carry:]
+        return action_seqs
+
+    def sampled_population(self, means, stds, carried_seqs):
+        """
+        Return the population of a batch of environments as a SampledPopulation, whose action sequences are
+        only generated when they are indexed or rolled out. Each environment's population is keyed on the seed
+        and a counter of the populations sampled so far.
+
+        Return
+        ------
+        SampledPopulation: (num_envs, num_traj, horizon, action_dim) view of the population
+        """
+        num_envs = means.shape[0]
+        keys = np.stack((np.full(num_envs, self.seed, dtype=np.uint64),
+                         np.arange(self.num_populations, self.num_populations + num_envs, dtype=np.uint64)), axis=1)
+        self.num_populations += num_envs
+        stream = PopulationStream(means, stds, self.action_low, self.action_high, keys, self.num_traj, carried_seqs)
+        return SampledPopulation(stream, np.arange(num_envs * self.num_traj).reshape(num_envs, self.num_traj))
+
+    def sample_action_seqs(self, mean, std):
+        """
+        Sample 'num_traj' action sequences from a Gaussian with the given mean and stdev,
+        truncated to the action bounds.
+
+        Return
+        ------
+        np.ndarray: (num_traj, horizon, action_dim) array of action sequences
+        """
+        return sample_truncated_normal(mean, std, self.action_low, self.action_high,
+                                       (self.num_traj, self.horizon, self.action_dim))
+
+    def evaluate(self, state0, action_seqs):
+        """
+        Compute the return of every action sequence starting from 'state0'.
+
+        Parameters
+        ----------
+        state0: np.ndarray
+            (state_dim,) start state of every action sequence, or (num_traj, state_dim) array with the start
+            state of each one
+        action_seqs: np.ndarray or SampledPopulation
+            (num_traj, horizon, action_dim) array of action sequences
+
+        Return
+        ------
+        np.ndarray: (num_traj,) array of returns
+        """
+        if isinstance(action_seqs, SampledPopulation):
+            return self.evaluate_population(state0, action_seqs)
+        self.num_rollouts += action_seqs.shape[0]
+        if not self.multithreading and self.backend != 'numpy':
+            return self.rollout_kernel()(state0, action_seqs)
+
+        elif not self.multithreading and self.batched:
+            nn_params = self.current_nn_params()
+            self.workspace = rollout_workspace(nn_params, action_seqs.shape[0] * self.num_particles, self.workspace,
+                                               seed=self.workspace_seed)
+            mpc_params = {'gamma': self.gamma, 'horizon': self.horizon, 'num_particles': self.num_particles,
+                          'compact_threshold': self.compact_threshold}
+            return do_vectorized_rollout_static(nn_params, mpc_params, self.reward_batch, self.terminate_batch,
+                                                state0, action_seqs, self.workspace)
+
+        elif not self.multithreading:
+            rets = np.zeros(action_seqs.shape[0])
+            for seq in range(action_seqs.shape[0]):
+                rets[seq] = self.do_rollout(state0[seq] if np.ndim(state0) == 2 else state0, action_seqs[seq, :, :])
+            return rets
+
+        return self.rollout_pool().rollout(state0, action_seqs)
+
+    def evaluate_batch(self, states0, action_seqs):
+        """
+        Compute the returns of the populations of a batch of environments with a single call to evaluate().
+
+        Parameters
+        ----------
+        states0 : np.ndarray
+            (num_envs, state_dim) array of start states
+        action_seqs : np.ndarray
+            (num_envs, num_traj, horizon, action_dim) array of action sequences
+
+        Return
+        ------
+        np.ndarray: (num_envs, num_traj) array of returns
+        """
+        self.last_stats['iterations'] += 1
+        if isinstance(action_seqs, SampledPopulation):
+            return self.evaluate_population(states0, action_seqs)
+        num_envs, num_traj = action_seqs.shape[:2]
+        rets = self.evaluate(np.repeat(states0, num_traj, axis=0),
+                             action_seqs.reshape((num_envs * num_traj,) + action_seqs.shape[2:]))
+        return rets.reshape(num_envs, num_traj)
+
+    def evaluate_population(self, states0, population):
+        """
+        Compute the returns of the action sequences of a SampledPopulation. With multithreading the workers
+        sample the action sequences themselves, so only the population's description is sent to them.
+
+        Parameters
+        ----------
+        states0 : np.ndarray
+            (state_dim,) start state of every action sequence, or (num_envs, state_dim) array with the start
+            state of each environment of the population
+        population : SampledPopulation
+
+        Return
+        ------
+        np.ndarray: array of returns with the shape of the population's leading dimensions
+        """
+        bounds = population.contiguous_range()
+        if not self.multithreading or bounds is None:
+            rows = population.rows.ravel()
+            if np.ndim(states0) == 2:
+                states0 = states0[population.stream.env_index(rows)]
+            action_seqs = population.stream.rows(rows)
+            return self.evaluate(states0, action_seqs).reshape(population.rows.shape)
+        self.num_rollouts += population.rows.size
+        rets = self.rollout_pool().rollout_population(states0, population.stream, *bounds)
+        return rets.reshape(population.rows.shape)
+
+    def current_nn_params(self):
+        """
+        Return the model's folded nn_params (at the configured precision), only exporting them again when
+        the model's version changes.
+        """
+        if self.nn_params_version != self.model.version:
+            self.nn_params = export_low_precision(self.model, self.precision)
+            self.nn_params_version = self.model.version
+        return self.nn_params
+
+    def rollout_kernel(self):
+        """
+        Return the torch or numba rollout kernel, creating it on first use, with the current dynamics
+        weights loaded.
+        """
+        if self.kernel is None:
+            mpc_params = {'gamma': self.gamma, 'horizon': self.horizon, 'backend': self.backend}
+            if self.backend == 'numba':
+                self.kernel = make_rollout_kernel(mpc_params, self.reward, self.terminate)
+            else:
+                self.kernel = make_rollout_kernel(mpc_params, self.reward_batch, self.terminate_batch)
+        nn_params = self.current_nn_params()
+        if self.kernel.nn_params is not nn_params:
+            self.kernel.set_nn_params(nn_params)
+        return self.kernel
+
     def do_rollout(self, state0, action_seq):
         """
         Parameters
@@ -117,8 +708,36 @@ class MPC:
 
         return ret
 
+    def rollout_pool(self):
+        """
+        Return the pool of rollout workers, creating it on first use, with the current
+        dynamics weights loaded.
+        """
+        if self.pool is None:
+            num_workers = self.num_workers
+            if num_workers is None and self.transport == 'ray':
+                num_workers = int(ray.cluster_resources().get('CPU', 1))
+            pool_class = RolloutWorkerPool if self.transport == 'ray' else SharedMemoryWorkerPool
+            mpc_params = {'gamma': self.gamma, 'horizon': self.horizon, 'batched': self.batched,
+                          'num_particles': self.num_particles, 'precision': self.precision,
+                          'backend': self.backend, 'compact_threshold': self.compact_threshold,
+                          'seed': self.seed_sequence.spawn(1)[0]}
+            if self.batched and self.backend != 'numba':
+                self.pool = pool_class(num_workers, mpc_params, self.reward_batch, self.terminate_batch)
+            else:
+                self.pool = pool_class(num_workers, mpc_params, self.reward, self.terminate)
+        self.pool.sync(self.model)
+        return self.pool
+
+    def shutdown_pool(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
     def empty_past_trajectory(self):
         self.past_trajectory = None
+        self.carried_seqs = None
+        self.batch_warm_starts = {}
 
 
 def do_rollout_static(nn_params, mpc_params, reward, terminate, state0, action_seq, seq_num):
@@ -140,25 +759,269 @@ def do_rollout_static(nn_params, mpc_params, reward, terminate, state0, action_s
     ret = 0
     for t in range(horizon):
         ret += (gamma ** t) * reward(state, action_seq[seq_num, t, :])
-        if terminate is not None and terminate(state, action_seq[t, :], t):
+        if terminate is not None and terminate(state, action_seq[seq_num, t, :], t):
             break
         next_state = forward_np_static(nn_params, state, action_seq[seq_num, t, :])
         state = next_state
     return ret
 
 
-@ray.remote
-def do_batch_rollout_static(nn_params, mpc_params, reward, terminate, state0, action_seq, batch_seq_num):
+def do_vectorized_rollout_static(nn_params, mpc_params, reward_batch, terminate_batch, state0, action_seqs,
+                                 workspace=None):
     """
+    Roll out all action sequences together, one timestep at a time. Trajectories which
+    terminate stop accumulating reward, and once the fraction of the batch still alive drops to
+    mpc_params['compact_threshold'] (default DEFAULT_COMPACT_THRESHOLD) the survivors are moved to
+    the front of the workspace so that terminated trajectories stop being stepped.
+
+    With mpc_params['num_particles'] = P, every action sequence is rolled out P times and its return
+    is the mean over its particles. For ensembles, trajectories (particles) are assigned to members
+    in equal contiguous blocks, each member stepping its block with one sgemm per layer.
+
     Parameters
     ----------
     nn_params : dict
+        As returned by DynamicsModel.create_folded_nn_params()
     mpc_params : dict
-    reward : function
-    terminate : function
+    reward_batch : function
+        Batched reward, see rewards.BatchReward.
+    terminate_batch : function
+        Batched termination condition, see rewards.BatchTerminate.
     state0 : np.ndarray
-    action_seq : np.ndarray
-    batch_seq_num : list of int
+        (state_dim,) start state, or (num_traj, state_dim) array with the start state of each action sequence
+    action_seqs : np.ndarray
+        (num_traj, horizon, action_dim) array of action sequences
+    workspace : dynamics.RolloutWorkspace
+        Buffers to step the trajectories in. A new workspace is allocated if None or too small.
+
+    Return
+    ------
+    np.ndarray: (num_traj,) array of rollout returns
+    """
+    horizon = mpc_params['horizon']
+    gamma = mpc_params['gamma']
+    num_particles = mpc_params.get('num_particles', 1)
+    compact_threshold = mpc_params.get('compact_threshold', DEFAULT_COMPACT_THRESHOLD)
+    num_seqs = action_seqs.shape[0]
+    num_traj = num_seqs * num_particles
+    workspace = rollout_workspace(nn_params, num_traj, workspace, seed=mpc_params.get('seed'))
+    members = ensemble_members(nn_params, num_traj)
+
+    # Only the first n rows of the buffers are stepped. Until the first compaction row i is trajectory i,
+    # afterwards row i is trajectory rows[i].
+    n = num_traj
+    rows = None
+    states = workspace.states
+    next_states = workspace.next_states
+    alive = workspace.alive
+    particle_actions = workspace.actions[:num_traj].reshape(num_particles, num_seqs, -1)
+    states[:n].reshape(num_particles, num_seqs, -1)[:] = state0
+    alive[:n] = True
+    rets = np.zeros(num_traj)
+    for t in range(horizon):
+        if rows is not None:
+            np.take(action_seqs[:, t, :], rows % num_seqs, axis=0, out=workspace.actions[:n])
+            actions = workspace.actions[:n]
+        elif num_particles > 1:
+            particle_actions[:] = action_seqs[:, t, :]
+            actions = workspace.actions[:n]
+        else:
+            actions = action_seqs[:, t, :]
+
+        rewards = (gamma ** t) * reward_batch(states[:n], actions)
+        if terminate_batch is not None:
+            rewards = np.where(alive[:n], rewards, 0.)
+            alive[:n] &= ~terminate_batch(states[:n], actions, t)
+        if rows is None:
+            rets += rewards
+        else:
+            rets[rows] += rewards
+        if t == horizon - 1:
+            break
+
+        # Drop terminated trajectories from the batch once enough of it has died
+        if terminate_batch is not None:
+            num_alive = np.count_nonzero(alive[:n])
+            if num_alive == 0:
+                break
+            if num_alive <= compact_threshold * n:
+                keep = np.flatnonzero(alive[:n])
+                states[:num_alive] = states[keep]
+                rows = keep if rows is None else rows[keep]
+                if members is not None:
+                    members = members[keep]
+                alive[:num_alive] = True
+                n = num_alive
+                actions = action_seqs[rows % num_seqs, t, :]
+
+        workspace.forward_np(nn_params, states[:n], actions, out=next_states[:n], members=members)
+        states, next_states = next_states, states
+    return rets.reshape(num_particles, num_seqs).mean(axis=0)
+
+
+class RolloutWorker:
     """
-    return [do_rollout_static(nn_params, mpc_params, reward, terminate, state0, action_seq, idx)
-            for idx in batch_seq_num]
+    Evaluates slices of action sequences. Keeps the dynamics weights and reward functions
+    between control steps so that only the current state and action sequences need to be sent.
+    """
+
+    def __init__(self, mpc_params, reward, terminate):
+        """
+        Parameters
+        ----------
+        mpc_params : dict
+            mpc_params['seed'] (optional) seeds the next states sampled from probabilistic models.
+        reward : function
+            Batched if mpc_params['batched'] is true
+        terminate : function
+            Batched if mpc_params['batched'] is true
+        """
+        self.mpc_params = mpc_params
+        self.reward = reward
+        self.terminate = terminate
+        self.nn_params = None
+        self.workspace = None
+        self.kernel = None
+
+    def set_nn_params(self, nn_params):
+        self.nn_params = nn_params
+        if self.mpc_params.get('backend', 'numpy') != 'numpy':
+            if self.kernel is None:
+                self.kernel = make_rollout_kernel(self.mpc_params, self.reward, self.terminate)
+            self.kernel.set_nn_params(nn_params)
+
+    def rollout(self, state0, action_seqs):
+        """
+        Parameters
+        ----------
+        state0 : np.ndarray
+            (state_dim,) start state, or (num_traj, state_dim) array with the start state of each sequence
+        action_seqs : np.ndarray
+            (num_traj, horizon, action_dim) slice of action sequences
+
+        Return
+        ------
+        np.ndarray: (num_traj,) array of rollout returns
+        """
+        if self.kernel is not None:
+            return self.kernel(state0, action_seqs)
+        if self.mpc_params.get('batched', False):
+            num_traj = action_seqs.shape[0] * self.mpc_params.get('num_particles', 1)
+            self.workspace = rollout_workspace(self.nn_params, num_traj, self.workspace,
+                                               seed=self.mpc_params.get('seed'))
+            return do_vectorized_rollout_static(self.nn_params, self.mpc_params, self.reward, self.terminate,
+                                                state0, action_seqs, self.workspace)
+        return np.array([do_rollout_static(self.nn_params, self.mpc_params, self.reward, self.terminate,
+                                           state0[seq] if np.ndim(state0) == 2 else state0, action_seqs, seq)
+                         for seq in range(action_seqs.shape[0])])
+
+    def rollout_population(self, states0, stream, start, end):
+        """
+        Sample rows start:end of a population and roll them out.
+
+        Parameters
+        ----------
+        states0 : np.ndarray
+            (state_dim,) start state, or (num_envs, state_dim) array with the start state of each environment
+        stream : sampling.PopulationStream
+        start : int
+        end : int
+
+        Return
+        ------
+        np.ndarray: (end - start,) array of rollout returns
+        """
+        if np.ndim(states0) == 2:
+            states0 = states0[stream.env_index(np.arange(start, end))]
+        return self.rollout(states0, stream.sample(start, end))
+
+
+RayRolloutWorker = ray.remote(RolloutWorker)
+
+
+def split_seeds(mpc_params, num_workers):
+    """
+    Return a copy of mpc_params for each of 'num_workers' workers, with an independent child of
+    mpc_params['seed'] (if given) as its seed.
+    """
+    if mpc_params.get('seed') is None:
+        return [mpc_params] * num_workers
+    seed = mpc_params['seed']
+    seed_sequence = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+    return [dict(mpc_params, seed=child) for child in seed_sequence.spawn(num_workers)]
+
+
+def make_rollout_kernel(mpc_params, reward, terminate):
+    """
+    Return the rollout kernel of mpc_params['backend'], which is 'torch', 'torch_compile' or 'numba'.
+    The reward and termination functions are batched for the torch backends and scalar for numba.
+    """
+    if mpc_params['backend'] == 'numba':
+        return NumbaRolloutKernel(mpc_params, reward, terminate)
+    return TorchRolloutKernel(mpc_params, reward, terminate, compile=mpc_params['backend'] == 'torch_compile')
+
+
+class RolloutWorkerPool:
+    """
+    A pool of long-lived Ray actors. Dynamics weights are only re-sent when the model's
+    version changes.
+    """
+
+    def __init__(self, num_workers, mpc_params, reward, terminate):
+        """
+        Parameters
+        ----------
+        num_workers : int
+        mpc_params : dict
+        reward : function
+        terminate : function
+        """
+        self.workers = [RayRolloutWorker.remote(worker_params, reward, terminate)
+                        for worker_params in split_seeds(mpc_params, num_workers)]
+        self.folded = mpc_params.get('batched', False) or mpc_params.get('backend', 'numpy') != 'numpy'
+        self.precision = mpc_params.get('precision', 'float32')
+        self.version = None
+
+    def sync(self, model):
+        """
+        Send the weights of 'model' to every worker if they have changed since the last sync.
+        """
+        if model.version == self.version:
+            return
+        if self.folded:
+            nn_params_ref = ray.put(export_low_precision(model, self.precision))
+        else:
+            nn_params_ref = ray.put(model.create_nn_params())
+        ray.get([worker.set_nn_params.remote(nn_params_ref) for worker in self.workers])
+        self.version = model.version
+
+    def rollout(self, state0, action_seqs):
+        """
+        Split 'action_seqs' (and per-sequence start states) evenly across the workers and return the (num_traj,)
+        array of returns.
+        """
+        slices = np.array_split(action_seqs, len(self.workers))
+        if np.ndim(state0) == 2:
+            state0_slices = np.array_split(state0, len(self.workers))
+        else:
+            state0_slices = [ray.put(state0)] * len(self.workers)
+        rets_ref = [worker.rollout.remote(state0_slice, seqs)
+                    for worker, state0_slice, seqs in zip(self.workers, state0_slices, slices)]
+        return np.concatenate(ray.get(rets_ref))
+
+    def rollout_population(self, states0, stream, start, end):
+        """
+        Split rows start:end of a population evenly across the workers, which sample their own rows, and return
+        the (end - start,) array of returns.
+        """
+        bounds = np.linspace(start, end, len(self.workers) + 1).astype(int)
+        states0_ref = ray.put(states0)
+        stream_ref = ray.put(stream)
+        rets_ref = [worker.rollout_population.remote(states0_ref, stream_ref, int(bounds[i]), int(bounds[i + 1]))
+                    for i, worker in enumerate(self.workers) if bounds[i] < bounds[i + 1]]
+        return np.concatenate(ray.get(rets_ref))
+
+    def shutdown(self):
+        for worker in self.workers:
+            ray.kill(worker)
+        self.workers = []
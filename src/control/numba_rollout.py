@@ -0,0 +1,180 @@
+import warnings
+
+import numpy as np
+
+from src.control.dynamics import rollout_workspace
+from src.control.rewards import vectorize_reward, vectorize_terminate
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+if numba is not None and numba.config.THREADING_LAYER == 'default':
+    # A process which has started TBB's threads hangs at exit once it has forked (e.g. to start an
+    # AsyncVectorEnv), so prefer the layers which survive fork
+    numba.config.THREADING_LAYER_PRIORITY = ['workqueue', 'omp', 'tbb']
+
+
+def numba_available():
+    return numba is not None
+
+
+def never_terminate(state, action, t):
+    return False
+
+
+# Number of trajectories stepped together by one parallel iteration, so that every row of weights
+# loaded from memory is reused for a whole tile of trajectories
+TILE_SIZE = 16
+
+if numba is not None:
+    @numba.njit(parallel=True, fastmath=True)
+    def rollout_kernel(w1, b1, w2, b2, w3, b3, state0, action_seqs, gamma, reward, terminate):
+        """
+        Roll out every action sequence from its row of the (num_traj, state_dim) start states 'state0' with the
+        folded network, one tile of trajectories per parallel iteration. The weights are C-contiguous (out, in)
+        float32 matrices.
+        """
+        num_traj, horizon, action_dim = action_seqs.shape
+        state_dim = state0.shape[1]
+        input_dim = state_dim + action_dim
+        hidden_dim = w1.shape[0]
+        rets = np.zeros(num_traj)
+        num_tiles = (num_traj + TILE_SIZE - 1) // TILE_SIZE
+        for tile in numba.prange(num_tiles):
+            lo = tile * TILE_SIZE
+            n = min(TILE_SIZE, num_traj - lo)
+            states = np.empty((n, state_dim))
+            for b in range(n):
+                states[b] = state0[lo + b]
+            alive = np.ones(n, dtype=np.bool_)
+            rows = np.empty(n, dtype=np.int64)
+            x = np.empty((n, input_dim), dtype=np.float32)
+            h1 = np.empty((n, hidden_dim), dtype=np.float32)
+            h2 = np.empty((n, hidden_dim), dtype=np.float32)
+            for t in range(horizon):
+                num_alive = 0
+                for b in range(n):
+                    if alive[b]:
+                        action = action_seqs[lo + b, t, :]
+                        rets[lo + b] += (gamma ** t) * reward(states[b], action)
+                        if terminate(states[b], action, t):
+                            alive[b] = False
+                        else:
+                            rows[num_alive] = b
+                            num_alive += 1
+                # The states after the last action are never rewarded
+                if num_alive == 0 or t == horizon - 1:
+                    break
+
+                # Only the trajectories still alive are stepped, packed at the top of the buffers, and each
+                # weight row is applied to all of them while it is in cache
+                for i in range(num_alive):
+                    b = rows[i]
+                    for k in range(state_dim):
+                        x[i, k] = states[b, k]
+                    for k in range(action_dim):
+                        x[i, state_dim + k] = action_seqs[lo + b, t, k]
+                for j in range(hidden_dim):
+                    for i in range(num_alive):
+                        acc = b1[j]
+                        for k in range(input_dim):
+                            acc += w1[j, k] * x[i, k]
+                        h1[i, j] = max(acc, np.float32(0))
+                for j in range(hidden_dim):
+                    for i in range(num_alive):
+                        acc = b2[j]
+                        for k in range(hidden_dim):
+                            acc += w2[j, k] * h1[i, k]
+                        h2[i, j] = max(acc, np.float32(0))
+
+                # The folded output layer predicts next_state - state in raw units
+                for j in range(state_dim):
+                    for i in range(num_alive):
+                        acc = b3[j]
+                        for k in range(hidden_dim):
+                            acc += w3[j, k] * h2[i, k]
+                        states[rows[i], j] += acc
+        return rets
+
+
+class NumbaRolloutKernel:
+    """
+    Rolls out a batch of action sequences with a JIT-compiled loop over tiles of trajectories, parallelized
+    with numba.prange, so that a single process uses every core without Ray. The scalar reward and termination
+    functions are compiled with numba.njit as well. If they cannot be compiled, rollouts fall back to the
+    vectorized NumPy path with a warning.
+    """
+
+    def __init__(self, mpc_params, reward, terminate):
+        """
+        Parameters
+        ----------
+        mpc_params : dict
+        reward : function
+            The instantaneous reward given at each timestep for a single (s, a) pair.
+        terminate : function
+            For a given (s, a, t) tuple returns true if episode has ended. May be None.
+        """
+        if numba is None:
+            raise ImportError("The numba rollout backend requires numba")
+        self.mpc_params = mpc_params
+        self.reward = reward
+        self.terminate = terminate
+        self.reward_jit = numba.njit(reward)
+        self.terminate_jit = numba.njit(never_terminate if terminate is None else terminate)
+        self.jit_compiled = False
+        self.jit_failed = False
+        self.workspace = None
+        self.nn_params = None
+        self.stack = None
+
+    def set_nn_params(self, nn_params):
+        """
+        Load the weights of folded nn_params, see DynamicsModel.create_folded_nn_params().
+        """
+        if 'num_members' in nn_params or 'module' in nn_params:
+            raise ValueError("The numba rollout backend only supports float32 single models")
+        self.nn_params = nn_params
+        stack = nn_params['stack']
+        self.stack = [np.ascontiguousarray(stack[key], dtype=np.float32)
+                      for key in ['w1', 'b1', 'w2', 'b2', 'w3', 'b3']]
+
+    def __call__(self, state0, action_seqs):
+        """
+        Parameters
+        ----------
+        state0 : np.ndarray
+            (state_dim,) start state, or (num_traj, state_dim) array with the start state of each sequence
+        action_seqs : np.ndarray
+            (num_traj, horizon, action_dim) array of action sequences
+
+        Return
+        ------
+        np.ndarray: (num_traj,) array of rollout returns
+        """
+        action_seqs = np.ascontiguousarray(action_seqs, dtype=np.float64)
+        state0 = np.asarray(state0, dtype=np.float64)
+        state0_rows = np.ascontiguousarray(np.broadcast_to(state0, (action_seqs.shape[0], state0.shape[-1])))
+        if self.jit_compiled:
+            return rollout_kernel(*self.stack, state0_rows, action_seqs, float(self.mpc_params['gamma']),
+                                  self.reward_jit, self.terminate_jit)
+        if not self.jit_failed:
+            # Numba raises all sorts of errors for functions it cannot compile
+            try:
+                rets = rollout_kernel(*self.stack, state0_rows, action_seqs, float(self.mpc_params['gamma']),
+                                      self.reward_jit, self.terminate_jit)
+                self.jit_compiled = True
+                return rets
+            except Exception as e:
+                warnings.warn("Could not JIT compile the reward or termination function, "
+                              "using NumPy rollouts: {}".format(e))
+                self.jit_failed = True
+
+        from src.control.mpc import do_vectorized_rollout_static
+        num_traj = action_seqs.shape[0] * self.mpc_params.get('num_particles', 1)
+        self.workspace = rollout_workspace(self.nn_params, num_traj, self.workspace, seed=self.mpc_params.get('seed'))
+        return do_vectorized_rollout_static(self.nn_params, self.mpc_params, vectorize_reward(self.reward),
+                                            vectorize_terminate(self.terminate), state0, action_seqs,
+                                            self.workspace)
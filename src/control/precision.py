@@ -0,0 +1,172 @@
+import time
+import warnings
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from src.control.dynamics import EnsembleDynamicsModel, rollout_workspace
+
+PRECISIONS = ['float32', 'bfloat16', 'float16', 'int8']
+
+# Precisions which already warned that they fall back to float32
+_warned_fallbacks = set()
+
+
+class FoldedNetwork(nn.Module):
+    """
+    Torch copy of the network with the normalization folded into its weights (see
+    DynamicsModel.create_folded_nn_params()), mapping raw (state, action) inputs to next_state - state.
+    """
+
+    def __init__(self, stack):
+        super().__init__()
+        layers = []
+        for i in range(1, 4):
+            w = torch.from_numpy(np.ascontiguousarray(stack['w' + str(i)], dtype=np.float32))
+            linear = nn.Linear(w.shape[1], w.shape[0])
+            with torch.no_grad():
+                linear.weight.copy_(w)
+                linear.bias.copy_(torch.from_numpy(np.asarray(stack['b' + str(i)], dtype=np.float32)))
+            layers += [linear, nn.ReLU()]
+        self.linear_relu_stack = nn.Sequential(*layers[:-1])
+
+    def forward(self, x):
+        return self.linear_relu_stack(x)
+
+
+def bfloat16_supported():
+    """
+    Return true if oneDNN can run bfloat16 matrix products natively on this CPU (AVX512-BF16 or AMX); elsewhere
+    torch emulates them, which is slower than float32.
+    """
+    try:
+        return torch.backends.mkldnn.is_available() and torch.ops.mkldnn._is_mkldnn_bf16_supported()
+    except (AttributeError, RuntimeError):
+        return False
+
+
+def float16_supported():
+    """
+    Return true if oneDNN can run float16 matrix products natively on this CPU (AVX512-FP16 or AMX-FP16);
+    elsewhere torch emulates them, which is slower than float32.
+    """
+    try:
+        return torch.backends.mkldnn.is_available() and torch.ops.mkldnn._is_mkldnn_fp16_supported()
+    except (AttributeError, RuntimeError):
+        return False
+
+
+def int8_supported():
+    """
+    Return true if torch has a quantized engine for dynamic int8 quantization on this CPU.
+    """
+    return any(engine in torch.backends.quantized.supported_engines for engine in ['x86', 'fbgemm', 'qnnpack'])
+
+
+def export_low_precision(model, precision):
+    """
+    Export the dynamics network for reduced-precision inference.
+
+    Parameters
+    ----------
+    model : DynamicsModel
+        Ensemble models are only supported with 'float32'.
+    precision : str
+        One of PRECISIONS. 'int8' applies dynamic quantization to the three linear layers (int8 weights,
+        activations quantized on the fly), 'bfloat16' and 'float16' cast the weights and activations. If the CPU
+        has no native support for 'bfloat16' or 'float16', it falls back to 'float32' and warns the first time.
+
+    Return
+    ------
+    dict: the folded nn_params of the model, plus the low precision torch module under 'module' and its
+    input dtype under 'dtype'. RolloutWorkspace.forward_np() runs the module instead of the float32 stack.
+    The precision actually exported is under 'precision'.
+    """
+    if precision not in PRECISIONS:
+        raise ValueError("Unknown precision: {}".format(precision))
+    supported = {'bfloat16': bfloat16_supported, 'float16': float16_supported}
+    if precision in supported and not supported[precision]():
+        if precision not in _warned_fallbacks:
+            _warned_fallbacks.add(precision)
+            warnings.warn("This CPU has no native {} support, exporting the dynamics network "
+                          "in float32 instead".format(precision))
+        precision = 'float32'
+    nn_params = dict(model.create_folded_nn_params(), precision=precision)
+    if precision == 'float32':
+        return nn_params
+    if isinstance(model, EnsembleDynamicsModel):
+        raise ValueError("Low precision inference is not supported for ensemble models")
+
+    module = FoldedNetwork(nn_params['stack']).eval()
+    dtype = torch.float32
+    if precision == 'int8':
+        # Eager mode dynamic quantization warns that it is deprecated on every call
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            module = torch.ao.quantization.quantize_dynamic(module, {nn.Linear}, dtype=torch.qint8)
+    else:
+        dtype = getattr(torch, precision)
+        module = module.to(dtype)
+    return dict(nn_params, module=module, dtype=dtype)
+
+
+def precision_report(model, states, action_seqs, precisions=None, num_repeats=20):
+    """
+    Compare reduced-precision exports of 'model' with the float32 folded network.
+
+    Parameters
+    ----------
+    model : DynamicsModel
+    states : np.ndarray
+        (num_traj, state_dim) array of start states, e.g. sampled from a replay buffer.
+    action_seqs : np.ndarray
+        (num_traj, horizon, action_dim) array of action sequences.
+    precisions : list of str
+        Defaults to all of PRECISIONS.
+    num_repeats : int
+        Number of batched forward passes timed for the throughput.
+
+    Return
+    ------
+    list of dict: for each precision, the precision it was exported in (see export_low_precision()), the RMS
+    error of the one-step and of the H-step predicted states against float32 (relative to the RMS distance
+    the float32 states moved from the start states), and the throughput in predicted transitions per second.
+    """
+    num_traj = action_seqs.shape[0]
+    reference = open_loop_rollout(export_low_precision(model, 'float32'), states, action_seqs)
+    scale = np.sqrt(np.mean(np.square(reference[1:] - reference[0]), axis=(1, 2)))
+    report = []
+    for precision in PRECISIONS if precisions is None else precisions:
+        nn_params = export_low_precision(model, precision)
+        trajectory = open_loop_rollout(nn_params, states, action_seqs)
+        error = np.sqrt(np.mean(np.square(trajectory[1:] - reference[1:]), axis=(1, 2))) / scale
+
+        workspace = rollout_workspace(nn_params, num_traj)
+        out = np.empty_like(states)
+        workspace.forward_np(nn_params, states, action_seqs[:, 0, :], out=out)
+        start_time = time.perf_counter()
+        for i in range(num_repeats):
+            workspace.forward_np(nn_params, states, action_seqs[:, 0, :], out=out)
+        throughput = num_repeats * num_traj / (time.perf_counter() - start_time)
+
+        report.append({'precision': precision,
+                       'exported_precision': nn_params['precision'],
+                       'one_step_error': error[0],
+                       'horizon_error': error[-1],
+                       'transitions_per_sec': throughput})
+    return report
+
+
+def open_loop_rollout(nn_params, states, action_seqs):
+    """
+    Return the (horizon + 1, num_traj, state_dim) array of states predicted by applying 'action_seqs'
+    from 'states'.
+    """
+    num_traj, horizon, action_dim = action_seqs.shape
+    workspace = rollout_workspace(nn_params, num_traj)
+    trajectory = np.empty((horizon + 1, num_traj, states.shape[1]))
+    trajectory[0] = states
+    for t in range(horizon):
+        workspace.forward_np(nn_params, trajectory[t], action_seqs[:, t, :], out=trajectory[t + 1])
+    return trajectory
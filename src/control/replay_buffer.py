@@ -1,22 +1,242 @@
-import random
 import collections
+import copy
+import functools
+import threading
 
 import numpy as np
 
 Transition = collections.namedtuple('Transition', ('state', 'action', 'next_state'))
 
 
+def synchronized(method):
+    """
+    Run 'method' while holding the instance's lock.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+class RunningMoments:
+    """
+    Running mean and variance of a stream of vectors (Welford's algorithm), with batched updates and
+    merging (Chan et al.'s parallel algorithm) and exact removal of previously added vectors.
+    """
+
+    def __init__(self, dim):
+        self.dim = dim
+        self.count = 0
+        self.mean = np.zeros(dim)
+        self.m2 = np.zeros(dim)
+
+    @classmethod
+    def from_batch(cls, x):
+        """
+        Moments of the rows of the (n, dim) array 'x'.
+        """
+        x = np.asarray(x, dtype=float).reshape(len(x), -1)
+        moments = cls(x.shape[1])
+        moments.count = x.shape[0]
+        if moments.count > 0:
+            moments.mean = np.mean(x, axis=0)
+            moments.m2 = np.sum(np.square(x - moments.mean), axis=0)
+        return moments
+
+    @property
+    def var(self):
+        """
+        Unbiased sample variance, or ones if fewer than two vectors have been added.
+        """
+        if self.count < 2:
+            return np.ones(self.dim)
+        return self.m2 / (self.count - 1)
+
+    def push(self, x):
+        self.count += 1
+        delta = x - self.mean
+        self.mean = self.mean + delta / self.count
+        self.m2 = self.m2 + delta * (x - self.mean)
+
+    def remove(self, x):
+        """
+        Remove a vector which was previously added.
+        """
+        if self.count <= 1:
+            self.__init__(self.dim)
+            return
+        self.count -= 1
+        delta = x - self.mean
+        self.mean = self.mean - delta / self.count
+        self.m2 = np.maximum(self.m2 - delta * (x - self.mean), 0)
+
+    def push_batch(self, x):
+        self.merge(RunningMoments.from_batch(x))
+
+    def remove_batch(self, x):
+        """
+        Remove the rows of 'x', all of which were previously added.
+        """
+        other = RunningMoments.from_batch(x)
+        if other.count == 0:
+            return
+        count = self.count - other.count
+        if count <= 0:
+            self.__init__(self.dim)
+            return
+        mean = (self.count * self.mean - other.count * other.mean) / count
+        delta = other.mean - mean
+        self.m2 = np.maximum(self.m2 - other.m2 - np.square(delta) * count * other.count / self.count, 0)
+        self.mean = mean
+        self.count = count
+
+    def merge(self, other):
+        """
+        Combine with the moments of another stream, e.g. those of a different worker's buffer.
+        """
+        if other.count == 0:
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta * other.count / count
+        self.m2 = self.m2 + other.m2 + np.square(delta) * self.count * other.count / count
+        self.count = count
+
+
+class RingBuffer:
+    """
+    Fixed-capacity storage of transitions in contiguous (max_size, dim) arrays. Once full,
+    the oldest transition is overwritten.
+    """
+
+    def __init__(self, max_size, state_dim, action_dim):
+        self.max_size = max_size
+        self.state = np.zeros((max_size, state_dim))
+        self.action = np.zeros((max_size, action_dim))
+        self.next_state = np.zeros((max_size, state_dim))
+        self.size = 0
+        self.next_idx = 0
+
+    def append(self, transition):
+        self.state[self.next_idx] = transition.state
+        self.action[self.next_idx] = transition.action
+        self.next_state[self.next_idx] = transition.next_state
+        self.next_idx = (self.next_idx + 1) % self.max_size
+        self.size = min(self.size + 1, self.max_size)
+
+    def extend(self, states, actions, next_states):
+        """
+        Append the rows of (n, dim) arrays with n <= max_size in one vectorized write.
+        """
+        idx = (self.next_idx + np.arange(len(states))) % self.max_size
+        self.state[idx] = states
+        self.action[idx] = actions
+        self.next_state[idx] = next_states
+        self.next_idx = (self.next_idx + len(states)) % self.max_size
+        self.size = min(self.size + len(states), self.max_size)
+
+    def oldest_batch(self, n):
+        """
+        Return (state, action) arrays of the 'n' oldest transitions, oldest first.
+        """
+        idx = (self.next_idx - self.size + np.arange(n)) % self.max_size
+        return self.state[idx], self.action[idx]
+
+    def oldest(self):
+        """
+        Return the transition that the next append overwrites, or None if the buffer is not full.
+        """
+        if self.size < self.max_size:
+            return None
+        return Transition(self.state[self.next_idx], self.action[self.next_idx], self.next_state[self.next_idx])
+
+    def sample(self, batch_size, rng, state, action, next_state):
+        """
+        Sample 'batch_size' distinct transitions, gathering them into the given (batch_size, dim) arrays.
+        """
+        idx = rng.choice(self.size, size=batch_size, replace=False)
+        np.take(self.state, idx, axis=0, out=state)
+        np.take(self.action, idx, axis=0, out=action)
+        np.take(self.next_state, idx, axis=0, out=next_state)
+
+    def __len__(self):
+        return self.size
+
+
 class ReplayBuffer:
 
-    def __init__(self, state_dim, action_dim, max_size=10000, normalize=False):
-        self.rand_data = collections.deque([], maxlen=max_size)
-        self.rl_data = collections.deque([], maxlen=max_size)
+    def __init__(self, state_dim, action_dim, max_size=10000, normalize=False, contiguous=False,
+                 state_noise_scale=0.1, action_noise_scale=0.1, seed=None, val_prop=0):
+        """
+        Parameters
+        ----------
+        state_dim : int
+        action_dim : int
+        max_size : int
+            Maximum number of transitions held in each of rand_data and rl_data.
+        normalize : bool
+        contiguous : bool
+            If true, transitions are stored in preallocated ring buffers instead of deques of
+            namedtuples, and batches are gathered with index arrays.
+        state_noise_scale : float or np.ndarray
+            Stdev of the zero-mean Gaussian noise added to normalized states and state differences.
+            Either a float or an array of shape (state_dim,).
+        action_noise_scale : float or np.ndarray
+            Stdev of the zero-mean Gaussian noise added to normalized actions.
+            Either a float or an array of shape (action_dim,).
+        seed : int
+            Seed of the random generator used for sampling batches and noise.
+        val_prop : float in [0, 1)
+            Fraction of pushed transitions held out in val_data for validating the dynamics model.
+            Held-out transitions are never sampled for training and do not count towards the statistics.
+        """
+        if contiguous:
+            self.rand_data = RingBuffer(max_size, state_dim, action_dim)
+            self.rl_data = RingBuffer(max_size, state_dim, action_dim)
+            self.val_data = RingBuffer(max_size, state_dim, action_dim)
+        else:
+            self.rand_data = collections.deque([], maxlen=max_size)
+            self.rl_data = collections.deque([], maxlen=max_size)
+            self.val_data = collections.deque([], maxlen=max_size)
+        self.val_prop = val_prop
         self.state_dim = state_dim
         self.action_dim = action_dim
-        self.state_mean, self.state_var = np.zeros(self.state_dim), np.ones(self.state_dim)
-        self.action_mean, self.action_var = np.zeros(self.action_dim), np.ones(self.action_dim)
+        self.state_moments = RunningMoments(self.state_dim)
+        self.action_moments = RunningMoments(self.action_dim)
         self.normalize = normalize
+        self.state_noise_scale = state_noise_scale
+        self.action_noise_scale = action_noise_scale
+        self.rng = np.random.default_rng(seed)
+
+        # Transitions may be pushed by a collecting thread while a learning thread samples
+        self.lock = threading.RLock()
+
+        # Preallocated batch buffers, grown when a larger batch is requested
+        self.batch_capacity = 0
+        self.batch_state = None
+        self.batch_action = None
+        self.batch_next_state = None
+        self.state_noise = None
+        self.action_noise = None
+
+    @property
+    def state_mean(self):
+        return self.state_moments.mean
+
+    @property
+    def state_var(self):
+        return self.state_moments.var
 
+    @property
+    def action_mean(self):
+        return self.action_moments.mean
+
+    @property
+    def action_var(self):
+        return self.action_moments.var
+
+    @synchronized
     def push(self, state, action, next_state, rl):
         """
         Push (s, a, s') tuple to replay memory where 'state', 'action', and 'next_state' are not yet normalized.
@@ -28,105 +248,269 @@ class ReplayBuffer:
         rl : bool
             True if 'a' in (s, a, s') is chosen by MPC (not random)
         """
-        # Update means and variances
-        if self.__len__() > 1 and self.normalize:
-            self.state_mean = (self.__len__()*self.state_mean + state) / (self.__len__() + 1)
-            self.action_mean = (self.__len__()*self.action_mean + action) / (self.__len__() + 1)
-            self.state_var = ((self.__len__() - 1)*self.state_var +
-                              np.square(state - self.state_mean))/(self.__len__() + 1 - 1)
-            self.action_var = ((self.__len__() - 1)*self.action_var +
-                               np.square(action - self.action_mean))/(self.__len__() + 1 - 1)
+        if self.val_prop > 0 and self.rng.uniform() < self.val_prop:
+            self.val_data.append(Transition(state, action, next_state))
+            return
+        data = self.rl_data if rl else self.rand_data
+
+        # Update means and variances, removing the transition about to be evicted
+        if self.normalize:
+            evicted = self.oldest(data)
+            if evicted is not None:
+                self.state_moments.remove(evicted.state)
+                self.action_moments.remove(evicted.action)
+            self.state_moments.push(state)
+            self.action_moments.push(action)
 
         # Push normalized data into replay buffer
-        transition = Transition(state, action, next_state)
-        if rl:
-            self.rl_data.append(transition)
-        else:
-            self.rand_data.append(transition)
+        data.append(Transition(state, action, next_state))
 
-    def sample(self, batch_size, rl_prop=0):
+    @synchronized
+    def push_batch(self, states, actions, next_states, rl):
+        """
+        Push a whole episode (or any batch) of (s, a, s') tuples at once, with vectorized statistics
+        updates and evictions. Useful for data collection workers which return whole episodes.
+
+        Parameters
+        ----------
+        states : np.ndarray
+            (T, state_dim) array
+        actions : np.ndarray
+            (T, action_dim) array
+        next_states : np.ndarray
+            (T, state_dim) array
+        rl : bool
+            True if the actions are chosen by MPC (not random)
+        """
+        states = np.asarray(states, dtype=float).reshape(-1, self.state_dim)
+        actions = np.asarray(actions, dtype=float).reshape(-1, self.action_dim)
+        next_states = np.asarray(next_states, dtype=float).reshape(-1, self.state_dim)
+        if self.val_prop > 0:
+            held_out = self.rng.uniform(size=len(states)) < self.val_prop
+            self.extend_data(self.val_data, states[held_out], actions[held_out], next_states[held_out])
+            states, actions, next_states = states[~held_out], actions[~held_out], next_states[~held_out]
+        data = self.rl_data if rl else self.rand_data
+
+        # Transitions which would be evicted by later ones in the same batch are never stored
+        max_size = data.max_size if isinstance(data, RingBuffer) else data.maxlen
+        states, actions, next_states = states[-max_size:], actions[-max_size:], next_states[-max_size:]
+        if len(states) == 0:
+            return
+
+        # Update means and variances, removing the transitions about to be evicted
+        if self.normalize:
+            num_evicted = max(len(data) + len(states) - max_size, 0)
+            if num_evicted > 0:
+                evicted_states, evicted_actions = self.oldest_batch(data, num_evicted)
+                self.state_moments.remove_batch(evicted_states)
+                self.action_moments.remove_batch(evicted_actions)
+            self.state_moments.push_batch(states)
+            self.action_moments.push_batch(actions)
+
+        self.extend_data(data, states, actions, next_states)
+
+    @synchronized
+    def sample(self, batch_size, rl_prop=0, rng=None):
         """
         Sample a batch of experiences from replay. Note that the third element returned is
         'next_state - state', NOT 'next_state'.
 
+        The returned arrays are views of buffers which are reused by the next call to sample(),
+        so copy them if they need to outlive it.
+
         Parameters
         ----------
         batch_size : int
             Number of tuples to sample from buffer
         rl_prop : float in [0, 1]
             Fraction of samples that come from rl_data (as opposed to rand_data)
+        rng : np.random.Generator
+            Random generator to sample with. Defaults to the buffer's own generator.
         """
+        if rng is None:
+            rng = self.rng
 
-        # Get samples from random actions
-        rand_transitions = random.sample(self.rand_data, int(np.ceil(batch_size * (1-rl_prop))))
-        rand_batch = Transition(*zip(*rand_transitions))
-
-        rand_state = np.array(rand_batch.state)
-        rand_action = np.array(rand_batch.action)
-        rand_next_state = np.array(rand_batch.next_state)
-
+        rand_batch_size = int(np.ceil(batch_size * (1-rl_prop)))
+        rl_batch_size = 0
         if rl_prop > 0:
-            # Get  samples from MPC actions
             rl_batch_size = int(np.min([np.floor(batch_size * rl_prop), len(self.rl_data)]))
-            rl_transitions = random.sample(self.rl_data, rl_batch_size)
-            rl_batch = Transition(*zip(*rl_transitions))
+        size = rand_batch_size + rl_batch_size
+        self.reserve_batch(size)
+        state = self.batch_state[:size]
+        action = self.batch_action[:size]
+        next_state = self.batch_next_state[:size]
 
-            rl_state = np.array(rl_batch.state)
-            rl_action = np.array(rl_batch.action)
-            rl_next_state = np.array(rl_batch.next_state)
-
-            # Combine samples
-            state = np.concatenate((rand_state, rl_state), axis=0)
-            action = np.concatenate((rand_action, rl_action), axis=0)
-            next_state = np.concatenate((rand_next_state, rl_next_state), axis=0)
-        else:
-            state = rand_state
-            action = rand_action
-            next_state = rand_next_state
+        # Get samples from random actions, then samples from MPC actions
+        self.sample_data(self.rand_data, rand_batch_size, rng,
+                         state[:rand_batch_size], action[:rand_batch_size], next_state[:rand_batch_size])
+        self.sample_data(self.rl_data, rl_batch_size, rng,
+                         state[rand_batch_size:], action[rand_batch_size:], next_state[rand_batch_size:])
 
         # Normalize data
         if self.normalize:
-            n_state, n_action, d_n_state = self.normalize_tuple(state, action, next_state, batch_size)
+            n_state, n_action, d_n_state = self.normalize_tuple(state, action, next_state, size, rng)
             return n_state, n_action, d_n_state
 
-        return state, action, next_state - state
+        np.subtract(next_state, state, out=next_state)
+        return state, action, next_state
 
-    def normalize_tuple(self, state, action, next_state, batch_size):
+    @synchronized
+    def validation_batch(self):
         """
-        Normalize state, action, and next_state - state. Assume covariance matrix of action
-        and states have zero on the diagonal.
+        Return all held-out transitions as (state, action, next_state - state) arrays, normalized
+        with the current statistics (if normalize is true) but without noise. Returns None if no
+        transitions have been held out yet.
         """
-        n_state = (state - self.state_mean) @ np.diagflat(np.reciprocal(np.sqrt(self.state_var)))
-        n_action = (action - self.action_mean) @ np.diagflat(np.reciprocal(np.sqrt(self.action_var)))
-        n_next_state = (next_state - self.state_mean) @ np.diagflat(np.reciprocal(np.sqrt(self.state_var)))
-        d_n_state = n_next_state - n_state
+        if len(self.val_data) == 0:
+            return None
+        if isinstance(self.val_data, RingBuffer):
+            size = len(self.val_data)
+            state = self.val_data.state[:size].copy()
+            action = self.val_data.action[:size].copy()
+            d_state = self.val_data.next_state[:size] - state
+        else:
+            state = np.array([t.state for t in self.val_data], dtype=float)
+            action = np.array([t.action for t in self.val_data], dtype=float)
+            d_state = np.array([t.next_state for t in self.val_data], dtype=float) - state
+
+        if self.normalize:
+            inv_state_std = np.reciprocal(np.sqrt(self.state_var))
+            state = (state - self.state_mean) * inv_state_std
+            action = (action - self.action_mean) / np.sqrt(self.action_var)
+            d_state = d_state * inv_state_std
+        return state, action, d_state
+
+    def reserve_batch(self, size):
+        """
+        Make sure the batch buffers can hold 'size' transitions.
+        """
+        if size <= self.batch_capacity:
+            return
+        self.batch_capacity = size
+        self.batch_state = np.empty((size, self.state_dim))
+        self.batch_action = np.empty((size, self.action_dim))
+        self.batch_next_state = np.empty((size, self.state_dim))
+        self.state_noise = np.empty((size, self.state_dim))
+        self.action_noise = np.empty((size, self.action_dim))
+
+    @staticmethod
+    def oldest(data):
+        """
+        Return the transition of rand_data or rl_data that the next push evicts, or None if there is room.
+        """
+        if isinstance(data, RingBuffer):
+            return data.oldest()
+        if len(data) < data.maxlen:
+            return None
+        return data[0]
+
+    @staticmethod
+    def oldest_batch(data, n):
+        """
+        Return (state, action) arrays of the 'n' oldest transitions of rand_data or rl_data.
+        """
+        if isinstance(data, RingBuffer):
+            return data.oldest_batch(n)
+        oldest = [data[i] for i in range(n)]
+        return np.array([t.state for t in oldest]), np.array([t.action for t in oldest])
+
+    @staticmethod
+    def extend_data(data, states, actions, next_states):
+        """
+        Append the rows of (n, dim) arrays to rand_data, rl_data or val_data.
+        """
+        if len(states) == 0:
+            return
+        if isinstance(data, RingBuffer):
+            max_size = data.max_size
+            data.extend(states[-max_size:], actions[-max_size:], next_states[-max_size:])
+        else:
+            data.extend(Transition(*transition) for transition in zip(states, actions, next_states))
+
+    @staticmethod
+    def sample_data(data, batch_size, rng, state, action, next_state):
+        """
+        Sample 'batch_size' transitions from either rand_data or rl_data, writing them into the given
+        (batch_size, dim) arrays.
+        """
+        if batch_size == 0:
+            return
+        if isinstance(data, RingBuffer):
+            data.sample(batch_size, rng, state, action, next_state)
+            return
+
+        for i, j in enumerate(rng.choice(len(data), size=batch_size, replace=False)):
+            transition = data[j]
+            state[i] = transition.state
+            action[i] = transition.action
+            next_state[i] = transition.next_state
+
+    def normalize_tuple(self, state, action, next_state, batch_size, rng=None):
+        """
+        Normalize state, action, and next_state - state in place, and add zero-mean Gaussian noise.
+        Assume covariance matrix of action and states have zero on the diagonal, so normalizing is
+        elementwise.
+        """
+        if rng is None:
+            rng = self.rng
+        self.reserve_batch(batch_size)
+        inv_state_std = np.reciprocal(np.sqrt(self.state_var))
+        inv_action_std = np.reciprocal(np.sqrt(self.action_var))
+
+        # (next_state - mean) / std - (state - mean) / std = (next_state - state) / std
+        d_n_state = next_state
+        np.subtract(next_state, state, out=d_n_state)
+        np.multiply(d_n_state, inv_state_std, out=d_n_state)
+        n_state = state
+        np.subtract(state, self.state_mean, out=n_state)
+        np.multiply(n_state, inv_state_std, out=n_state)
+        n_action = action
+        np.subtract(action, self.action_mean, out=n_action)
+        np.multiply(n_action, inv_action_std, out=n_action)
 
         # Add zero-mean gaussian noise to tuple variables
-        n_state += self.sample_state_gaussian(batch_size)
-        n_action += self.sample_action_gaussian(batch_size)
-        d_n_state += self.sample_state_gaussian(batch_size)
+        state_noise = self.state_noise[:batch_size]
+        action_noise = self.action_noise[:batch_size]
+        for target, noise, scale in [(n_state, state_noise, self.state_noise_scale),
+                                     (n_action, action_noise, self.action_noise_scale),
+                                     (d_n_state, state_noise, self.state_noise_scale)]:
+            rng.standard_normal(out=noise)
+            np.multiply(noise, scale, out=noise)
+            np.add(target, noise, out=target)
 
         return n_state, n_action, d_n_state
 
-    def sample_state_gaussian(self, size):
-        return np.random.multivariate_normal(mean=np.zeros(self.state_dim),
-                                             cov=0.01*np.eye(self.state_dim),
-                                             size=size)
+    def merge_statistics(self, other):
+        """
+        Combine the state and action statistics of another buffer, e.g. a different worker's, into this
+        buffer's, as if its transitions had been pushed here too. The transitions themselves are not copied,
+        so later evictions only remove this buffer's own transitions from the statistics.
 
-    def sample_action_gaussian(self, size):
-        return np.random.multivariate_normal(mean=np.zeros(self.action_dim),
-                                             cov=0.01*np.eye(self.action_dim),
-                                             size=size)
+        Parameters
+        ----------
+        other : ReplayBuffer
+        """
+        # Copy the other buffer's moments first, so that the two locks are never held together
+        with other.lock:
+            state_moments = copy.deepcopy(other.state_moments)
+            action_moments = copy.deepcopy(other.action_moments)
+        with self.lock:
+            self.state_moments.merge(state_moments)
+            self.action_moments.merge(action_moments)
 
+    @synchronized
     def get_state_mean(self):
         return self.state_mean
 
+    @synchronized
     def get_state_var(self):
         return self.state_var
 
+    @synchronized
     def get_action_mean(self):
         return self.action_mean
 
+    @synchronized
     def get_action_var(self):
         return self.action_var
 
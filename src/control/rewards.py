@@ -0,0 +1,62 @@
+import numpy as np
+
+
+class BatchReward:
+    """
+    Adapter which turns a scalar reward(state, action) function into a batched one
+    taking (N, state_dim) and (N, action_dim) arrays and returning an (N,) array of rewards.
+    """
+
+    def __init__(self, reward):
+        """
+        Parameters
+        ----------
+        reward : function
+            The instantaneous reward given at each timestep for a single (s, a) pair.
+        """
+        self.reward = reward
+
+    def __call__(self, states, actions):
+        num = states.shape[0]
+        return np.array([self.reward(states[i], actions[i]) for i in range(num)], dtype=float).reshape(num)
+
+
+class BatchTerminate:
+    """
+    Adapter which turns a scalar terminate(state, action, t) function into a batched one
+    taking (N, state_dim) and (N, action_dim) arrays and returning an (N,) boolean done-mask.
+    """
+
+    def __init__(self, terminate):
+        """
+        Parameters
+        ----------
+        terminate : function
+            For a given (s, a, t) tuple returns true if episode has ended.
+        """
+        self.terminate = terminate
+
+    def __call__(self, states, actions, t):
+        num = states.shape[0]
+        return np.array([self.terminate(states[i], actions[i], t) for i in range(num)], dtype=bool).reshape(num)
+
+
+def vectorize_reward(reward, reward_batch=None):
+    """
+    Return 'reward_batch' if given, otherwise wrap the scalar 'reward' function.
+    """
+    if reward_batch is not None:
+        return reward_batch
+    return BatchReward(reward)
+
+
+def vectorize_terminate(terminate, terminate_batch=None):
+    """
+    Return 'terminate_batch' if given, otherwise wrap the scalar 'terminate' function
+    (or return None if there is no termination condition at all).
+    """
+    if terminate_batch is not None:
+        return terminate_batch
+    if terminate is None:
+        return None
+    return BatchTerminate(terminate)
@@ -0,0 +1,184 @@
+import numpy as np
+import scipy.special as special
+
+
+def sample_truncated_normal(mean, std, low, high, size, u=None):
+    """
+    Sample from a Gaussian truncated to [low, high] using its inverse CDF, so that every sample
+    is in bounds without piling up on the bounds the way clipped samples do.
+
+    Parameters
+    ----------
+    mean : np.ndarray
+        Broadcastable to 'size'
+    std : float or np.ndarray
+        Broadcastable to 'size'
+    low : np.ndarray
+        Broadcastable to 'size'
+    high : np.ndarray
+        Broadcastable to 'size'
+    size : tuple of int
+    u : np.ndarray
+        Uniform samples in [0, 1) of shape 'size' to transform. Drawn from np.random if None.
+    """
+    mean = np.broadcast_to(mean, size)
+    std = np.broadcast_to(std, size)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cdf_low = special.ndtr((low - mean) / std)
+        cdf_high = special.ndtr((high - mean) / std)
+        if u is None:
+            u = np.random.uniform(low=0, high=1.0, size=size)
+        samples = mean + std * special.ndtri(cdf_low + u * (cdf_high - cdf_low))
+    samples = np.where(std > 0, samples, mean)
+    return np.clip(samples, low, high)
+
+
+class PopulationStream:
+    """
+    The description of a population of action sequences sampled around the mean trajectories of one or more
+    environments, from which any row can be generated independently: the noise of trajectory j of environment b
+    comes from the counter-based Philox generator keyed on keys[b], advanced to the block of counters of row j.
+    The description is O(num_envs * horizon * action_dim) however large the population, so that it can be sent
+    to rollout workers which sample their own rows, and the same rows come out whichever process samples them.
+
+    Rows are numbered b * num_traj + j. The first rows of an environment may be replaced by action sequences
+    carried over from the previous control step.
+    """
+
+    def __init__(self, means, stds, low, high, keys, num_traj, carried_seqs=None):
+        """
+        Parameters
+        ----------
+        means : np.ndarray
+            (num_envs, horizon, action_dim) array of mean action sequences
+        stds : float or np.ndarray
+            Stdev of the noise, broadcastable to means
+        low : np.ndarray
+            (action_dim,) lower action bounds
+        high : np.ndarray
+            (action_dim,) upper action bounds
+        keys : np.ndarray
+            (num_envs, 2) uint64 array of the Philox keys of the environments
+        num_traj : int
+            Number of action sequences per environment
+        carried_seqs : list
+            (num_carry, horizon, action_dim) array of each environment which replaces its first rows, or None
+        """
+        self.means = np.asarray(means, dtype=float)
+        self.stds = np.asarray(stds, dtype=float)
+        self.low = low
+        self.high = high
+        self.keys = np.asarray(keys, dtype=np.uint64)
+        self.num_traj = num_traj
+        self.carried_seqs = [None] * self.num_envs if carried_seqs is None else list(carried_seqs)
+
+    @property
+    def num_envs(self):
+        return self.means.shape[0]
+
+    @property
+    def seq_shape(self):
+        return self.means.shape[1:]
+
+    def uniforms(self, b, start, end):
+        """
+        Return the (end - start, horizon, action_dim) uniform samples of rows start:end of environment b.
+        """
+        # Philox produces four doubles per counter, so each row starts at a counter of its own
+        seq_size = int(np.prod(self.seq_shape))
+        blocks = -(-seq_size // 4)
+        bit_generator = np.random.Philox(key=self.keys[b]).advance(start * blocks)
+        u = np.random.Generator(bit_generator).random((end - start, 4 * blocks))
+        return u[:, :seq_size].reshape((end - start,) + self.seq_shape)
+
+    def sample(self, start, end):
+        """
+        Return rows start:end of the population as a (end - start, horizon, action_dim) array.
+        """
+        return self.rows(np.arange(start, end))
+
+    def rows(self, rows):
+        """
+        Return the given rows of the population as a (len(rows), horizon, action_dim) array.
+        """
+        rows = np.asarray(rows, dtype=int)
+        action_seqs = np.empty((len(rows),) + self.seq_shape)
+        if len(rows) == 0:
+            return action_seqs
+
+        # Generate each run of consecutive rows of an environment with a single generator
+        breaks = np.flatnonzero((np.diff(rows) != 1) | (np.diff(rows // self.num_traj) != 0)) + 1
+        for run in np.split(np.arange(len(rows)), breaks):
+            b, start = divmod(int(rows[run[0]]), self.num_traj)
+            end = start + len(run)
+            std = np.broadcast_to(self.stds, self.means.shape)[b]
+            action_seqs[run] = sample_truncated_normal(self.means[b], std, self.low, self.high,
+                                                       (len(run),) + self.seq_shape, u=self.uniforms(b, start, end))
+            if self.carried_seqs[b] is not None:
+                num_carry = min(self.carried_seqs[b].shape[0], self.num_traj)
+                carried = np.arange(start, min(end, num_carry))
+                action_seqs[run[carried - start]] = self.carried_seqs[b][-num_carry:][carried]
+        return action_seqs
+
+    def env_index(self, rows):
+        """
+        Return the environment of each of the given rows.
+        """
+        return np.asarray(rows) // self.num_traj
+
+
+class SampledPopulation:
+    """
+    An array-like view of the rows of a PopulationStream, of shape (num_traj, horizon, action_dim) for one
+    environment or (num_envs, num_traj, horizon, action_dim) for several. Slicing returns another view,
+    while any other indexing (or conversion with np.asarray) generates the selected action sequences, so that
+    a planner only rebuilds the sequences it needs, e.g. the best one or the elites.
+    """
+
+    def __init__(self, stream, rows):
+        """
+        Parameters
+        ----------
+        stream : PopulationStream
+        rows : np.ndarray
+            Integer array of the stream rows in view, e.g. np.arange(num_traj) or
+            np.arange(num_envs * num_traj).reshape(num_envs, num_traj)
+        """
+        self.stream = stream
+        self.rows = rows
+
+    @property
+    def shape(self):
+        return self.rows.shape + self.stream.seq_shape
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def contiguous_range(self):
+        """
+        Return the (start, end) bounds of the stream rows in view if they are consecutive, else None.
+        """
+        rows = self.rows.ravel()
+        if len(rows) == 0 or np.any(np.diff(rows) != 1):
+            return None
+        return int(rows[0]), int(rows[-1]) + 1
+
+    def reshape(self, *shape):
+        return SampledPopulation(self.stream, self.rows.reshape(*shape))
+
+    def __getitem__(self, key):
+        key = key if isinstance(key, tuple) else (key,)
+        lead, trailing = key[:self.rows.ndim], key[self.rows.ndim:]
+        rows = self.rows[lead]
+        if not trailing and np.ndim(rows) > 0 and all(isinstance(k, (int, np.integer, slice)) for k in lead):
+            return SampledPopulation(self.stream, rows)
+        action_seqs = self.stream.rows(np.ravel(rows)).reshape(np.shape(rows) + self.stream.seq_shape)
+        return action_seqs[(slice(None),) * np.ndim(rows) + trailing]
+
+    def __array__(self, dtype=None, copy=None):
+        action_seqs = self.stream.rows(self.rows.ravel()).reshape(self.shape)
+        return action_seqs if dtype is None else action_seqs.astype(dtype)
@@ -0,0 +1,311 @@
+import multiprocessing
+import os
+import pickle
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+from src.control.precision import export_low_precision
+
+try:
+    import cloudpickle
+except ImportError:
+    cloudpickle = None
+
+
+def dense_strides(x):
+    """
+    Return the strides of 'x' if its elements fill a block of x.nbytes bytes (in any axis order, e.g. C or
+    FORTRAN order or a stack of FORTRAN matrices), else the strides of a C-contiguous copy.
+    """
+    expected = x.itemsize
+    for axis in np.argsort(x.strides):
+        if x.shape[axis] == 1:
+            continue
+        if x.strides[axis] != expected:
+            return x.itemsize * np.cumprod((x.shape[1:] + (1,))[::-1])[::-1]
+        expected *= x.shape[axis]
+    return x.strides
+
+
+class SharedArena:
+    """
+    A block of shared memory holding numpy arrays at fixed offsets. The layout of the arrays is a list of
+    (key, offset, shape, dtype, strides) entries, which is all another process needs to view them in place.
+    """
+
+    def __init__(self, size):
+        self.shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    @property
+    def size(self):
+        return self.shm.size
+
+    @staticmethod
+    def plan_layout(arrays):
+        """
+        Return the layout of the (key, array) pairs 'arrays' packed one after the other (64-byte aligned),
+        and the number of bytes it needs.
+        """
+        layout = []
+        offset = 0
+        for key, x in arrays:
+            layout.append((key, offset, x.shape, x.dtype.str, tuple(int(s) for s in dense_strides(x))))
+            offset += -(-x.nbytes // 64) * 64
+        return layout, offset
+
+    def views(self, layout):
+        return view_layout(self.shm, layout)
+
+    def write(self, layout, arrays):
+        for view, (key, x) in zip(self.views(layout).values(), arrays):
+            view[...] = x
+
+    def close(self):
+        self.shm.close()
+        self.shm.unlink()
+
+
+def view_layout(shm, layout):
+    """
+    Return a dict mapping each key of 'layout' to a numpy view of its array in the SharedMemory 'shm'.
+    """
+    return {key: np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf, offset=offset, strides=strides)
+            for key, offset, shape, dtype, strides in layout}
+
+
+def flatten_nn_params(nn_params):
+    """
+    Split nn_params into a list of ('stack/w1', array)-style pairs and a dict of its other (non-array) entries,
+    e.g. the low precision torch module.
+    """
+    arrays = []
+    extras = {}
+    for key, value in nn_params.items():
+        if key == 'stack':
+            arrays += [('stack/' + name, np.asarray(x)) for name, x in value.items()]
+        elif isinstance(value, np.ndarray):
+            arrays.append((key, value))
+        else:
+            extras[key] = value
+    return arrays, extras
+
+
+def unflatten_nn_params(views, extras):
+    nn_params = dict(extras)
+    nn_params['stack'] = {}
+    for key, x in views.items():
+        if key.startswith('stack/'):
+            nn_params['stack'][key[len('stack/'):]] = x
+        else:
+            nn_params[key] = x
+    return nn_params
+
+
+def shared_memory_worker(conn, payload):
+    """
+    Main loop of a worker process of a SharedMemoryWorkerPool. Every request names the shared memory blocks and
+    the layout of the arrays it refers to, so the worker reads its slice of the action sequences and the
+    weights in place, and writes its returns directly into the shared output array.
+
+    'payload' is the pickled (mpc_params, reward, terminate) of the worker.
+    """
+    from src.control.mpc import RolloutWorker
+    worker = RolloutWorker(*pickle.loads(payload))
+    segments = {}
+
+    def attach(kind, name):
+        # The pool replaces a block with a larger one when it runs out of space
+        if kind in segments and segments[kind].name != name:
+            detach(segments.pop(kind))
+        if kind not in segments:
+            segments[kind] = shared_memory.SharedMemory(name=name)
+        return segments[kind]
+
+    while True:
+        request = pickle.loads(conn.recv_bytes())
+        if request is None:
+            break
+        try:
+            if request[0] == 'weights':
+                name, layout, extras = request[1:]
+                worker.set_nn_params(unflatten_nn_params(view_layout(attach('weights', name), layout), extras))
+            elif request[0] == 'population':
+                name, layout, states0, stream, start, end, offset = request[1:]
+                views = view_layout(attach('data', name), layout)
+                views['rets'][start - offset:end - offset] = worker.rollout_population(states0, stream, start, end)
+            else:
+                name, layout, start, end = request[1:]
+                views = view_layout(attach('data', name), layout)
+                state0 = views['state0']
+                if state0.shape[0] > 1:
+                    state0 = state0[start:end]
+                views['rets'][start:end] = worker.rollout(state0[0] if state0.shape[0] == 1 else state0,
+                                                          views['action_seqs'][start:end])
+            conn.send_bytes(pickle.dumps(None))
+        except Exception as e:
+            conn.send_bytes(pickle.dumps(e))
+    worker.nn_params = None
+    worker.kernel = None
+    for segment in segments.values():
+        detach(segment)
+
+
+def detach(segment):
+    try:
+        segment.close()
+    except BufferError:
+        # Views of the block are still alive, it is unmapped when they are garbage collected
+        pass
+
+
+class SharedMemoryWorkerPool:
+    """
+    A pool of long-lived worker processes which exchange action sequences, start states, returns and dynamics
+    weights through shared memory instead of pickling them. Each control step only sends every worker a small
+    message with the bounds of its slice; the weights are written to shared memory when the model's version
+    changes. Has the same interface as mpc.RolloutWorkerPool, but needs no Ray.
+
+    Workers are started by a fork server (or spawned where there is none) rather than forked from the
+    planning process, whose threads (an AsyncDynamicsLearner, torch's OpenMP pool, a PrefetchLoader) may hold
+    locks a forked child would inherit and wait on forever. The reward and termination functions are sent with
+    cloudpickle if it is installed, so closures work; otherwise they must be picklable.
+    """
+
+    def __init__(self, num_workers, mpc_params, reward, terminate):
+        """
+        Parameters
+        ----------
+        num_workers : int
+            Defaults to os.cpu_count() if None.
+        mpc_params : dict
+        reward : function
+        terminate : function
+        """
+        from src.control.mpc import split_seeds
+        num_workers = os.cpu_count() if num_workers is None else num_workers
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+        if context.get_start_method() == 'forkserver':
+            # The fork server imports the rollout code once, so that starting each worker is cheap
+            context.set_forkserver_preload(['src.control.mpc'])
+        dumps = pickle.dumps if cloudpickle is None else cloudpickle.dumps
+
+        # Workers must share the parent's resource tracker, or theirs would unlink the blocks they attach to
+        resource_tracker.ensure_running()
+        self.conns = []
+        self.processes = []
+        for worker_params in split_seeds(mpc_params, num_workers):
+            parent_conn, child_conn = context.Pipe()
+            process = context.Process(target=shared_memory_worker,
+                                      args=(child_conn, dumps((worker_params, reward, terminate))), daemon=True)
+            process.start()
+            child_conn.close()
+            self.conns.append(parent_conn)
+            self.processes.append(process)
+        self.folded = mpc_params.get('batched', False) or mpc_params.get('backend', 'numpy') != 'numpy'
+        self.precision = mpc_params.get('precision', 'float32')
+        self.version = None
+        self.weights = None
+        self.data = None
+        self.bytes_sent = 0
+
+    def request(self, messages):
+        """
+        Send one message to each worker and wait for all of them to finish, raising the first worker error.
+        """
+        for conn, message in zip(self.conns, messages):
+            payload = pickle.dumps(message)
+            self.bytes_sent += len(payload)
+            conn.send_bytes(payload)
+        errors = [pickle.loads(conn.recv_bytes()) for conn in self.conns[:len(messages)]]
+        for error in errors:
+            if error is not None:
+                raise error
+
+    def sync(self, model):
+        """
+        Write the weights of 'model' to shared memory if they have changed since the last sync.
+        """
+        if model.version == self.version:
+            return
+        if self.folded:
+            nn_params = export_low_precision(model, self.precision)
+        else:
+            nn_params = model.create_nn_params()
+        arrays, extras = flatten_nn_params(nn_params)
+        layout, size = SharedArena.plan_layout(arrays)
+
+        # Workers only read the weights during rollout(), so the block can be overwritten in place
+        old_weights = None
+        if self.weights is None or self.weights.size < size:
+            old_weights, self.weights = self.weights, SharedArena(size)
+        self.weights.write(layout, arrays)
+        self.request([('weights', self.weights.name, layout, extras)] * len(self.conns))
+        if old_weights is not None:
+            old_weights.close()
+        self.version = model.version
+
+    def reserve_data(self, size):
+        """
+        Return the block of shared memory for rollout data, replaced by a larger one if it has less than 'size'
+        bytes.
+        """
+        if self.data is None or self.data.size < size:
+            if self.data is not None:
+                self.data.close()
+            self.data = SharedArena(size)
+        return self.data
+
+    def rollout(self, state0, action_seqs):
+        """
+        Split 'action_seqs' (and per-sequence start states) evenly across the workers and return the (num_traj,)
+        array of returns.
+        """
+        num_traj = action_seqs.shape[0]
+        state0 = np.asarray(state0, dtype=float)
+        state0 = state0.reshape(-1, state0.shape[-1])
+        arrays = [('action_seqs', np.asarray(action_seqs, dtype=float)), ('state0', state0),
+                  ('rets', np.zeros(num_traj))]
+        layout, size = SharedArena.plan_layout(arrays)
+        views = self.reserve_data(size).views(layout)
+        views['action_seqs'][...] = action_seqs
+        views['state0'][...] = state0
+
+        bounds = np.linspace(0, num_traj, len(self.conns) + 1).astype(int)
+        self.request([('rollout', self.data.name, layout, bounds[i], bounds[i + 1])
+                      for i in range(len(self.conns)) if bounds[i] < bounds[i + 1]])
+        return views['rets'].copy()
+
+    def rollout_population(self, states0, stream, start, end):
+        """
+        Split rows start:end of a population (see sampling.PopulationStream) evenly across the workers, which
+        sample their own rows, and return the (end - start,) array of returns. Only the population's description
+        is sent; the returns come back through shared memory.
+        """
+        layout, size = SharedArena.plan_layout([('rets', np.zeros(end - start))])
+        self.reserve_data(size)
+        bounds = np.linspace(start, end, len(self.conns) + 1).astype(int)
+        self.request([('population', self.data.name, layout, states0, stream, int(bounds[i]), int(bounds[i + 1]),
+                       start) for i in range(len(self.conns)) if bounds[i] < bounds[i + 1]])
+        return self.data.views(layout)['rets'].copy()
+
+    def shutdown(self):
+        for conn in self.conns:
+            try:
+                conn.send_bytes(pickle.dumps(None))
+            except (BrokenPipeError, OSError):
+                pass
+        for process in self.processes:
+            process.join()
+        for arena in [self.weights, self.data]:
+            if arena is not None:
+                arena.close()
+        self.conns = []
+        self.processes = []
+        self.weights = None
+        self.data = None
@@ -0,0 +1,93 @@
+import warnings
+
+import numpy as np
+import torch
+
+
+class TorchRolloutKernel:
+    """
+    Rolls out a batch of action sequences with the whole horizon loop in a single torch function:
+    the folded dynamics network, residual, reward, discounting and termination masking of every
+    trajectory, without per-timestep NumPy <-> torch copies. With compile=True the function is
+    compiled with torch.compile, falling back to eager execution if compilation fails.
+
+    The reward and termination functions are called with torch tensors, so they must be written
+    with operations that torch tensors support (e.g. 'x.sum(axis=1)' rather than 'np.sum(x, axis=1)').
+    """
+
+    def __init__(self, mpc_params, reward_batch, terminate_batch, compile=False):
+        """
+        Parameters
+        ----------
+        mpc_params : dict
+        reward_batch : function
+            Batched reward taking (N, state_dim) and (N, action_dim) tensors and returning an (N,) tensor.
+        terminate_batch : function
+            Batched termination condition taking (N, state_dim) and (N, action_dim) tensors and a
+            timestep, and returning an (N,) boolean tensor. May be None.
+        compile : bool
+        """
+        self.horizon = mpc_params['horizon']
+        self.discounts = torch.tensor([mpc_params['gamma'] ** t for t in range(self.horizon)], dtype=torch.float64)
+        self.reward_batch = reward_batch
+        self.terminate_batch = terminate_batch
+        self.nn_params = None
+        self.stack = None
+        self.rollout_fn = self.rollout
+        if compile:
+            self.rollout_fn = torch.compile(self.rollout)
+        self.compiled = compile
+
+    def set_nn_params(self, nn_params):
+        """
+        Load the weights of folded nn_params, see DynamicsModel.create_folded_nn_params().
+        """
+        if 'num_members' in nn_params or 'module' in nn_params:
+            raise ValueError("The torch rollout backends only support float32 single models")
+        self.nn_params = nn_params
+        stack = nn_params['stack']
+        self.stack = [torch.from_numpy(np.ascontiguousarray(stack[key], dtype=np.float32))
+                      for key in ['w1', 'b1', 'w2', 'b2', 'w3', 'b3']]
+
+    def __call__(self, state0, action_seqs):
+        """
+        Parameters
+        ----------
+        state0 : np.ndarray
+            (state_dim,) start state, or (num_traj, state_dim) array with the start state of each sequence
+        action_seqs : np.ndarray
+            (num_traj, horizon, action_dim) array of action sequences
+
+        Return
+        ------
+        np.ndarray: (num_traj,) array of rollout returns
+        """
+        state0 = torch.from_numpy(np.asarray(state0, dtype=np.float64))
+        action_seqs = torch.from_numpy(np.asarray(action_seqs, dtype=np.float64))
+        with torch.inference_mode():
+            if self.compiled:
+                try:
+                    return self.rollout_fn(state0, action_seqs, *self.stack).numpy()
+                except Exception as e:
+                    warnings.warn("torch.compile failed, using eager rollouts: {}".format(e))
+                    self.rollout_fn = self.rollout
+                    self.compiled = False
+            return self.rollout_fn(state0, action_seqs, *self.stack).numpy()
+
+    def rollout(self, state0, action_seqs, w1, b1, w2, b2, w3, b3):
+        num_traj = action_seqs.shape[0]
+        states = state0.expand(num_traj, state0.shape[-1])
+        alive = torch.ones(num_traj, dtype=torch.bool)
+        rets = torch.zeros(num_traj, dtype=torch.float64)
+        for t in range(self.horizon):
+            actions = action_seqs[:, t, :]
+            rets = rets + self.discounts[t] * self.reward_batch(states, actions) * alive
+            if self.terminate_batch is not None:
+                alive = alive & ~self.terminate_batch(states, actions, t)
+
+            # The normalization is folded into the weights, and the output is next_state - state
+            x = torch.cat((states, actions), dim=1).float()
+            h = torch.relu(torch.addmm(b1, x, w1.T))
+            h = torch.relu(torch.addmm(b2, h, w2.T))
+            states = states + torch.addmm(b3, h, w3.T)
+        return rets
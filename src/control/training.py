@@ -0,0 +1,268 @@
+import copy
+import threading
+import time
+
+import numpy as np
+import torch
+
+from src.control.data_loader import PrefetchLoader
+
+
+class DynamicsTrainer:
+    """
+    Fits a dynamics model to the transitions in a ReplayBuffer. Each call to fit() either runs a fixed
+    number of gradient steps, or a number of epochs over the buffer with early stopping on the
+    validation MSE of the buffer's held-out transitions.
+    """
+
+    def __init__(self, model, optimizer, loss, replay_buffer, batch_size, train_steps=4, train_epochs=None,
+                 patience=None, min_delta=0., prefetch=2, device=torch.device("cpu")):
+        """
+        Parameters
+        ----------
+        model : DynamicsModel or EnsembleDynamicsModel
+        optimizer : torch.optim.Optimizer
+        loss : torch.nn.Module
+        replay_buffer : ReplayBuffer
+        batch_size : int
+        train_steps : int
+            Number of gradient steps per call to fit(), if train_epochs is None.
+        train_epochs : int
+            If given, maximum number of passes over the buffer per call to fit(). An epoch is
+            len(replay_buffer) // batch_size gradient steps.
+        patience : int
+            Stop after this many epochs without the validation MSE improving by more than 'min_delta',
+            and restore the weights with the best validation MSE. Only used with train_epochs, and only
+            once the replay buffer holds validation data.
+        min_delta : float
+        prefetch : int
+            Number of minibatches prepared ahead on a background thread.
+        device : torch.device
+        """
+        self.model = model
+        self.optimizer = optimizer
+        self.loss = loss
+        self.replay_buffer = replay_buffer
+        self.batch_size = batch_size
+        self.train_steps = train_steps
+        self.train_epochs = train_epochs
+        self.patience = patience
+        self.min_delta = min_delta
+        self.prefetch = prefetch
+        self.device = device
+
+    def fit(self, rl_prop=0, seed=None):
+        """
+        Train the model on the replay buffer.
+
+        Parameters
+        ----------
+        rl_prop : float in [0, 1]
+            Fraction of samples that come from MPC transitions, see ReplayBuffer.sample.
+        seed : int or np.random.SeedSequence
+            Seed for sampling minibatches.
+
+        Return
+        ------
+        dict with the number of gradient steps and epochs run, the mean training loss of the last epoch,
+        the best validation MSE (None without validation data), whether training stopped early, and
+        the training throughput in samples/sec.
+        """
+        seed_sequence = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+        if self.train_epochs is None:
+            num_epochs = 1
+            steps_per_epoch = self.train_steps
+        else:
+            num_epochs = self.train_epochs
+            steps_per_epoch = max(len(self.replay_buffer) // self.batch_size, 1)
+
+        stats = {'steps': 0, 'epochs': 0, 'train_loss': None, 'val_loss': None, 'stopped_early': False}
+        best_state_dict = None
+        bad_epochs = 0
+        num_samples = 0
+        train_time = 0.
+        for epoch in range(num_epochs):
+            start_time = time.perf_counter()
+            loss_sum = 0.
+            loader = PrefetchLoader(self.replay_buffer, self.batch_size, steps_per_epoch, rl_prop,
+                                    prefetch=self.prefetch, seed=seed_sequence.spawn(1)[0],
+                                    pin_memory=self.device.type == 'cuda')
+            with loader:
+                for input, target in loader:
+                    input = input.to(self.device, non_blocking=True)
+                    target = target.to(self.device, non_blocking=True)
+                    self.optimizer.zero_grad()
+                    loss = self.model.training_loss(input, target, self.loss)
+                    loss.backward()
+                    self.optimizer.step()
+                    loss_sum += loss.item()
+                    num_samples += input.shape[0]
+                    stats['steps'] += 1
+            train_time += time.perf_counter() - start_time
+            stats['epochs'] += 1
+            stats['train_loss'] = loss_sum / steps_per_epoch
+
+            val_loss = self.validate()
+            if val_loss is None:
+                continue
+            if stats['val_loss'] is None or val_loss < stats['val_loss'] - self.min_delta:
+                stats['val_loss'] = val_loss
+                bad_epochs = 0
+                if self.patience is not None:
+                    best_state_dict = copy.deepcopy(self.model.state_dict())
+            else:
+                bad_epochs += 1
+                if self.patience is not None and bad_epochs >= self.patience:
+                    stats['stopped_early'] = epoch + 1 < num_epochs
+                    break
+
+        if best_state_dict is not None and bad_epochs > 0:
+            self.model.load_state_dict(best_state_dict)
+        self.model.increment_version()
+        stats['samples_per_sec'] = num_samples / train_time if train_time > 0 else 0.
+        return stats
+
+    def validate(self):
+        """
+        Return the MSE of the model on the replay buffer's held-out transitions, or None if there are none.
+        """
+        batch = self.replay_buffer.validation_batch()
+        if batch is None:
+            return None
+        state, action, d_state = batch
+        input = torch.from_numpy(np.concatenate((state, action), axis=1)).float().to(self.device)
+        target = torch.from_numpy(d_state).float().to(self.device)
+        with torch.no_grad():
+            return self.loss(self.model.predict(input), target).item()
+
+
+class AsyncDynamicsLearner:
+    """
+    Runs DynamicsTrainer.fit() over and over on a background thread while transitions are being collected,
+    publishing a snapshot of the model's state_dict after every call. Each snapshot has a version, the number
+    of fit() calls it includes, so that collectors can tell how stale the weights they plan with are and
+    refresh their copy of the model with sync().
+
+    Use as a context manager so that the background thread is always shut down:
+
+        with AsyncDynamicsLearner(trainer, min_buffer_size) as learner:
+            ...
+            version = learner.sync(policy_model, version, max_staleness)
+    """
+
+    def __init__(self, trainer, min_buffer_size=0, before_fit=None, max_updates_per_episode=1, seed=None):
+        """
+        Parameters
+        ----------
+        trainer : DynamicsTrainer
+            Its model must not be used by other threads while the learner is running, use sync() to copy
+            its weights into a separate model instead.
+        min_buffer_size : int
+            Training starts once the replay buffer holds more than this many transitions.
+        before_fit : function
+            If given, called with no arguments before each call to fit(), e.g. to update the model's
+            normalization statistics.
+        max_updates_per_episode : int
+            The learner waits whenever it has made this many calls to fit() per episode reported with
+            add_episodes(), so that it does not get arbitrarily far ahead of the data (and leaves the CPU to the
+            collectors when it does). If None, it trains continuously.
+        seed : int or np.random.SeedSequence
+            Seed for sampling minibatches.
+        """
+        self.trainer = trainer
+        self.min_buffer_size = min_buffer_size
+        self.before_fit = before_fit
+        self.max_updates_per_episode = max_updates_per_episode
+        self.num_episodes = 0
+        self.seed_sequence = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+        self.rl_prop = 0
+        self.version = 0
+        self.snapshot = None
+        self.train_stats = None
+        self.error = None
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def run(self):
+        try:
+            while not self.stop_event.is_set():
+                if len(self.trainer.replay_buffer) <= self.min_buffer_size or self.ahead_of_data():
+                    self.stop_event.wait(0.01)
+                    continue
+                if self.before_fit is not None:
+                    self.before_fit()
+                stats = self.trainer.fit(self.rl_prop, seed=self.seed_sequence.spawn(1)[0])
+                self.publish(stats)
+        except Exception as e:
+            self.error = e
+
+    def ahead_of_data(self):
+        return self.max_updates_per_episode is not None and \
+            self.version >= self.max_updates_per_episode * self.num_episodes
+
+    def add_episodes(self, num_episodes=1):
+        """
+        Report that 'num_episodes' more episodes were collected, see max_updates_per_episode.
+        """
+        self.num_episodes += num_episodes
+
+    def publish(self, stats):
+        snapshot = {key: value.detach().clone() for key, value in self.trainer.model.state_dict().items()}
+        with self.lock:
+            self.snapshot = snapshot
+            self.train_stats = stats
+            self.version += 1
+
+    def latest(self):
+        """
+        Return the version and state_dict of the latest snapshot (None before the first one), and the stats of
+        the fit() call that produced it. Raises the exception the background thread stopped with, if any.
+        """
+        if self.error is not None:
+            raise self.error
+        with self.lock:
+            return self.version, self.snapshot, self.train_stats
+
+    def sync(self, model, version, max_staleness=0):
+        """
+        Load the latest snapshot into 'model' if the one it holds is more than 'max_staleness' versions old.
+
+        Parameters
+        ----------
+        model : DynamicsModel or EnsembleDynamicsModel
+            A separate copy of the trainer's model, e.g. the model an MPC plans with.
+        version : int
+            Version of the snapshot 'model' currently holds (0 for none).
+        max_staleness : int
+
+        Return
+        ------
+        int: the version of the snapshot 'model' holds after the call.
+        """
+        latest_version, snapshot, stats = self.latest()
+        if snapshot is None or latest_version - version <= max_staleness:
+            return version
+        model.load_state_dict(snapshot)
+        return latest_version
+
+    def close(self):
+        """
+        Stop the background thread once the current call to fit() returns.
+        """
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
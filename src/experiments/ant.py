@@ -21,10 +21,19 @@ def reward(state, action):
     return x_vel + 0.5 - 0.5 / 8 * np.linalg.norm(action) ** 2
 
 
+def reward_batch(states, actions):
+    x_vel = states[:, 13]
+    return x_vel + 0.5 - 0.5 / 8 * (actions ** 2).sum(axis=1)
+
+
 def terminate(state, action, t):
     return state[0] < 0.2 or state[0] > 1.0
 
 
+def terminate_batch(states, actions, t):
+    return (states[:, 0] < 0.2) | (states[:, 0] > 1.0)
+
+
 def ant():
     state_dim = 27
     action_dim = 8
@@ -46,7 +55,9 @@ def ant():
     print("Number of workers: ", num_workers)
     ray.init(num_cpus=num_workers)
 
-    mpc = MPC(model, num_traj, gamma, horizon, reward, terminate, True)
+    mpc = MPC(model, num_traj, gamma, horizon, reward, terminate, True, batched=True,
+              reward_batch=reward_batch, terminate_batch=terminate_batch,
+              action_low=-0.3, action_high=0.3)
 
     start_time = time.time()
     MBRLLearner.static_eval_model(env, episode_len, mpc, gamma, reward_func=reward, terminate_func=terminate)
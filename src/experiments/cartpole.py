@@ -8,6 +8,19 @@ from src.constants import MODELS_PATH
 import os
 
 
+class DiscreteActionPolicy:
+    """
+    CartPole-v1 has a Discrete(2) action space, so the MPC plans a continuous action in [0, 1] which is
+    mapped to pushing the cart left (0) or right (1).
+    """
+
+    def __init__(self, policy):
+        self.policy = policy
+
+    def plan(self, state0):
+        return int(self.policy.plan(state0)[0] > 0.5)
+
+
 def cartpole():
     state_dim = 4
     action_dim = 1
@@ -29,12 +42,20 @@ def cartpole():
         else:
             return False
 
+    def reward_batch(states, actions):
+        return np.ones(states.shape[0])
+
+    def terminate_batch(states, actions, t):
+        return (t >= 500) | (np.abs(states[:, 0]) > 2.4) | (np.abs(states[:, 2]) > 0.2)
+
     num_traj = 30
     gamma = 0.999
     horizon = 15
-    mpc = MPC(model, num_traj, gamma, horizon, reward, terminate)
+    mpc = MPC(model, num_traj, gamma, horizon, reward, terminate,
+              reward_batch=reward_batch, terminate_batch=terminate_batch,
+              action_low=0., action_high=1.)
 
-    MBRLLearner.static_eval_model(env, episode_len, mpc, gamma)
+    MBRLLearner.static_eval_model(env, episode_len, DiscreteActionPolicy(mpc), gamma)
 
 
 if __name__ == "__main__":
@@ -26,6 +26,12 @@ def reward(state, action):
     return - (angle_normalize(th) ** 2 + 0.1 * thdot ** 2 + 0.001 * (u ** 2))
 
 
+def reward_batch(states, actions):
+    th = states[:, 0]
+    thdot = states[:, 1]
+    return - (angle_normalize(th) ** 2 + 0.1 * thdot ** 2 + 0.001 * (actions ** 2).sum(axis=1))
+
+
 def pendulum():
     state_dim = 2
     action_dim = 1
@@ -44,7 +50,8 @@ def pendulum():
     print("Number of workers: ", num_workers)
     ray.init(num_cpus=num_workers)
 
-    mpc = MPC(model, num_traj, gamma, horizon, reward, multithreading=True)
+    mpc = MPC(model, num_traj, gamma, horizon, reward, multithreading=True, batched=True, reward_batch=reward_batch,
+              action_low=-2.0, action_high=2.0)
 
     start_time = time.time()
     MBRLLearner.static_eval_model(env, episode_len, mpc, gamma)
@@ -0,0 +1,81 @@
+import numpy as np
+import torch
+import gymnasium as gym
+from src.control.mpc import MPC
+from src.control.dynamics import DynamicsModel
+from src.control.mbrl import MBRLLearner
+from src.constants import MODELS_PATH
+from src.experiments import ant, pendulum
+import os
+
+import time
+
+
+def compare_planners(env, model, episode_len, gamma, horizon, reward, terminate, reward_batch, terminate_batch,
+                     budgets, action_low, action_high, num_iters=5, noise_scale=1.0, num_carry=0):
+    """
+    Evaluate one episode with each planner for each budget, where a budget is the number of
+    trajectories rolled out per control step. The iterative planners split their budget
+    evenly over their iterations. 'num_carry' best sequences of each control step are carried
+    into the next (see MPC), which lets smaller budgets keep their return.
+
+    Return
+    ------
+    list of tuple: (planner, rollouts per step, return, seconds per step)
+    """
+    results = []
+    for planner in ['random_shooting', 'cem', 'mppi']:
+        for budget in budgets:
+            iters = 1 if planner == 'random_shooting' else num_iters
+            num_traj = max(budget // iters, 1)
+            planner_params = {'num_iters': iters, 'num_elites': max(num_traj // 8, 1),
+                              'num_carry': min(num_carry, num_traj)}
+            mpc = MPC(model, num_traj, gamma, horizon, reward, terminate, multithreading=False, batched=True,
+                      reward_batch=reward_batch, terminate_batch=terminate_batch,
+                      planner=planner, planner_params=planner_params, noise_scale=noise_scale,
+                      action_low=action_low, action_high=action_high)
+
+            start_time = time.time()
+            ret = MBRLLearner.static_eval_model(env, episode_len, mpc, gamma, reward_func=reward,
+                                                terminate_func=terminate)
+            num_steps = max(mpc.num_rollouts / (num_traj * iters), 1)
+            results.append((planner, num_traj * iters, ret, (time.time() - start_time) / num_steps))
+
+    print("{:>16} | {:>16} | {:>10} | {:>14}".format('planner', 'rollouts / step', 'return', 'sec / step'))
+    for planner, rollouts, ret, sec in results:
+        print("{:>16} | {:>16} | {:>10.2f} | {:>14.4f}".format(planner, rollouts, float(np.squeeze(ret)), sec))
+    return results
+
+
+def pendulum_planners():
+    state_dim = 2
+    action_dim = 1
+    env = gym.make("Pendulum-v1")
+
+    model = DynamicsModel(state_dim, action_dim, normalize=True)
+    model.load_state_dict(torch.load(os.path.join(MODELS_PATH, "pend_demo_256.pt")))
+
+    return compare_planners(env, model, episode_len=200, gamma=0.95, horizon=15,
+                            reward=pendulum.reward, terminate=None,
+                            reward_batch=pendulum.reward_batch, terminate_batch=None,
+                            budgets=[128, 256, 512, 1024], action_low=-2.0, action_high=2.0)
+
+
+def ant_planners():
+    state_dim = 27
+    action_dim = 8
+    env = gym.make("Ant-v4")
+
+    save_name = "ant-task-4-9-run0"
+    model = DynamicsModel(state_dim, action_dim, normalize=True)
+    model.load_state_dict(torch.load(os.path.join(MODELS_PATH, save_name, save_name + '.pt')))
+
+    return compare_planners(env, model, episode_len=200, gamma=0.99, horizon=15,
+                            reward=ant.reward, terminate=ant.terminate,
+                            reward_batch=ant.reward_batch, terminate_batch=ant.terminate_batch,
+                            budgets=[128, 256, 512, 1024], action_low=-0.3, action_high=0.3)
+
+
+if __name__ == "__main__":
+    pendulum_planners()
+    ant_planners()
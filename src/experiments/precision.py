@@ -0,0 +1,40 @@
+import numpy as np
+import torch
+from src.control.dynamics import DynamicsModel
+from src.control.precision import precision_report
+from src.constants import MODELS_PATH
+import os
+
+
+def print_precision_report(model, states, action_seqs):
+    """
+    Print the accuracy (against float32) and throughput of every inference precision.
+    """
+    report = precision_report(model, states, action_seqs)
+    print("{:>10} | {:>10} | {:>16} | {:>16} | {:>18}".format('precision', 'exported', 'one-step error',
+                                                               'H-step error', 'transitions / sec'))
+    for row in report:
+        print("{:>10} | {:>10} | {:>16.2e} | {:>16.2e} | {:>18.0f}".format(
+            row['precision'], row['exported_precision'], row['one_step_error'], row['horizon_error'],
+            row['transitions_per_sec']))
+    return report
+
+
+def ant_precision(num_traj=1024, horizon=15):
+    state_dim = 27
+    action_dim = 8
+
+    save_name = "ant-task-4-9-run0"
+    model = DynamicsModel(state_dim, action_dim, normalize=True)
+    model.load_state_dict(torch.load(os.path.join(MODELS_PATH, save_name, save_name + '.pt')))
+
+    # Start states drawn from the model's state distribution, and random actions within the Ant's bounds
+    state_mean = model.state_mean.detach().numpy()
+    state_std = np.sqrt(model.state_var.detach().numpy())
+    states = state_mean + state_std * np.random.normal(size=(num_traj, state_dim))
+    action_seqs = np.random.uniform(low=-0.3, high=0.3, size=(num_traj, horizon, action_dim))
+    return print_precision_report(model, states, action_seqs)
+
+
+if __name__ == "__main__":
+    ant_precision()
@@ -11,10 +11,19 @@ def reward(state, action):
     return x_vel + 0.5 - 0.5 / 8 * np.linalg.norm(action) ** 2
 
 
+def reward_batch(states, actions):
+    x_vel = states[:, 13]
+    return x_vel + 0.5 - 0.5 / 8 * (actions ** 2).sum(axis=1)
+
+
 def terminate(state, action, t):
     return state[0] < 0.2 or state[0] > 1.0
 
 
+def terminate_batch(states, actions, t):
+    return (states[:, 0] < 0.2) | (states[:, 0] > 1.0)
+
+
 def run_mbrl(num_times=1):
     """
     Parameters:
@@ -26,7 +35,9 @@ def run_mbrl(num_times=1):
     env_dict = {
         'state_dim': 27,
         'action_dim': 8,
-        'env': gym.make('Ant-v4')
+        'env': gym.make('Ant-v4'),
+        'action_low': -0.3,
+        'action_high': 0.3
     }
 
     train_dict = {
@@ -35,16 +46,20 @@ def run_mbrl(num_times=1):
         'episode_len': 200,
         'reward': reward,
         'terminate': terminate,
+        'reward_batch': reward_batch,
+        'terminate_batch': terminate_batch,
         'lr': 1e-3,
         'batch_size': 256,
         'rl_prop': 0.9,
-        'epsilon': 0.05
+        'epsilon': 0.05,
+        'contiguous_buffer': True
     }
 
     mpc_dict = {
         'num_traj': 1024,
         'gamma': 0.99,
-        'horizon': 15
+        'horizon': 15,
+        'batched': True
     }
 
     misc_dict = {
@@ -0,0 +1,79 @@
+from unittest import TestCase
+from src.control.collection import VectorEnvCollector
+from src.control.replay_buffer import ReplayBuffer
+import gymnasium as gym
+import numpy as np
+
+
+def make_pendulum():
+    return gym.make("Pendulum-v1")
+
+
+def make_short_pendulum():
+    return gym.make("Pendulum-v1", max_episode_steps=8)
+
+
+class TestCollection(TestCase):
+
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    def test_vector_env_collector(self):
+        """
+        Test that a round of episodes from several environments ends up in the replay buffer, and that
+        episodes stop at the custom termination condition.
+        """
+        num_envs = 3
+        episode_len = 20
+        replay_buffer = ReplayBuffer(3, 1)
+
+        def terminate(state, action, t):
+            return t >= 10
+
+        def random_policy(o, t, active):
+            self.assertEqual(o.shape, (num_envs, 3))
+            return np.random.uniform(-2, 2, size=(num_envs, 1))
+
+        def push_episode(i, states, actions, next_states, ret, ep_len):
+            replay_buffer.push_batch(states, actions, next_states, False)
+
+        for asynchronous in [False, True]:
+            collector = VectorEnvCollector(make_pendulum, num_envs, episode_len, 0.99, asynchronous=asynchronous)
+            try:
+                episodes = collector.collect(random_policy, 2, on_episode=push_episode)
+                self.assertEqual(len(episodes), 2)
+                for states, actions, next_states, ret, ep_len in episodes:
+                    self.assertEqual(states.shape, (episode_len, 3))
+                    self.assertEqual(actions.shape, (episode_len, 1))
+                    self.assertEqual(ep_len, episode_len)
+                    self.assertLess(ret, 0)
+
+                    # Consecutive transitions of an episode are chained
+                    self.assertTrue(np.allclose(states[1:], next_states[:-1]))
+            finally:
+                collector.close()
+
+            collector = VectorEnvCollector(make_pendulum, num_envs, episode_len, 0.99, terminate=terminate,
+                                           asynchronous=asynchronous)
+            try:
+                episodes = collector.collect(random_policy, num_envs, on_episode=push_episode)
+                self.assertEqual([ep_len for states, actions, next_states, ret, ep_len in episodes], [10] * num_envs)
+                self.assertTrue(all(states.shape[0] == 10 for states, actions, next_states, ret, ep_len in episodes))
+            finally:
+                collector.close()
+
+        self.assertEqual(len(replay_buffer), 2 * (2 * episode_len + num_envs * 10))
+
+        # Episodes the environment truncates end even if the custom condition does not hold, so that the
+        # observation it was reset to is not chained to the episode
+        collector = VectorEnvCollector(make_short_pendulum, num_envs, episode_len, 0.99,
+                                       terminate=lambda state, action, t: False, asynchronous=False)
+        try:
+            for states, actions, next_states, ret, ep_len in collector.collect(random_policy, num_envs):
+                self.assertEqual(ep_len, 7)
+                self.assertTrue(np.allclose(states[1:], next_states[:-1]))
+        finally:
+            collector.close()
@@ -0,0 +1,41 @@
+from unittest import TestCase
+from src.control.replay_buffer import ReplayBuffer
+from src.control.data_loader import PrefetchLoader
+import numpy as np
+import torch
+
+
+class TestDataLoader(TestCase):
+
+    def setUp(self):
+        self.replay_buffer = ReplayBuffer(state_dim=3, action_dim=2, max_size=1000, normalize=True, contiguous=True)
+        states = np.random.normal(size=(500, 3))
+        self.replay_buffer.push_batch(states, np.random.normal(size=(500, 2)), states + 0.1, False)
+
+    def tearDown(self):
+        pass
+
+    def test_prefetch_loader(self):
+        """
+        Test that the loader produces the requested number of float32 batches, reproducibly for a given seed.
+        """
+        batches = []
+        for i in range(2):
+            with PrefetchLoader(self.replay_buffer, batch_size=32, num_batches=10, prefetch=3, seed=7) as loader:
+                batches.append([(input.clone(), target.clone()) for input, target in loader])
+
+        self.assertTrue(len(batches[0]) == 10)
+        for (input_1, target_1), (input_2, target_2) in zip(batches[0], batches[1]):
+            self.assertTrue(input_1.shape == (32, 5) and target_1.shape == (32, 3))
+            self.assertTrue(input_1.dtype == torch.float32 and input_1.is_contiguous())
+            self.assertTrue(torch.equal(input_1, input_2) and torch.equal(target_1, target_2))
+
+    def test_early_close(self):
+        """
+        Test that leaving the loop early shuts the background thread down.
+        """
+        with PrefetchLoader(self.replay_buffer, batch_size=32, num_batches=1000, prefetch=2) as loader:
+            for i, (input, target) in enumerate(loader):
+                if i == 3:
+                    break
+        self.assertTrue(loader.thread is None)
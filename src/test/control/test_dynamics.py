@@ -9,6 +9,29 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 
+def forward_batch_static(stack, x):
+    """
+    Reference batched forward pass of the network 'stack' (as in DynamicsModel.create_nn_params()['stack'])
+    on the (num_traj, input_dim) array 'x'.
+    """
+    y = np.maximum(x @ stack['w1'].T + stack['b1'], 0)
+    y = np.maximum(y @ stack['w2'].T + stack['b2'], 0)
+    return y @ stack['w3'].T + stack['b3']
+
+
+def forward_np_batch_static(nn_params, states, actions):
+    """
+    Reference batched version of dynamics.forward_np_static, normalizing the inputs and denormalizing the
+    predicted next states outside the network.
+    """
+    state_std = np.sqrt(nn_params['state_var'])
+    n_states = (states - nn_params['state_mean']) / state_std
+    n_actions = (actions - nn_params['action_mean']) / np.sqrt(nn_params['action_var'])
+    x = np.concatenate((n_states, n_actions), axis=1)
+    n_next_states = forward_batch_static(nn_params['stack'], x) + n_states
+    return n_next_states * state_std + nn_params['state_mean']
+
+
 class TestDynamics(TestCase):
 
     def setUp(self):
@@ -107,3 +130,106 @@ class TestDynamics(TestCase):
         print(np.mean(nn_evals[-10:]))
         print("+++++++++++++++++++++++++")
         torch.save(model.state_dict(), PATH)
+
+    def test_rollout_workspace(self):
+        """
+        Test that stepping trajectories in a preallocated workspace with folded weights matches
+        forward_np_batch_static, including for batches smaller than the workspace.
+        """
+        from src.control.dynamics import RolloutWorkspace
+
+        state_dim = 5
+        action_dim = 3
+        model = DynamicsModel(state_dim, action_dim, normalize=True)
+        model.update_state_mean(np.random.normal(size=state_dim).astype(np.float32))
+        model.update_state_var(np.random.uniform(0.5, 2., size=state_dim).astype(np.float32))
+        model.update_action_mean(np.random.normal(size=action_dim).astype(np.float32))
+        model.update_action_var(np.random.uniform(0.5, 2., size=action_dim).astype(np.float32))
+        nn_params = model.create_nn_params()
+        folded_nn_params = model.create_folded_nn_params()
+
+        workspace = RolloutWorkspace(64, state_dim, action_dim, 512)
+        for num_traj in [64, 40, 1]:
+            states = np.random.normal(size=(num_traj, state_dim))
+            actions = np.random.normal(size=(num_traj, action_dim))
+            out = np.empty((num_traj, state_dim))
+            workspace.forward_np(folded_nn_params, states, actions, out)
+            expected = forward_np_batch_static(nn_params, states, actions)
+            self.assertTrue(np.max(np.abs(out - expected)) < 1e-4)
+
+    def test_folded_nn_params(self):
+        """
+        Test that the network with the normalization folded into its weights gives the same outputs
+        as forward_np and forward_np_static.
+        """
+        from src.control.dynamics import forward_np_static
+
+        state_dim = 6
+        action_dim = 2
+        for normalize in [True, False]:
+            model = DynamicsModel(state_dim, action_dim, normalize=normalize)
+            model.update_state_mean(np.random.normal(size=state_dim))
+            model.update_state_var(np.random.uniform(0.1, 5., size=state_dim))
+            model.update_action_mean(np.random.normal(size=action_dim))
+            model.update_action_var(np.random.uniform(0.1, 5., size=action_dim))
+            stack = model.create_folded_nn_params()['stack']
+
+            for i in range(10):
+                state = np.random.normal(size=state_dim)
+                action = np.random.normal(size=action_dim)
+                x = np.concatenate((state, action))[np.newaxis, :]
+                folded = state + forward_batch_static(stack, x)[0]
+                expected = model.forward_np(state, action)
+                self.assertTrue(np.max(np.abs(folded - expected)) < 1e-4)
+                if normalize:
+                    expected = forward_np_static(model.create_nn_params(), np.copy(state), action)
+                    self.assertTrue(np.max(np.abs(folded - expected)) < 1e-4)
+
+    def test_ensemble_model(self):
+        """
+        Test that every member of an ensemble is stepped by the folded rollout workspace exactly as by
+        torch, and that training the stacked members lowers their loss.
+        """
+        from src.control.dynamics import EnsembleDynamicsModel, rollout_workspace, ensemble_members
+
+        state_dim = 4
+        action_dim = 2
+        num_members = 3
+        model = EnsembleDynamicsModel(state_dim, action_dim, normalize=True, num_members=num_members,
+                                      hidden_dim=32)
+        model.update_state_mean(np.random.normal(size=state_dim).astype(np.float32))
+        model.update_state_var(np.random.uniform(0.5, 2., size=state_dim).astype(np.float32))
+        model.update_action_mean(np.random.normal(size=action_dim).astype(np.float32))
+        model.update_action_var(np.random.uniform(0.5, 2., size=action_dim).astype(np.float32))
+        nn_params = model.create_folded_nn_params()
+
+        states = np.random.normal(size=(12, state_dim))
+        actions = np.random.normal(size=(12, action_dim))
+        members = ensemble_members(nn_params, 12)
+        workspace = rollout_workspace(nn_params, 12)
+        next_states = workspace.forward_np(nn_params, states, actions, np.empty((12, state_dim)), members)
+
+        n_states, n_actions = model.normalize_state_action(states, actions)
+        x = torch.from_numpy(np.concatenate((n_states, n_actions), axis=1)).float()
+        expected = model.denormalize_state(model(x).detach().numpy() + n_states)
+        self.assertTrue(model(x).shape == (num_members, 12, state_dim))
+        self.assertTrue(np.max(np.abs(next_states - expected[members, np.arange(12)])) < 1e-4)
+        self.assertTrue(np.max(np.abs(model.forward_np(states[0], actions[0]) - expected[:, 0].mean(axis=0))) < 1e-4)
+
+        # Fit a linear function with a probabilistic ensemble
+        model = EnsembleDynamicsModel(state_dim, action_dim, num_members=num_members, probabilistic=True,
+                                      hidden_dim=32)
+        optimizer = torch.optim.Adam(model.parameters(), lr=1e-2)
+        input = torch.randn(256, state_dim + action_dim)
+        target = 0.5 * input[:, :state_dim]
+        with torch.no_grad():
+            initial_mse = nn.MSELoss()(model.predict(input), target).item()
+        for i in range(200):
+            optimizer.zero_grad()
+            loss = model.training_loss(input, target, nn.MSELoss())
+            loss.backward()
+            optimizer.step()
+        mean, logvar = model.mean_logvar(input)
+        self.assertTrue(logvar.shape == (num_members, 256, state_dim))
+        with torch.no_grad():
+            self.assertTrue(nn.MSELoss()(model.predict(input), target).item() < 0.1 * initial_mse)
@@ -1,7 +1,8 @@
-from unittest import TestCase
+from unittest import TestCase, mock
 from control.mbrl import MBRLLearner
 import gymnasium as gym
 import numpy as np
+import tempfile
 
 
 class TestMBRL(TestCase):
@@ -99,3 +100,25 @@ class TestMBRL(TestCase):
                               terminate=None, batch_size=batch_size, num_rand_eps=train_buffer_len,
                               save_name="pend_demo_256", normalize=True)
         learner.train()
+
+    def test_discrete_action_bounds(self):
+        """
+        Test that an environment whose action space is not a Box needs explicit action bounds.
+        """
+        def make_dicts(**bounds):
+            env_dict = dict({'state_dim': 4, 'action_dim': 1, 'env': gym.make("CartPole-v1")}, **bounds)
+            train_dict = {'num_episodes': 1, 'episode_len': 10, 'reward': lambda state, action: 1,
+                          'terminate': None, 'lr': 1e-3, 'batch_size': 8, 'num_rand_eps': 1, 'rl_prop': 0,
+                          'epsilon': 0}
+            mpc_dict = {'num_traj': 16, 'gamma': 0.99, 'horizon': 5}
+            misc_dict = {'print_every_n_episodes': 1, 'normalize': True, 'override_env_reward': False,
+                         'override_env_terminate': False, 'save_name': 'test_discrete_action_bounds',
+                         'save_every_n_episodes': 1}
+            return env_dict, train_dict, mpc_dict, misc_dict
+
+        with tempfile.TemporaryDirectory() as models_path, mock.patch('control.mbrl.MODELS_PATH', models_path):
+            self.assertRaises(ValueError, MBRLLearner, *make_dicts())
+            self.assertRaises(ValueError, MBRLLearner, *make_dicts(action_low=0.))
+
+            learner = MBRLLearner(*make_dicts(action_low=0., action_high=1.))
+            self.assertTrue(np.all(learner.policy.action_low == 0) and np.all(learner.policy.action_high == 1))
@@ -2,6 +2,7 @@ from unittest import TestCase
 from src.control.dynamics import DynamicsModel
 from src.constants import MODELS_PATH
 from control.mpc import MPC
+from src.control.sampling import PopulationStream
 import gymnasium as gym
 import numpy as np
 import torch
@@ -241,3 +242,553 @@ class TestMPC(TestCase):
 
         print("--- %s seconds ---" % (time.time() - start_time))
 
+    def test_vectorized_rollout(self):
+        """
+        Test that rolling out all trajectories together gives the same returns as
+        rolling them out one at a time.
+        """
+        from src.control.mpc import do_rollout_static, do_vectorized_rollout_static
+        from src.control.rewards import BatchReward
+
+        state_dim = 4
+        action_dim = 2
+        num_traj = 32
+        horizon = 10
+        model = DynamicsModel(state_dim, action_dim, normalize=True)
+        model.update_state_mean(np.random.normal(size=state_dim).astype(np.float32))
+        model.update_state_var(np.random.uniform(0.5, 2., size=state_dim).astype(np.float32))
+        model.update_action_mean(np.random.normal(size=action_dim).astype(np.float32))
+        model.update_action_var(np.random.uniform(0.5, 2., size=action_dim).astype(np.float32))
+        nn_params = model.create_nn_params()
+        folded_nn_params = model.create_folded_nn_params()
+        mpc_params = {'gamma': 0.9, 'horizon': horizon}
+
+        def reward(state, action):
+            return state[0] - 0.1 * np.linalg.norm(action) ** 2
+
+        state0 = np.random.normal(size=state_dim)
+        action_seqs = np.random.uniform(-1., 1., size=(num_traj, horizon, action_dim))
+
+        rets = do_vectorized_rollout_static(folded_nn_params, mpc_params, BatchReward(reward), None, state0,
+                                            action_seqs)
+        for seq in range(num_traj):
+            ret = do_rollout_static(nn_params, mpc_params, reward, None, state0, action_seqs, seq)
+            self.assertTrue(np.abs(ret - rets[seq]) < 1e-3 * max(1., np.abs(ret)))
+
+    def test_rollout_worker(self):
+        """
+        Test that a rollout worker keeps its weights between calls and matches the vectorized rollout.
+        """
+        from src.control.mpc import RolloutWorker, do_vectorized_rollout_static
+        from src.control.rewards import BatchReward
+
+        state_dim = 3
+        action_dim = 2
+        horizon = 5
+        model = DynamicsModel(state_dim, action_dim, normalize=True)
+        nn_params = model.create_folded_nn_params()
+        mpc_params = {'gamma': 0.95, 'horizon': horizon, 'batched': True}
+
+        def reward(state, action):
+            return -np.linalg.norm(state) ** 2
+
+        worker = RolloutWorker(mpc_params, BatchReward(reward), None)
+        worker.set_nn_params(nn_params)
+        state0 = np.ones(state_dim)
+        for i in range(3):
+            action_seqs = np.random.normal(size=(16, horizon, action_dim))
+            rets = worker.rollout(state0, action_seqs)
+            expected = do_vectorized_rollout_static(nn_params, mpc_params, BatchReward(reward), None,
+                                                    state0, action_seqs)
+            self.assertTrue(np.linalg.norm(rets - expected) < 1e-8)
+
+    def test_iterative_planners(self):
+        """
+        Test that CEM and MPPI, warm-started over a few control steps, move towards the optimal
+        action for a reward that only depends on the action.
+        """
+        np.random.seed(0)
+        state_dim = 3
+        model = DynamicsModel(state_dim, 8)
+        optimal_action = 0.2 * np.ones(8)
+
+        def reward(state, action):
+            return -np.linalg.norm(action - optimal_action) ** 2
+
+        for planner, planner_params in [('cem', {'num_elites': 8}), ('mppi', {'temperature': 0.1})]:
+            mpc = MPC(model, 64, 0.9, 5, reward, multithreading=False, batched=True,
+                      planner=planner, planner_params=planner_params, noise_scale=0.2)
+            for i in range(10):
+                action = mpc.plan(np.zeros(state_dim))
+            self.assertTrue(np.mean(np.abs(action - optimal_action)) < 0.1)
+            self.assertTrue(mpc.num_rollouts == 10 * 64 * 5)
+
+    def test_action_bounds(self):
+        """
+        Test that sampled action sequences have the model's action dimension and respect per-dimension bounds.
+        """
+        state_dim = 2
+        action_dim = 3
+        model = DynamicsModel(state_dim, action_dim)
+        action_low = np.array([-2., -0.3, 0.])
+        action_high = np.array([2., 0.3, 1.])
+
+        def reward(state, action):
+            return 1
+
+        mpc = MPC(model, 200, 0.9, 7, reward, multithreading=False, batched=True,
+                  action_low=action_low, action_high=action_high)
+        action_seqs = mpc.sample_action_seqs(mpc.initial_mean(), 1.0)
+        self.assertTrue(action_seqs.shape == (200, 7, action_dim))
+        self.assertTrue(np.all(action_seqs >= action_low) and np.all(action_seqs <= action_high))
+
+        # Samples should not pile up on the bounds the way clipped samples do
+        self.assertTrue(np.mean(np.abs(action_seqs[:, :, 1]) == 0.3) < 0.01)
+
+        mpc.plan(np.zeros(state_dim))
+        action = mpc.plan(np.zeros(state_dim))
+        self.assertTrue(action.shape == (action_dim,))
+
+    def test_ensemble_particles(self):
+        """
+        Test that the return of an action sequence is the mean over its particles, each rolled out
+        with the member it is assigned to.
+        """
+        from src.control.dynamics import EnsembleDynamicsModel
+        from src.control.mpc import do_vectorized_rollout_static
+
+        state_dim = 3
+        action_dim = 2
+        num_members = 4
+        horizon = 6
+        model = EnsembleDynamicsModel(state_dim, action_dim, num_members=num_members, hidden_dim=16)
+        nn_params = model.create_folded_nn_params()
+
+        def reward_batch(states, actions):
+            return states[:, 0] - 0.1 * np.sum(actions ** 2, axis=1)
+
+        state0 = np.random.normal(size=state_dim)
+        action_seqs = np.random.uniform(-1., 1., size=(10, horizon, action_dim))
+        mpc_params = {'gamma': 0.9, 'horizon': horizon, 'num_particles': num_members}
+        rets = do_vectorized_rollout_static(nn_params, mpc_params, reward_batch, None, state0, action_seqs)
+
+        # Roll out each member on its own, as a single-member ensemble
+        member_rets = []
+        for m in range(num_members):
+            member_params = dict(nn_params, num_members=1,
+                                 stack={key: value[m:m + 1] for key, value in nn_params['stack'].items()})
+            member_rets.append(do_vectorized_rollout_static(member_params, {'gamma': 0.9, 'horizon': horizon},
+                                                            reward_batch, None, state0, action_seqs))
+        self.assertTrue(np.max(np.abs(rets - np.mean(member_rets, axis=0))) < 1e-6)
+
+        mpc = MPC(model, 10, 0.9, horizon, None, multithreading=False, batched=True, reward_batch=reward_batch)
+        self.assertTrue(mpc.num_particles == num_members)
+        self.assertTrue(np.max(np.abs(mpc.evaluate(state0, action_seqs) - rets)) < 1e-6)
+
+    def test_seeded_probabilistic_rollouts(self):
+        """
+        Test that the next states sampled from a probabilistic ensemble are reproducible for a given seed, locally
+        and on each worker of a pool.
+        """
+        from src.control.dynamics import EnsembleDynamicsModel
+
+        state_dim = 3
+        action_dim = 2
+        horizon = 6
+        model = EnsembleDynamicsModel(state_dim, action_dim, num_members=4, probabilistic=True, hidden_dim=16)
+
+        def reward_batch(states, actions):
+            return states[:, 0] - 0.1 * np.sum(actions ** 2, axis=1)
+
+        state0 = np.random.normal(size=state_dim)
+        action_seqs = np.random.uniform(-1., 1., size=(40, horizon, action_dim))
+
+        def evaluate(seed, **kwargs):
+            mpc = MPC(model, 40, 0.9, horizon, None, batched=True, reward_batch=reward_batch, seed=seed, **kwargs)
+            try:
+                return np.concatenate([mpc.evaluate(state0, action_seqs) for i in range(2)])
+            finally:
+                mpc.shutdown_pool()
+
+        for kwargs in [{'multithreading': False},
+                       {'multithreading': True, 'num_workers': 2, 'transport': 'shared_memory'}]:
+            rets = evaluate(0, **kwargs)
+            self.assertTrue(np.array_equal(rets, evaluate(0, **kwargs)))
+            self.assertFalse(np.allclose(rets, evaluate(1, **kwargs)))
+
+            # Consecutive evaluations keep drawing from the same stream
+            self.assertFalse(np.allclose(rets[:40], rets[40:]))
+
+        # A worker rolls out every particle in the workspace it keeps between calls
+        from src.control.mpc import RolloutWorker
+
+        def worker_rollout(seed):
+            mpc_params = {'gamma': 0.9, 'horizon': horizon, 'batched': True, 'num_particles': 8, 'seed': seed}
+            worker = RolloutWorker(mpc_params, reward_batch, None)
+            worker.set_nn_params(model.create_folded_nn_params())
+            rets = worker.rollout(state0, action_seqs)
+            workspace = worker.workspace
+            rets = np.concatenate((rets, worker.rollout(state0, action_seqs)))
+            self.assertTrue(worker.workspace is workspace and workspace.num_traj == 8 * 40)
+            return rets
+
+        self.assertTrue(np.array_equal(worker_rollout(0), worker_rollout(0)))
+
+    def test_torch_backend(self):
+        """
+        Test that the torch rollout kernel gives the same returns as the NumPy rollouts, with termination,
+        locally and in a rollout worker.
+        """
+        from src.control.mpc import RolloutWorker
+
+        state_dim = 4
+        action_dim = 2
+        horizon = 8
+        model = DynamicsModel(state_dim, action_dim, normalize=True)
+        model.update_state_mean(np.random.normal(size=state_dim).astype(np.float32))
+        model.update_state_var(np.random.uniform(0.5, 2., size=state_dim).astype(np.float32))
+
+        def reward_batch(states, actions):
+            return states[:, 0] - 0.1 * (actions ** 2).sum(axis=1)
+
+        def terminate_batch(states, actions, t):
+            return (states[:, 1] > 0.5) | (t >= 6)
+
+        state0 = np.random.normal(size=state_dim)
+        action_seqs = np.random.uniform(-1., 1., size=(64, horizon, action_dim))
+        rets = {}
+        for backend in ['numpy', 'torch']:
+            mpc = MPC(model, 64, 0.9, horizon, None, multithreading=False, batched=True,
+                      reward_batch=reward_batch, terminate_batch=terminate_batch, backend=backend)
+            rets[backend] = mpc.evaluate(state0, action_seqs)
+        self.assertTrue(np.max(np.abs(rets['torch'] - rets['numpy'])) < 1e-5)
+
+        mpc_params = {'gamma': 0.9, 'horizon': horizon, 'batched': True, 'backend': 'torch'}
+        worker = RolloutWorker(mpc_params, reward_batch, terminate_batch)
+        worker.set_nn_params(model.create_folded_nn_params())
+        self.assertTrue(np.max(np.abs(worker.rollout(state0, action_seqs) - rets['numpy'])) < 1e-5)
+
+        self.assertRaises(ValueError, MPC, model, 64, 0.9, horizon, None, multithreading=False, batched=True,
+                          reward_batch=reward_batch, backend='jax')
+
+    def test_numba_backend(self):
+        """
+        Test that the JIT compiled rollouts give the same returns as the NumPy rollouts, with termination,
+        and that a reward numba cannot compile falls back to NumPy rollouts with a warning.
+        """
+        import warnings
+        from src.control.numba_rollout import numba_available
+        if not numba_available():
+            self.skipTest("numba is not installed")
+
+        state_dim = 4
+        action_dim = 2
+        horizon = 8
+        model = DynamicsModel(state_dim, action_dim, normalize=True)
+        model.update_state_mean(np.random.normal(size=state_dim).astype(np.float32))
+        model.update_state_var(np.random.uniform(0.5, 2., size=state_dim).astype(np.float32))
+
+        def reward(state, action):
+            return state[0] - 0.1 * np.linalg.norm(action) ** 2
+
+        def terminate(state, action, t):
+            return state[1] > 0.5 or t >= 6
+
+        state0 = np.random.normal(size=state_dim)
+        action_seqs = np.random.uniform(-1., 1., size=(40, horizon, action_dim))
+        rets = {}
+        for backend in ['numpy', 'numba']:
+            mpc = MPC(model, 40, 0.9, horizon, reward, terminate, multithreading=False, batched=True,
+                      backend=backend)
+            rets[backend] = mpc.evaluate(state0, action_seqs)
+        self.assertTrue(np.max(np.abs(rets['numba'] - rets['numpy'])) < 1e-4)
+
+        def object_reward(state, action):
+            return float(str(state[0]))
+
+        mpc = MPC(model, 40, 0.9, horizon, object_reward, multithreading=False, batched=True, backend='numba')
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            rets = mpc.evaluate(state0, action_seqs)
+        self.assertTrue(len(caught) == 1 and rets.shape == (40,))
+
+    def test_masked_rollout(self):
+        """
+        Test that terminated trajectories stop contributing reward and stop being stepped, and that compacting
+        the batch does not change the returns.
+        """
+        from src.control.dynamics import rollout_workspace
+        from src.control.mpc import do_rollout_static, do_vectorized_rollout_static
+        from src.control.rewards import BatchReward, BatchTerminate
+
+        state_dim = 3
+        action_dim = 2
+        num_traj = 50
+        horizon = 10
+        model = DynamicsModel(state_dim, action_dim, normalize=True)
+        nn_params = model.create_nn_params()
+        folded_nn_params = model.create_folded_nn_params()
+
+        def reward(state, action):
+            return 1. + state[0]
+
+        def terminate(state, action, t):
+            # Trajectories die at different times, driven by their first action
+            return action[0] > 0.3 and t >= 2 or action[1] > 0.9
+
+        state0 = np.zeros(state_dim)
+        action_seqs = np.random.uniform(-1., 1., size=(num_traj, horizon, action_dim))
+        expected = np.array([do_rollout_static(nn_params, {'gamma': 0.9, 'horizon': horizon}, reward, terminate,
+                                               state0, action_seqs, seq) for seq in range(num_traj)])
+
+        num_forward = {}
+        for compact_threshold in [0., 0.75, 1.]:
+            mpc_params = {'gamma': 0.9, 'horizon': horizon, 'compact_threshold': compact_threshold}
+            workspace = rollout_workspace(folded_nn_params, num_traj)
+            rets = do_vectorized_rollout_static(folded_nn_params, mpc_params, BatchReward(reward),
+                                                BatchTerminate(terminate), state0, action_seqs, workspace)
+            self.assertTrue(np.max(np.abs(rets - expected)) < 1e-4)
+            num_forward[compact_threshold] = workspace.num_forward
+
+        # Without compaction the whole batch is stepped until every trajectory has terminated
+        self.assertTrue(num_forward[0.] % num_traj == 0 and num_forward[0.] <= num_traj * (horizon - 1))
+        self.assertTrue(num_forward[1.] < num_forward[0.75] < num_forward[0.])
+
+        # The reward of a trajectory that has terminated is dropped, even if it is not finite
+        dead = np.cumsum(action_seqs[:, :, 1] > 0.9, axis=1) > (action_seqs[:, :, 1] > 0.9)
+        action_seqs[:, :, 0] = np.where(dead, 10., action_seqs[:, :, 0])
+
+        def reward_batch(states, actions):
+            return np.where(actions[:, 0] > 5., np.inf, 1.)
+
+        def terminate_batch(states, actions, t):
+            return actions[:, 1] > 0.9
+
+        mpc_params = {'gamma': 0.9, 'horizon': horizon, 'compact_threshold': 0.}
+        rets = do_vectorized_rollout_static(folded_nn_params, mpc_params, reward_batch, terminate_batch, state0,
+                                            action_seqs, rollout_workspace(folded_nn_params, num_traj))
+        expected = np.sum(0.9 ** np.arange(horizon) * ~dead, axis=1)
+        self.assertTrue(np.allclose(rets, expected))
+
+    def test_warm_start(self):
+        """
+        Test that the plan is shifted forward by one timestep between control steps, and that the best
+        sequences are carried into the next population.
+        """
+        state_dim = 2
+        action_dim = 2
+        horizon = 6
+        model = DynamicsModel(state_dim, action_dim)
+        target = np.linspace(-0.5, 0.5, horizon + 10)
+
+        def reward_batch(states, actions):
+            return np.zeros(states.shape[0])
+
+        mpc = MPC(model, 32, 0.9, horizon, None, multithreading=False, batched=True, reward_batch=reward_batch,
+                  planner_params={'num_carry': 4}, action_low=-1., action_high=1.)
+        mpc.plan(np.zeros(state_dim))
+        for step in range(3):
+            evaluated = []
+            evaluate = mpc.evaluate
+
+            def record(state0, action_seqs):
+                evaluated.append(np.copy(action_seqs))
+                return -np.sum(np.abs(action_seqs[:, :, 0] - target[step:step + horizon]), axis=1)
+
+            mpc.evaluate = record
+            action = mpc.plan(np.zeros(state_dim))
+            mpc.evaluate = evaluate
+
+            rets = record(None, evaluated[0])
+            best = evaluated[0][np.argmax(rets)]
+            self.assertTrue(np.array_equal(action, best[0]))
+            self.assertTrue(np.array_equal(mpc.past_trajectory[:-1], best[1:]))
+            self.assertTrue(np.array_equal(mpc.past_trajectory[-1], np.zeros(action_dim)))
+
+            # The 4 best sequences of this step, shifted, are the first 4 of the next population
+            carried = evaluated[0][np.argsort(rets)[-4:], 1:]
+            self.assertTrue(np.array_equal(mpc.carried_seqs[:, :-1], carried))
+            if step > 0:
+                self.assertTrue(np.array_equal(evaluated[0][:4], carried_before))
+            carried_before = np.copy(mpc.carried_seqs)
+
+    def test_time_budget(self):
+        """
+        Test that in anytime mode planning stops evaluating chunks once the time budget is used up, returns
+        the best action among the evaluated sequences, and reports how many rollouts fit in the budget.
+        """
+        state_dim = 2
+        action_dim = 1
+        horizon = 4
+        model = DynamicsModel(state_dim, action_dim)
+
+        def slow_reward_batch(states, actions):
+            time.sleep(0.01)
+            return -np.sum(actions ** 2, axis=1)
+
+        mpc = MPC(model, 64, 0.9, horizon, None, multithreading=False, batched=True,
+                  reward_batch=slow_reward_batch, time_budget=0.1, chunk_size=8)
+        mpc.plan(np.zeros(state_dim))
+        evaluated = []
+        evaluate = mpc.evaluate
+
+        def record(state0, action_seqs):
+            rets = evaluate(state0, action_seqs)
+            evaluated.append((np.copy(action_seqs), rets))
+            return rets
+
+        mpc.evaluate = record
+        action = mpc.plan(np.zeros(state_dim))
+        stats = mpc.last_stats
+        self.assertTrue(stats['deadline_hit'] and stats['iterations'] == 1)
+        self.assertTrue(0 < stats['rollouts'] < 64 and stats['rollouts'] == 8 * len(evaluated))
+        self.assertTrue(stats['time'] < 0.1 + 2 * 0.01 * horizon)
+        action_seqs = np.concatenate([seqs for seqs, rets in evaluated])
+        rets = np.concatenate([rets for seqs, rets in evaluated])
+        self.assertTrue(np.array_equal(action, action_seqs[np.argmax(rets), 0]))
+
+        # Iterative planners also skip iterations once the budget is used up
+        mpc = MPC(model, 64, 0.9, horizon, None, multithreading=False, batched=True, planner='cem',
+                  reward_batch=slow_reward_batch, time_budget=0.1, chunk_size=64)
+        mpc.plan(np.zeros(state_dim))
+        self.assertTrue(mpc.last_stats['deadline_hit'] and 1 <= mpc.last_stats['iterations'] < 5)
+        self.assertTrue(mpc.last_stats['rollouts'] == 64 * mpc.last_stats['iterations'])
+
+    def test_plan_batch(self):
+        """
+        Test that plan_batch() plans every environment from its own state and warm start with one evaluation of
+        all environments' populations per iteration, and that rollouts from per-sequence start states match
+        rollouts of each start state on its own in every backend.
+        """
+        state_dim = 2
+        action_dim = 1
+        model = DynamicsModel(state_dim, action_dim)
+        states0 = np.array([[0.5, 0.], [-0.5, 0.], [0.2, 0.]])
+
+        def reward(state, action):
+            return -(action[0] - state[0]) ** 2
+
+        def reward_batch(states, actions):
+            return -(actions[:, 0] - states[:, 0]) ** 2
+
+        mpc = MPC(model, 64, 0.9, 1, reward, multithreading=False, batched=True, reward_batch=reward_batch,
+                  planner='cem', planner_params={'num_elites': 8}, action_low=-1., action_high=1.)
+        evaluated = []
+        evaluate = mpc.evaluate
+
+        def record(state0, action_seqs):
+            evaluated.append(action_seqs.shape[0])
+            return evaluate(state0, action_seqs)
+
+        mpc.evaluate = record
+        actions = mpc.plan_batch(states0)
+        self.assertEqual(actions.shape, (3, action_dim))
+        self.assertTrue(np.allclose(actions[:, 0], states0[:, 0], atol=0.05))
+        self.assertEqual(evaluated, [3 * 64] * 5)
+        self.assertTrue(mpc.last_stats['rollouts'] == 3 * 64 * 5 and mpc.last_stats['iterations'] == 5)
+
+        # Warm starts are kept per environment id
+        mpc.plan_batch(states0[1:], env_ids=['b', 'c'])
+        self.assertEqual(sorted(map(str, mpc.batch_warm_starts)), ['0', '1', '2', 'b', 'c'])
+        self.assertTrue(np.array_equal(mpc.batch_warm_starts[0][0][-1], np.zeros(action_dim)))
+        mpc.empty_past_trajectory()
+        self.assertEqual(mpc.batch_warm_starts, {})
+
+        horizon = 5
+        action_seqs = np.random.uniform(-1, 1, size=(3 * 16, horizon, action_dim))
+        start_states = np.repeat(states0, 16, axis=0)
+        backends = [('numpy', True), ('numpy', False), ('torch', True)]
+        from src.control.numba_rollout import numba_available
+        if numba_available():
+            backends.append(('numba', False))
+        for backend, batched in backends:
+            mpc = MPC(model, 16, 0.9, horizon, reward, multithreading=False, batched=batched,
+                      reward_batch=reward_batch, backend=backend)
+            rets = mpc.evaluate(start_states, action_seqs)
+            for b in range(3):
+                rets_b = mpc.evaluate(states0[b], action_seqs[16 * b:16 * (b + 1)])
+                self.assertTrue(np.allclose(rets[16 * b:16 * (b + 1)], rets_b, atol=1e-5), backend)
+
+    def test_shared_memory_pool(self):
+        """
+        Test that the shared memory worker pool gives the same returns as local rollouts, for batched and
+        unbatched rollouts and per-sequence start states, while only sending each worker the bounds of its slice.
+        """
+        state_dim = 3
+        action_dim = 2
+        horizon = 6
+        model = DynamicsModel(state_dim, action_dim, normalize=True)
+        action_seqs = np.random.uniform(-1, 1, size=(40, horizon, action_dim))
+        states0 = np.random.normal(size=(40, state_dim))
+
+        def reward(state, action):
+            return state[0] - np.sum(action ** 2)
+
+        def terminate(state, action, t):
+            return abs(state[1]) > 1
+
+        for batched in [True, False]:
+            local = MPC(model, 40, 0.9, horizon, reward, terminate, multithreading=False, batched=batched)
+            mpc = MPC(model, 40, 0.9, horizon, reward, terminate, multithreading=True, batched=batched,
+                      num_workers=3, transport='shared_memory')
+            try:
+                for state0 in [states0[0], states0]:
+                    rets = mpc.evaluate(state0, action_seqs)
+                    self.assertTrue(np.allclose(rets, local.evaluate(state0, action_seqs), atol=1e-5))
+
+                # Only the model's first sync writes the weights, and the messages do not grow with the number
+                # of action sequences
+                bytes_sent = mpc.pool.bytes_sent
+                mpc.evaluate(states0[0], action_seqs)
+                step_bytes = mpc.pool.bytes_sent - bytes_sent
+                mpc.evaluate(states0[0], np.tile(action_seqs, (10, 1, 1)))
+                self.assertTrue(step_bytes < 1000)
+                self.assertTrue(mpc.pool.bytes_sent - bytes_sent - step_bytes < step_bytes + 50)
+            finally:
+                mpc.shutdown_pool()
+
+    def test_worker_sampling(self):
+        """
+        Test that populations sampled by the workers from counter-based streams give the same plans as sampling
+        them locally, whatever the number of workers, and that any subset of rows is rebuilt exactly.
+        """
+        np.random.seed(0)
+        means = np.random.normal(size=(2, 5, 3))
+        carried_seqs = [np.ones((2, 5, 3)), None]
+        stream = PopulationStream(means, 0.5, -np.ones(3), np.ones(3), [[1, 2], [1, 3]], 10, carried_seqs)
+        action_seqs = stream.sample(0, 20)
+        self.assertTrue(np.allclose(stream.rows([3, 17, 0, 19]), action_seqs[[3, 17, 0, 19]]))
+        self.assertTrue(np.allclose(stream.sample(7, 13), action_seqs[7:13]))
+        self.assertTrue(np.allclose(action_seqs[:2], 1))
+        self.assertTrue(np.all(np.abs(action_seqs) <= 1))
+
+        model = DynamicsModel(3, 2, normalize=True)
+        states0 = np.random.normal(size=(3, 3))
+
+        def reward(state, action):
+            return state[0] - np.sum(action ** 2)
+
+        def plan(planner, num_traj=64, **kwargs):
+            mpc = MPC(model, num_traj, 0.9, 8, reward, None, batched=True, planner=planner, worker_sampling=True,
+                      seed=3, planner_params={'num_iters': 2, 'num_elites': 8, 'num_carry': 4}, **kwargs)
+            try:
+                actions = [mpc.plan(state0) for state0 in states0]
+                actions.append(mpc.plan_batch(states0[:2]).ravel())
+                actions.append(mpc.plan_batch(states0[:2]).ravel())
+                bytes_sent = mpc.pool.bytes_sent if mpc.pool is not None else None
+            finally:
+                mpc.shutdown_pool()
+            return np.concatenate(actions), bytes_sent
+
+        for planner in ['random_shooting', 'cem', 'mppi']:
+            actions, _ = plan(planner, multithreading=False)
+            for num_workers in [1, 3]:
+                pool_actions, bytes_sent = plan(planner, multithreading=True, num_workers=num_workers,
+                                                transport='shared_memory')
+                self.assertTrue(np.allclose(actions, pool_actions), planner)
+
+        # The messages do not grow with the number of action sequences
+        _, bytes_sent = plan('random_shooting', multithreading=True, num_workers=2, transport='shared_memory')
+        _, more_bytes_sent = plan('random_shooting', num_traj=640, multithreading=True, num_workers=2,
+                                  transport='shared_memory')
+        self.assertTrue(more_bytes_sent < bytes_sent + 100)
@@ -0,0 +1,72 @@
+from unittest import TestCase
+from src.control.dynamics import DynamicsModel, EnsembleDynamicsModel
+from src.control.precision import bfloat16_supported, float16_supported, export_low_precision, precision_report
+from src.control.mpc import MPC
+from unittest import mock
+import numpy as np
+import warnings
+
+
+class TestPrecision(TestCase):
+
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    def test_precision_report(self):
+        """
+        Test that reduced precision exports stay close to the float32 network over a horizon.
+        """
+        np.random.seed(0)
+        state_dim = 6
+        action_dim = 2
+        model = DynamicsModel(state_dim, action_dim, normalize=True)
+        model.update_state_mean(np.random.normal(size=state_dim).astype(np.float32))
+        model.update_state_var(np.random.uniform(0.5, 2., size=state_dim).astype(np.float32))
+        states = np.random.normal(size=(256, state_dim))
+        action_seqs = np.random.uniform(-1., 1., size=(256, 5, action_dim))
+
+        report = {row['precision']: row for row in precision_report(model, states, action_seqs, num_repeats=2)}
+        self.assertTrue(report['float32']['one_step_error'] == 0)
+        self.assertTrue(report['int8']['exported_precision'] == 'int8')
+        for precision, supported in [('bfloat16', bfloat16_supported()), ('float16', float16_supported())]:
+            self.assertTrue(report[precision]['exported_precision'] == (precision if supported else 'float32'))
+        for precision, tol in [('bfloat16', 0.05), ('float16', 0.01), ('int8', 0.05)]:
+            if report[precision]['exported_precision'] != 'float32':
+                self.assertTrue(0 < report[precision]['one_step_error'] < tol)
+            self.assertTrue(report[precision]['horizon_error'] < 2 * tol)
+            self.assertTrue(report[precision]['transitions_per_sec'] > 0)
+
+        # Without native support the half precisions fall back to float32, warning once each
+        with mock.patch('src.control.precision.bfloat16_supported', return_value=False), \
+                mock.patch('src.control.precision.float16_supported', return_value=False), \
+                mock.patch('src.control.precision._warned_fallbacks', set()):
+            with warnings.catch_warnings(record=True) as caught:
+                warnings.simplefilter('always')
+                exported = [export_low_precision(model, precision)['precision']
+                            for precision in ['bfloat16', 'float16', 'bfloat16', 'float16']]
+        self.assertTrue(exported == ['float32'] * 4 and len(caught) == 2)
+
+    def test_low_precision_mpc(self):
+        """
+        Test that an MPC rolling out in int8 picks (nearly) the same action sequence as in float32.
+        """
+        state_dim = 3
+        action_dim = 2
+        model = DynamicsModel(state_dim, action_dim)
+
+        def reward_batch(states, actions):
+            return -np.sum(states ** 2, axis=1)
+
+        state0 = np.ones(state_dim)
+        action_seqs = np.random.uniform(-1., 1., size=(64, 5, action_dim))
+        rets = {}
+        for precision in ['float32', 'int8']:
+            mpc = MPC(model, 64, 0.9, 5, None, multithreading=False, batched=True, reward_batch=reward_batch,
+                      precision=precision)
+            rets[precision] = mpc.evaluate(state0, action_seqs)
+        self.assertTrue(np.max(np.abs(rets['int8'] - rets['float32'])) < 0.05 * np.max(np.abs(rets['float32'])))
+
+        self.assertRaises(ValueError, export_low_precision, EnsembleDynamicsModel(state_dim, action_dim), 'int8')
@@ -1,5 +1,5 @@
 from unittest import TestCase
-from src.control.replay_buffer import ReplayBuffer
+from src.control.replay_buffer import ReplayBuffer, RunningMoments
 import numpy as np
 
 
@@ -58,3 +58,189 @@ class TestReplayBuffer(TestCase):
             self.assertTrue(np.linalg.norm(np.array([0.2, 0.2]) - n_s[i, :]) < epsilon)
 
         self.assertTrue(len(a) == 50)
+
+    def test_contiguous_storage(self):
+        """
+        Test the ring buffer storage: sampling from each partition and overwriting the oldest transitions.
+        """
+        replay_buffer = ReplayBuffer(state_dim=2, action_dim=1, max_size=20, normalize=False, contiguous=True)
+        for i in range(30):
+            replay_buffer.push(np.array([i, i], dtype=float), np.array([1.]), np.array([i + 0.5, i + 0.5]), False)
+
+        for i in range(10):
+            replay_buffer.push(np.array([2., 2.]), np.array([2.]), np.array([2.2, 2.2]), True)
+
+        self.assertTrue(len(replay_buffer) == 30)
+
+        s, a, n_s = replay_buffer.sample(batch_size=20, rl_prop=0)
+        self.assertTrue(s.shape == (20, 2) and a.shape == (20, 1))
+        self.assertTrue(np.min(s) >= 10)  # first 10 transitions were overwritten
+        self.assertTrue(len(set(s[:, 0])) == 20)  # sampled without replacement
+        self.assertTrue(np.linalg.norm(n_s - 0.5) < 1e-5)
+
+        s, a, n_s = replay_buffer.sample(batch_size=20, rl_prop=0.5)
+        self.assertTrue(np.linalg.norm(s[10:] - 2.) < 1e-5)
+        self.assertTrue(np.linalg.norm(a[10:] - 2.) < 1e-5)
+        self.assertTrue(np.linalg.norm(n_s[10:] - 0.2) < 1e-5)
+
+    def test_running_moments(self):
+        """
+        Test that pushing, batched pushing, merging and removal agree with recomputing the moments.
+        """
+        x = np.random.normal(loc=3., scale=2., size=(100, 4))
+
+        moments = RunningMoments(4)
+        for i in range(60):
+            moments.push(x[i])
+        other = RunningMoments(4)
+        other.push_batch(x[60:])
+        moments.merge(other)
+        self.assertTrue(moments.count == 100)
+        self.assertTrue(np.linalg.norm(moments.mean - np.mean(x, axis=0)) < 1e-8)
+        self.assertTrue(np.linalg.norm(moments.var - np.var(x, axis=0, ddof=1)) < 1e-8)
+
+        for i in range(10):
+            moments.remove(x[i])
+        moments.remove_batch(x[10:30])
+        self.assertTrue(np.linalg.norm(moments.mean - np.mean(x[30:], axis=0)) < 1e-8)
+        self.assertTrue(np.linalg.norm(moments.var - np.var(x[30:], axis=0, ddof=1)) < 1e-8)
+
+    def test_merge_statistics(self):
+        """
+        Test that merging the statistics of several workers' buffers gives the statistics of their concatenated
+        transitions.
+        """
+        states = np.random.normal(loc=1., scale=2., size=(90, 3))
+        actions = np.random.uniform(-1., 1., size=(90, 2))
+        buffers = [ReplayBuffer(state_dim=3, action_dim=2, normalize=True) for i in range(3)]
+        for i, replay_buffer in enumerate(buffers):
+            replay_buffer.push_batch(states[30 * i:30 * (i + 1)], actions[30 * i:30 * (i + 1)],
+                                     states[30 * i:30 * (i + 1)] + 0.1, False)
+        buffers[0].merge_statistics(buffers[1])
+        buffers[0].merge_statistics(buffers[2])
+
+        self.assertTrue(len(buffers[0]) == 30)
+        self.assertTrue(np.linalg.norm(buffers[0].get_state_mean() - np.mean(states, axis=0)) < 1e-8)
+        self.assertTrue(np.linalg.norm(buffers[0].get_state_var() - np.var(states, axis=0, ddof=1)) < 1e-8)
+        self.assertTrue(np.linalg.norm(buffers[0].get_action_mean() - np.mean(actions, axis=0)) < 1e-8)
+        self.assertTrue(np.linalg.norm(buffers[0].get_action_var() - np.var(actions, axis=0, ddof=1)) < 1e-8)
+
+        # The other buffers are unchanged
+        self.assertTrue(np.linalg.norm(buffers[1].get_state_mean() - np.mean(states[30:60], axis=0)) < 1e-8)
+
+    def test_statistics_with_eviction(self):
+        """
+        Test that the buffer statistics only describe the transitions it currently holds.
+        """
+        for contiguous in [False, True]:
+            replay_buffer = ReplayBuffer(state_dim=3, action_dim=2, max_size=50, normalize=True,
+                                         contiguous=contiguous)
+            states = np.random.normal(size=(200, 3))
+            actions = np.random.uniform(-1., 1., size=(200, 2))
+            for i in range(200):
+                replay_buffer.push(states[i], actions[i], states[i] + 0.1, i % 2 == 0)
+
+            held_states = np.concatenate((states[100:][0::2], states[100:][1::2]))
+            held_actions = np.concatenate((actions[100:][0::2], actions[100:][1::2]))
+            self.assertTrue(np.linalg.norm(replay_buffer.get_state_mean() - np.mean(held_states, axis=0)) < 1e-8)
+            self.assertTrue(np.linalg.norm(replay_buffer.get_state_var() -
+                                           np.var(held_states, axis=0, ddof=1)) < 1e-8)
+            self.assertTrue(np.linalg.norm(replay_buffer.get_action_var() -
+                                           np.var(held_actions, axis=0, ddof=1)) < 1e-8)
+
+    def test_push_batch(self):
+        """
+        Test that pushing whole episodes is equivalent to pushing their transitions one at a time.
+        """
+        for contiguous in [False, True]:
+            buffer_single = ReplayBuffer(state_dim=3, action_dim=2, max_size=40, normalize=True,
+                                         contiguous=contiguous)
+            buffer_batch = ReplayBuffer(state_dim=3, action_dim=2, max_size=40, normalize=True,
+                                        contiguous=contiguous)
+            for ep, ep_len in enumerate([15, 30, 1, 55, 20]):
+                states = np.random.normal(size=(ep_len, 3))
+                actions = np.random.normal(size=(ep_len, 2))
+                next_states = states + np.random.normal(size=(ep_len, 3))
+                rl = ep % 2 == 1
+                for t in range(ep_len):
+                    buffer_single.push(states[t], actions[t], next_states[t], rl)
+                buffer_batch.push_batch(states, actions, next_states, rl)
+
+                self.assertTrue(len(buffer_single) == len(buffer_batch))
+                self.assertTrue(np.linalg.norm(buffer_single.get_state_mean() - buffer_batch.get_state_mean()) < 1e-8)
+                self.assertTrue(np.linalg.norm(buffer_single.get_state_var() - buffer_batch.get_state_var()) < 1e-8)
+                self.assertTrue(np.linalg.norm(buffer_single.get_action_var() -
+                                               buffer_batch.get_action_var()) < 1e-8)
+
+            size = len(buffer_single.rl_data)
+            s1, s2 = np.zeros((size, 3)), np.zeros((size, 3))
+            buffer_single.sample_data(buffer_single.rl_data, size, buffer_single.rng, s1, np.zeros((size, 2)),
+                                      np.zeros((size, 3)))
+            buffer_batch.sample_data(buffer_batch.rl_data, size, buffer_batch.rng, s2, np.zeros((size, 2)),
+                                     np.zeros((size, 3)))
+            self.assertTrue(np.linalg.norm(np.sort(s1, axis=0) - np.sort(s2, axis=0)) < 1e-8)
+
+    def test_normalized_sample(self):
+        """
+        Test normalization and noise injection: no noise gives exactly normalized tuples, per-dimension
+        noise scales are respected, and sampling is reproducible for a given seed.
+        """
+        states = np.random.normal(loc=2., scale=3., size=(500, 2))
+        actions = np.random.normal(loc=-1., scale=0.5, size=(500, 1))
+        next_states = states + np.random.normal(size=(500, 2))
+
+        def make_buffer(state_noise_scale, seed):
+            replay_buffer = ReplayBuffer(state_dim=2, action_dim=1, max_size=1000, normalize=True, contiguous=True,
+                                         state_noise_scale=state_noise_scale, action_noise_scale=0., seed=seed)
+            replay_buffer.push_batch(states, actions, next_states, False)
+            return replay_buffer
+
+        replay_buffer = make_buffer(0., 0)
+        n_s, n_a, d_n_s = replay_buffer.sample(batch_size=500)
+        self.assertTrue(np.linalg.norm(np.mean(n_s, axis=0)) < 1e-8)
+        self.assertTrue(np.linalg.norm(np.var(n_s, axis=0, ddof=1) - 1.) < 1e-8)
+        self.assertTrue(np.linalg.norm(np.var(n_a, axis=0, ddof=1) - 1.) < 1e-8)
+        self.assertTrue(np.abs(np.sum(d_n_s * np.sqrt(replay_buffer.get_state_var())) -
+                               np.sum(next_states - states)) < 1e-6)
+
+        # Per-dimension noise: second state dimension gets no noise
+        replay_buffer = make_buffer(np.array([1., 0.]), 0)
+        n_s, n_a, d_n_s = replay_buffer.sample(batch_size=500)
+        self.assertTrue(np.abs(np.var(n_s[:, 0]) - 2.) < 0.5)
+        self.assertTrue(np.abs(np.var(n_s[:, 1], ddof=1) - 1.) < 1e-8)
+
+        # Same seed, same batches
+        batch_1 = [np.copy(x) for x in make_buffer(0.1, 3).sample(batch_size=64)]
+        batch_2 = [np.copy(x) for x in make_buffer(0.1, 3).sample(batch_size=64)]
+        for x_1, x_2 in zip(batch_1, batch_2):
+            self.assertTrue(np.array_equal(x_1, x_2))
+
+    def test_validation_split(self):
+        """
+        Test that held-out transitions are kept out of training batches and statistics, for both storage layouts.
+        """
+        states = np.random.normal(size=(1000, 2))
+        actions = np.random.normal(size=(1000, 1))
+        for contiguous in [False, True]:
+            replay_buffer = ReplayBuffer(state_dim=2, action_dim=1, max_size=2000, normalize=True,
+                                         contiguous=contiguous, seed=0, val_prop=0.2)
+            replay_buffer.push_batch(states[:500], actions[:500], states[:500] + 1., False)
+            for i in range(500, 1000):
+                replay_buffer.push(states[i], actions[i], states[i] + 1., True)
+
+            num_val = len(replay_buffer.val_data)
+            self.assertTrue(150 < num_val < 250 and len(replay_buffer) + num_val == 1000)
+            if contiguous:
+                train_states = np.concatenate((replay_buffer.rand_data.state[:len(replay_buffer.rand_data)],
+                                               replay_buffer.rl_data.state[:len(replay_buffer.rl_data)]))
+            else:
+                train_states = np.array([t.state for t in replay_buffer.rand_data] +
+                                        [t.state for t in replay_buffer.rl_data])
+            self.assertTrue(np.allclose(replay_buffer.get_state_mean(), np.mean(train_states, axis=0)))
+
+            # Validation data is normalized without noise
+            n_s, n_a, d_n_s = replay_buffer.validation_batch()
+            self.assertTrue(n_s.shape == (num_val, 2) and n_a.shape == (num_val, 1))
+            self.assertTrue(np.allclose(d_n_s, 1. / np.sqrt(replay_buffer.get_state_var())))
+
+        self.assertTrue(ReplayBuffer(state_dim=2, action_dim=1, val_prop=0.2).validation_batch() is None)
@@ -0,0 +1,41 @@
+from unittest import TestCase
+from src.control.rewards import BatchReward, BatchTerminate, vectorize_reward, vectorize_terminate
+import numpy as np
+
+
+class TestRewards(TestCase):
+
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    def test_batch_adapters(self):
+        """
+        Test that the adapters give the same values as calling the scalar functions row by row.
+        """
+        def reward(state, action):
+            return state[1] - 0.5 * np.linalg.norm(action) ** 2
+
+        def terminate(state, action, t):
+            return state[0] < 0.2 or t > 3
+
+        states = np.random.uniform(0., 1., size=(20, 3))
+        actions = np.random.normal(size=(20, 2))
+
+        rewards = BatchReward(reward)(states, actions)
+        dones = BatchTerminate(terminate)(states, actions, 2)
+        self.assertTrue(rewards.shape == (20,))
+        self.assertTrue(dones.dtype == bool)
+        for i in range(20):
+            self.assertTrue(np.abs(rewards[i] - reward(states[i], actions[i])) < 1e-10)
+            self.assertTrue(dones[i] == terminate(states[i], actions[i], 2))
+
+    def test_vectorize(self):
+        def reward_batch(states, actions):
+            return states[:, 0]
+
+        self.assertTrue(vectorize_reward(None, reward_batch) is reward_batch)
+        self.assertTrue(isinstance(vectorize_reward(lambda s, a: 1), BatchReward))
+        self.assertTrue(vectorize_terminate(None) is None)
@@ -0,0 +1,91 @@
+from unittest import TestCase
+from src.control.dynamics import DynamicsModel
+from src.control.replay_buffer import ReplayBuffer
+from src.control.training import DynamicsTrainer, AsyncDynamicsLearner
+import copy
+import time
+import numpy as np
+import torch
+import torch.nn as nn
+
+
+class TestTraining(TestCase):
+
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    def make_trainer(self, **kwargs):
+        torch.manual_seed(0)
+        rng = np.random.default_rng(0)
+        replay_buffer = ReplayBuffer(state_dim=2, action_dim=1, max_size=2000, normalize=True, contiguous=True,
+                                     state_noise_scale=0.01, action_noise_scale=0.01, seed=0, val_prop=0.2)
+        states = rng.normal(size=(1000, 2))
+        actions = rng.normal(size=(1000, 1))
+        replay_buffer.push_batch(states, actions, states + 0.1 * actions, False)
+
+        model = DynamicsModel(state_dim=2, action_dim=1, normalize=True)
+        optimizer = torch.optim.Adam(model.parameters(), lr=1e-3)
+        return DynamicsTrainer(model, optimizer, nn.MSELoss(), replay_buffer, batch_size=64, **kwargs)
+
+    def test_train_steps(self):
+        """
+        Test that without epochs, fit() runs exactly 'train_steps' gradient steps.
+        """
+        trainer = self.make_trainer(train_steps=4)
+        version = trainer.model.version
+        stats = trainer.fit(seed=0)
+        self.assertTrue(stats['steps'] == 4 and stats['epochs'] == 1)
+        self.assertTrue(stats['val_loss'] is not None and stats['samples_per_sec'] > 0)
+        self.assertTrue(trainer.model.version > version)
+
+    def test_early_stopping(self):
+        """
+        Test that epoch-based training reduces the validation error, and that it stops early and keeps
+        the best weights once the validation error stops improving.
+        """
+        trainer = self.make_trainer(train_epochs=50, patience=2, min_delta=1e-3)
+        initial_val_loss = trainer.validate()
+        stats = trainer.fit(seed=0)
+        steps_per_epoch = len(trainer.replay_buffer) // 64
+
+        self.assertTrue(stats['stopped_early'])
+        self.assertTrue(stats['epochs'] < 50 and stats['steps'] == stats['epochs'] * steps_per_epoch)
+        self.assertTrue(stats['val_loss'] < 0.1 * initial_val_loss)
+        self.assertTrue(np.isclose(trainer.validate(), stats['val_loss']))
+
+    def test_async_learner(self):
+        """
+        Test that the asynchronous learner keeps training while transitions are pushed, and that sync() only
+        refreshes a copy of the model once its snapshot is more than max_staleness versions old, and that it
+        makes at most one update per reported episode by default.
+        """
+        trainer = self.make_trainer(train_steps=2)
+        policy_model = copy.deepcopy(trainer.model)
+        rng = np.random.default_rng(1)
+        with AsyncDynamicsLearner(trainer, min_buffer_size=64, seed=0) as learner:
+            for i in range(20):
+                states = rng.normal(size=(10, 2))
+                actions = rng.normal(size=(10, 1))
+                trainer.replay_buffer.push_batch(states, actions, states + 0.1 * actions, True)
+                if i < 5:
+                    learner.add_episodes()
+                time.sleep(0.01)
+            while learner.latest()[0] < 3:
+                time.sleep(0.01)
+            time.sleep(0.1)
+            self.assertTrue(learner.latest()[0] <= 5)
+
+            version = learner.sync(policy_model, 0)
+            self.assertTrue(version >= 3)
+            self.assertEqual(learner.sync(policy_model, version, max_staleness=10 ** 6), version)
+        self.assertTrue(learner.thread is None)
+
+        # Once stopped, syncing gives the copy exactly the trainer's final weights
+        version = learner.sync(policy_model, version)
+        latest_version, snapshot, stats = learner.latest()
+        self.assertTrue(version == latest_version and stats['steps'] == 2)
+        for key, value in trainer.model.state_dict().items():
+            self.assertTrue(torch.equal(value, policy_model.state_dict()[key]))